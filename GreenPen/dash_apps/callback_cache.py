@@ -0,0 +1,76 @@
+import functools
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from plotly.utils import PlotlyJSONEncoder
+
+from GreenPen.models import Student, Syllabus, data_version
+
+
+def user_scope(user):
+    """
+    The part of a cache key that depends on who is asking: their role, and
+    which students they can see. Teachers can see every student; students only
+    themselves. As in the dashboards' get_students_from_graph(), being in the
+    Students group wins over being in the Teachers group.
+    """
+    if user.groups.filter(name='Students').exists():
+        return ['Students', sorted(Student.objects.filter(user=user).values_list('pk', flat=True))]
+    if user.groups.filter(name='Teachers').exists():
+        return ['Teachers', 'all']
+    return ['None', []]
+
+
+def subject_tree_id(inputs):
+    """ The syllabus tree of the subject chosen in the callback inputs, if any. """
+    subject_pk = inputs.get('subject-dropdown.value')
+    if not subject_pk:
+        return None
+    return Syllabus.objects.filter(pk=subject_pk).values_list('tree_id', flat=True).first()
+
+
+def cached_callback(timeout=None):
+    """
+    Cache the responses of a Dash expanded callback, so that the same request
+    from another user with the same role and visible students is answered
+    without running the callback again. Use it beneath @app.expanded_callback.
+
+    The key is made up of the callback, its inputs and states, the user's scope
+    (see user_scope()) and the data version of the chosen subject. Saving marks
+    or recalculating ratings bumps the data version (see
+    GreenPen.models.bump_data_versions), so stale responses are never served.
+
+    :param timeout: seconds to keep responses for. Defaults to
+                    settings.DASH_CALLBACK_CACHE_TIMEOUT; 0 turns caching off.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            ttl = settings.DASH_CALLBACK_CACHE_TIMEOUT if timeout is None else timeout
+            callback = kwargs.get('callback_context')
+            if not ttl or callback is None or 'user' not in kwargs:
+                return func(*args, **kwargs)
+
+            inputs = dict(callback.inputs or {})
+            key_parts = [func.__module__,
+                         func.__qualname__,
+                         inputs,
+                         dict(getattr(callback, 'states', None) or {}),
+                         user_scope(kwargs['user']),
+                         data_version(subject_tree_id(inputs))]
+            key = 'dash_callback_' + hashlib.sha256(
+                json.dumps(key_parts, sort_keys=True, default=str).encode()).hexdigest()
+
+            response = cache.get(key)
+            if response is None:
+                # Store the response as JSON, as Plotly figure objects don't
+                # always pickle cleanly.
+                response = json.dumps(func(*args, **kwargs), cls=PlotlyJSONEncoder)
+                cache.set(key, response, ttl)
+            return json.loads(response)
+
+        return wrapper
+
+    return decorator
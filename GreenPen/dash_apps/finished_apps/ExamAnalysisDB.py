@@ -10,6 +10,7 @@ import dash_bootstrap_components as dbc
 import plotly.graph_objs as go
 from django_plotly_dash import DjangoDash
 from GreenPen.models import Syllabus, Student, Sitting, TeachingGroup, Mistake, Mark, Question, Exam
+from GreenPen.dash_apps.callback_cache import cached_callback
 from django.contrib.auth.models import User
 from GreenPen.settings import CURRENT_ACADEMIC_YEAR
 from GreenPen.models import generate_analsysios_df
@@ -72,6 +73,7 @@ app.css.append_css({
      Input('exam-dropdown', 'value'),
      Input('sitting-dropdown', 'value'),
      ])
+@cached_callback()
 def update_results_table(*args, **kwargs):
     callback = kwargs['callback_context']
 
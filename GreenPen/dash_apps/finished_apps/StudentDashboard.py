@@ -6,9 +6,13 @@ from dash.dependencies import Input, Output
 import dash_bootstrap_components as dbc
 import plotly.graph_objs as go
 from django_plotly_dash import DjangoDash
-from GreenPen.models import Syllabus, Student, Sitting, TeachingGroup
+from GreenPen.models import Syllabus, Student, Sitting, TeachingGroup, sitting_rating_series
+from GreenPen.dash_apps.callback_cache import cached_callback
 from GreenPen.settings import CURRENT_ACADEMIC_YEAR
 
+# Longest time series to plot; students with more sittings than this have them averaged in runs.
+TIME_GRAPH_MAX_POINTS = 100
+
 
 # Helper functions:
 
@@ -173,6 +177,7 @@ def get_root_pk(callback):
      Input('teachinggroup-dropdown', 'value'),
      Input('student-dropdown', 'value'),
      ])
+@cached_callback()
 def update_syllabus_sunburst(*args, **kwargs):
     callback = kwargs['callback_context']
     if not callback.inputs['student-dropdown.value']:
@@ -182,13 +187,16 @@ def update_syllabus_sunburst(*args, **kwargs):
     students = get_students_from_graph(kwargs)
 
     parent_point = Syllabus.objects.get(pk=subject_pk)
-    points = parent_point.get_descendants(include_self=True)
+    # Ratings for the whole subtree are calculated in one pass from the student's marks.
+    points, ratings = parent_point.student_ratings(students.get())
     labels = [point.text for point in points]
     ids = [point.pk for point in points]
-    parents = [point.parent.text for point in points]
+    texts = {point.pk: point.text for point in points}
+    parents = [texts.get(point.parent_id, "") for point in points]
     parents[0] = ""
     values = [1 for point in points]
-    colors = [point.cohort_stats(students)['rating'] for point in points]
+    colors = [rating if attempted else None
+              for rating, attempted in zip(ratings['rating'].tolist(), ratings['attempted_plus_children'].tolist())]
 
     graph = go.Sunburst(
         labels=labels,
@@ -223,6 +231,7 @@ def update_syllabus_sunburst(*args, **kwargs):
      Input('time-chart', 'clickData'),
      Input('teachinggroup-dropdown', 'value'),
      Input('student-dropdown', 'value')])
+@cached_callback()
 def update_rating_time_graph(*args, **kwargs):
     callback = kwargs['callback_context']
     parent_pk = get_root_pk(callback)
@@ -236,25 +245,15 @@ def update_rating_time_graph(*args, **kwargs):
         return False
 
     groups = TeachingGroup.objects.filter(students__in=students)
-    records = Sitting.objects.filter(exam__question__syllabus_points__in=parent_point.get_descendants(),
-                                     group__in=groups
-                                     ).order_by('date').distinct()
-    # text = [sitting.exam.name for sitting in records]
-    # x = [sitting.date for sitting in records]
-    # y = [sitting.avg_syllabus_rating(parent_point) for sitting in records]
-
-    text = []
-    x = []
-    y = []
-    ids = []
-
-    for sitting in records:
-        if sitting.student_total(students[0]):
-            string = str(sitting.group.name) + "<br>" + str(sitting.exam.name)
-            text.append(string)
-            x.append(sitting.date)
-            y.append(round(sitting.student_total(students[0])/sitting.exam.total_score(),2)*100)
-            ids.append(sitting.pk)
+    sittings = Sitting.objects.filter(exam__question__syllabus_points__in=parent_point.get_descendants(),
+                                      group__in=groups
+                                      ).distinct()
+    series = sitting_rating_series(parent_point, sittings, students, max_points=TIME_GRAPH_MAX_POINTS)
+
+    text = [str(group_name) + "<br>" + str(exam_name) for pk, date, group_name, exam_name, rating in series]
+    x = [date for pk, date, group_name, exam_name, rating in series]
+    y = [rating for pk, date, group_name, exam_name, rating in series]
+    ids = [pk for pk, date, group_name, exam_name, rating in series]
 
     graph = go.Scatter(
         x=x,
@@ -274,8 +273,8 @@ def update_rating_time_graph(*args, **kwargs):
             'title': 'Date of assessment',
         },
         yaxis={
-            'title': 'Percentage scored',
-            'range': [0, 100]
+            'title': 'Rating',
+            'range': [0, 5]
         }
     )
 
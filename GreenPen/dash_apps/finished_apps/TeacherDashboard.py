@@ -9,7 +9,9 @@ from dash.dependencies import Input, Output
 import dash_bootstrap_components as dbc
 import plotly.graph_objs as go
 from django_plotly_dash import DjangoDash
-from GreenPen.models import Syllabus, Student, Sitting, TeachingGroup, Mistake, Mark, Question, Exam, Resource
+from GreenPen.models import Syllabus, Student, Sitting, TeachingGroup, Mistake, Mark, Question, Exam, Resource, \
+    ratings_pc_by_range, RATING_RANGES, sitting_rating_series
+from GreenPen.dash_apps.callback_cache import cached_callback
 from django.contrib.auth.models import User
 from django.utils.html import mark_safe
 
@@ -103,6 +105,18 @@ def get_students_from_graph(callback, user=User.objects.none(), groups=TeachingG
         raise NotImplementedError('User must be in teacher or studnet group')
 
 
+def student_selected(callback):
+    """
+    True if the graphs have been narrowed down to a single student, either
+    from the student dropdown or by clicking a student on the group chart.
+    """
+    if callback.inputs.get('student-dropdown.value'):
+        return True
+    if callback.inputs.get('group-chart.clickData'):
+        return callback.inputs['group-chart.clickData']['points'][0]['customdata'].startswith('student_')
+    return False
+
+
 def set_sittings(callback, user=User.objects.none()):
     if user.groups.filter(name='Teachers').count():
         sittings = Sitting.objects.all()
@@ -314,6 +328,7 @@ def get_root_pk(callback):
      Input('group-chart', 'clickData'),
      Input('time-chart', 'clickData'),
      ])
+@cached_callback()
 def update_syllabus_sunburst(*args, **kwargs):
     callback = kwargs['callback_context']
     user = kwargs['user']
@@ -328,10 +343,17 @@ def update_syllabus_sunburst(*args, **kwargs):
     points = parent_point.get_descendants(include_self=True)
     labels = [point.text for point in points]
     ids = [point.pk for point in points]
-    parents = [point.parent.text for point in points]
+    texts = {point.pk: point.text for point in points}
+    parents = [texts.get(point.parent_id, "") for point in points]
     parents[0] = ""
     values = [1 for point in points]
-    colors = [point.cohort_stats(students, sittings)['rating'] for point in points]
+    if user.groups.filter(name='Teachers').count() and not student_selected(callback):
+        # Whole groups, so read the pre-calculated group statistics for the subtree:
+        stats = parent_point.group_rollup_stats(get_groups_from_graph(callback, user), sittings)
+        colors = [stats.get(point.pk, {}).get('rating') for point in points]
+    else:
+        stats = Syllabus.objects.cohort_stats_tree(parent_point, students, sittings)
+        colors = [stats.get(point.pk, {}).get('rating') for point in points]
 
     graph = go.Sunburst(
         labels=labels,
@@ -366,6 +388,7 @@ def update_syllabus_sunburst(*args, **kwargs):
      Input('syllabus-graph', 'clickData'),
      Input('group-chart', 'clickData'),
      Input('time-chart', 'clickData')])
+@cached_callback()
 def update_mistake_starburst(*args, **kwargs):
     callback = kwargs['callback_context']
     user = kwargs['user']
@@ -380,7 +403,7 @@ def update_mistake_starburst(*args, **kwargs):
         return False
     parent_point = Syllabus.objects.get(pk=root_pk)
 
-    mistakes = Mistake.objects.all()
+    mistakes = Mistake.objects.select_related('parent')
     sittings = set_sittings(callback, user)
     labels = [mistake.mistake_type for mistake in mistakes]
     ids = [mistake.pk for mistake in mistakes]
@@ -393,7 +416,8 @@ def update_mistake_starburst(*args, **kwargs):
 
     parents[0] = ""
     values = [1 for mistake in mistakes]
-    colors = [mistake.cohort_totals(students, parent_point.get_descendants(), sittings) for mistake in mistakes]
+    totals = Mistake.objects.cohort_totals_tree(students, parent_point.get_descendants(), sittings)
+    colors = [totals[mistake.pk] for mistake in mistakes]
     graph = go.Sunburst(
         labels=labels,
         parents=parents,
@@ -425,6 +449,7 @@ def update_mistake_starburst(*args, **kwargs):
      Input('syllabus-graph', 'clickData'),
      Input('group-chart', 'clickData'),
      Input('time-chart', 'clickData')])
+@cached_callback()
 def update_rating_time_graph(*args, **kwargs):
     callback = kwargs['callback_context']
     user = kwargs['user']
@@ -436,30 +461,15 @@ def update_rating_time_graph(*args, **kwargs):
     parent_point = Syllabus.objects.get(pk=parent_pk)
     groups = get_groups_from_graph(callback, user)
     students = get_students_from_graph(callback, user)
-    records = Sitting.objects.filter(exam__question__syllabus_points__in=parent_point.get_descendants(),
-                                     group__in=groups,
-                                     ).order_by('date').distinct()
-
-    # Debug:
-    records_list=list(records)
-    # text = [sitting.exam.name for sitting in records]
-    # x = [sitting.date for sitting in records]
-    # y = [sitting.avg_syllabus_rating(parent_point) for sitting in records]
-
-    text = []
-    x = []
-    y = []
-    ids = []
-
-    for sitting in records:
-        avg_score = sitting.avg_syllabus_rating(parent_point, students)
-        if avg_score:
-            if avg_score != 'none':
-                string = str(sitting.group.name) + "<br>" + str(sitting.exam.name)
-                text.append(string)
-                x.append(sitting.date)
-                y.append(avg_score)
-                ids.append(sitting.pk)
+    sittings = Sitting.objects.filter(exam__question__syllabus_points__in=parent_point.get_descendants(),
+                                      group__in=groups,
+                                      ).distinct()
+    series = sitting_rating_series(parent_point, sittings, students)
+
+    text = [str(group_name) + "<br>" + str(exam_name) for pk, date, group_name, exam_name, rating in series]
+    x = [date for pk, date, group_name, exam_name, rating in series]
+    y = [rating for pk, date, group_name, exam_name, rating in series]
+    ids = [pk for pk, date, group_name, exam_name, rating in series]
 
     graph = go.Scatter(
         x=x,
@@ -495,6 +505,7 @@ def update_rating_time_graph(*args, **kwargs):
      Input('syllabus-graph', 'clickData'),
      Input('time-chart', 'clickData'),
      Input('group-chart', 'clickData')])
+@cached_callback()
 def update_group_graph(*args, **kwargs):
     """ Update the group performance graph for interractions """
 
@@ -525,46 +536,31 @@ def update_group_graph(*args, **kwargs):
         # Spit out by-student graph
         pass
 
-    y_0_1 = []
-    y_1_2 = []
-    y_2_3 = []
-    y_3_4 = []
-    y_4_5 = []
+    series = [[] for rating_range in RATING_RANGES]
     names = []
     data = []
     customdata = []
 
     # If we only have one group, it's better to output individual students.
     if groups.count() == 1:
-        group = groups[0]
-        for student in students:
-            student_qs = Student.objects.filter(pk=student.pk)
+        ratings = ratings_pc_by_range(groups, 'student', sittings, students, points)
+        for student in students.select_related('user'):
             names.append(student.full_name())
-            y_0_1.append(group.ratings_pc_between_range(0, 1, sittings, student_qs, points))
-            y_1_2.append(group.ratings_pc_between_range(1, 2, sittings, student_qs, points))
-            y_2_3.append(group.ratings_pc_between_range(2, 3, sittings, student_qs, points))
-            y_3_4.append(group.ratings_pc_between_range(3, 4, sittings, student_qs, points))
-            y_4_5.append(group.ratings_pc_between_range(4, 5.1, sittings, student_qs,
-                                                 points))  # Must do this to include 5.0 ratings
+            for i, pc in enumerate(ratings.get(student.pk, [0] * len(RATING_RANGES))):
+                series[i].append(pc)
             customdata.append('student_' + str(student.pk))
 
     else:
+        ratings = ratings_pc_by_range(groups, 'group', sittings, students, points)
         for group in groups:
             names.append(group.name)
-            y_0_1.append(group.ratings_pc_between_range(0, 1, sittings, students, points))
-            y_1_2.append(group.ratings_pc_between_range(1, 2, sittings, students, points))
-            y_2_3.append(group.ratings_pc_between_range(2, 3, sittings, students, points))
-            y_3_4.append(group.ratings_pc_between_range(3, 4, sittings, students, points))
-            y_4_5.append(
-                group.ratings_pc_between_range(4, 5.1, sittings, students, points))  # Must do this to include 5.0 ratings
+            for i, pc in enumerate(ratings.get(group.pk, [0] * len(RATING_RANGES))):
+                series[i].append(pc)
             customdata.append('group_' + str(group.pk))
 
     # Create a bar for each level:
-    data.append(go.Bar(name='0-1', x=names, y=y_0_1, customdata=customdata))
-    data.append(go.Bar(name='1-2', x=names, y=y_1_2, customdata=customdata))
-    data.append(go.Bar(name='2-3', x=names, y=y_2_3, customdata=customdata))
-    data.append(go.Bar(name='3-4', x=names, y=y_3_4, customdata=customdata))
-    data.append(go.Bar(name='4-5', x=names, y=y_4_5, customdata=customdata))
+    for name, y in zip(['0-1', '1-2', '2-3', '3-4', '4-5'], series):
+        data.append(go.Bar(name=name, x=names, y=y, customdata=customdata))
 
     figure = go.Figure(data=data)
     figure.update_layout(barmode='stack')
@@ -699,6 +695,7 @@ def set_default_subject(*args, **kwargs):
      Input('time-chart', 'clickData'),
      Input('mistake-chart', 'clickData')]
     )
+@cached_callback()
 def update_mistakes_table(*args, **kwargs):
     callback = kwargs['callback_context']
     user = kwargs['user']
@@ -767,12 +764,10 @@ def update_resources_table(*args, **kwargs):
     table_header = [
         html.Thead(html.Tr([html.Th("Rating"), html.Th("Name"), html.Th("Resources")]))
     ]
+    stats = Syllabus.objects.cohort_stats_tree(syllabus, students, sittings)
     rows = []
     for point in s_with_rs:
-        try:
-            rating = round(point.cohort_stats(students, sittings)['rating'],1)
-        except TypeError:
-            rating = 0
+        rating = stats.get(point.pk, {}).get('rating') or 0
         rows.append(html.Tr([html.Td(rating),
                              html.Td(point.text),
                              html.Td(html.Div(point.dash_resources(user), className='row'))
@@ -1,8 +1,74 @@
 from GreenPen.models import *
 from GreenPen.settings import CURRENT_ACADEMIC_YEAR
 from django.contrib.auth.models import User, Group
+from django.conf import settings
+from django.db import transaction
 import csv
 
+# Rows handled per batch of queries by the chunked importers below.
+IMPORT_CHUNK_SIZE = 2000
+
+# Students whose ratings are recalculated together at the end of a mark import.
+IMPORT_RATING_BATCH_SIZE = 200
+
+
+class ImportStatus:
+    """
+    Progress of a chunked CSV import. Importers update this rather than printing,
+    so the caller can report it however suits (a message, a log, a job record).
+    Pass a callback to hear about progress after each chunk.
+    """
+
+    def __init__(self, callback=None):
+        self.rows = 0
+        self.created = 0
+        self.updated = 0
+        self.skipped = 0
+        self.errors = []
+        self.finished = False
+        self.callback = callback
+
+    def error(self, row, message):
+        self.errors.append((row, message))
+
+    def report(self):
+        if self.callback:
+            self.callback(self)
+
+    def __str__(self):
+        return "%d rows read: %d created, %d updated, %d skipped, %d errors" % (
+            self.rows, self.created, self.updated, self.skipped, len(self.errors))
+
+
+def read_csv_chunks(path, chunk_size=IMPORT_CHUNK_SIZE):
+    """ Stream the rows of a CSV file (less its header row) in lists of up to chunk_size. """
+    with open(path, newline='') as csvfile:
+        rows = csv.reader(csvfile, delimiter=',', quotechar='"')
+        # Skip headers
+        next(rows, None)
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def recalculate_imported_ratings(pairs):
+    """
+    Recalculate the ratings for imported (student, sitting) pairs, a batch of
+    students at a time, or queue them if DEFER_RATING_UPDATES is set.
+    """
+    by_student = {}
+    for student, sitting in pairs:
+        by_student.setdefault(student, []).append((student, sitting))
+    students = sorted(by_student)
+    for i in range(0, len(students), IMPORT_RATING_BATCH_SIZE):
+        recalculate_assessment_records([pair for student in students[i:i + IMPORT_RATING_BATCH_SIZE]
+                                        for pair in by_student[student]])
+
 
 def import_students_from_csv(path):
     student_list = []
@@ -75,85 +141,207 @@ def import_classgroups_from_csv(path):
         return classgroup_pks
 
 
-def import_syllabus_from_csv(path):
-    with open(path, newline='') as csvfile:
-        points = csv.reader(csvfile, delimiter=',', quotechar='"')
-        # Skip headers
-        next(points, None)
-
-        for row in points:
-            print('Adding ' + row[1])
-            if row[3]:
-                parent = Syllabus.objects.get_or_create(id=row[3])
-            pt, created = Syllabus.objects.get_or_create(id=row[0])
-            pt.text = row[1]
-            pt.identifier = row[2]
-            if row[3]:
-                pt.parent = Syllabus.objects.get_or_create(id=row[3])[0]
-            pt.save()
-
-
-def import_questions_from_csv(path):
-    with open(path, newline='') as csvfile:
-        qs = csv.reader(csvfile, delimiter=',', quotechar='"')
-        # Skip headers
-        next(qs, None)
-
-        for row in qs:
-            print('Adding ' + row[1])
-            exam, created = Exam.objects.get_or_create(id=row[0],
-                                                       defaults={'name': row[1]})
-
-            question, created = Question.objects.get_or_create(id=row[2],
-                                                               defaults={'number': row[3],
-                                                                         'order': row[4],
-                                                                         'max_score': row[6],
-                                                                         'exam': exam})
-
-            question.syllabus_points.add(Syllabus.objects.get_or_create(pk=row[5])[0])
-
-
-def import_sittings_from_csv(path):
-    with open(path, newline='') as csvfile:
-        qs = csv.reader(csvfile, delimiter=',', quotechar='"')
-        # Skip headers
-        next(qs, None)
-
-        for row in qs:
-            print('Adding ' + row[1])
-            exam, created = Exam.objects.get_or_create(pk=row[0])
-            sitting, created = Sitting.objects.get_or_create(pk=row[1],
-                                                             defaults={'date': row[3],
-                                                                       'exam': exam,
-                                                                       'group__pk': row[2]})
+def import_syllabus_from_csv(path, chunk_size=IMPORT_CHUNK_SIZE, status=None):
+    """
+    Import syllabus points from a CSV of pk, text, identifier, parent pk.
+    Tree fields are only worked out once, at the end.
+    """
+    status = status or ImportStatus()
+    with Syllabus.objects.delay_mptt_updates():
+        for chunk in read_csv_chunks(path, chunk_size):
+            status.rows += len(chunk)
+            points = Syllabus.objects.in_bulk({row[0] for row in chunk} | {row[3] for row in chunk if row[3]})
+            points = {str(pk): point for pk, point in points.items()}
+
+            def get_point(pk):
+                if pk not in points:
+                    points[pk] = Syllabus.objects.create(id=pk)
+                    status.created += 1
+                return points[pk]
+
+            for row in chunk:
+                if row[0] in points:
+                    status.updated += 1
+                pt = get_point(row[0])
+                pt.text = row[1]
+                pt.identifier = row[2]
+                if row[3]:
+                    pt.parent = get_point(row[3])
+                pt.save()
+            status.report()
+    # Renaming a point without moving it doesn't need a rebuild, so the labels
+    # may not have been updated by delay_mptt_updates():
+    Syllabus.objects.update_full_identifiers()
+    status.finished = True
+    status.report()
+    return status
+
+
+def import_questions_from_csv(path, chunk_size=IMPORT_CHUNK_SIZE, status=None):
+    """
+    Import questions from a CSV of exam pk, exam name, question pk, number,
+    order, syllabus point pk, max score. Existing exams and questions are left
+    as they are, but still get any new syllabus points.
+    """
+    status = status or ImportStatus()
+    new_question_exams = set()
+    for chunk in read_csv_chunks(path, chunk_size):
+        status.rows += len(chunk)
+        existing_exams = set(Exam.objects.filter(pk__in={row[0] for row in chunk}).values_list('pk', flat=True))
+        existing_points = set(Syllabus.objects.filter(pk__in={row[5] for row in chunk}).values_list('pk', flat=True))
+        existing_questions = set(Question.objects.filter(pk__in={row[2] for row in chunk}).values_list('pk', flat=True))
+
+        new_exams = {}
+        new_questions = {}
+        question_points = []
+        for row in chunk:
+            exam_pk, question_pk, point_pk = int(row[0]), int(row[2]), int(row[5])
+            if exam_pk not in existing_exams:
+                new_exams.setdefault(exam_pk, Exam(pk=exam_pk, name=row[1]))
+            if point_pk not in existing_points:
+                # New syllabus points need their tree fields, so can't be created in bulk.
+                Syllabus.objects.get_or_create(pk=point_pk)
+                existing_points.add(point_pk)
+            if question_pk not in existing_questions:
+                new_questions.setdefault(question_pk, Question(pk=question_pk,
+                                                               number=row[3],
+                                                               order=row[4],
+                                                               max_score=row[6],
+                                                               exam_id=exam_pk))
+            question_points.append(Question.syllabus_points.through(question_id=question_pk, syllabus_id=point_pk))
+
+        with transaction.atomic():
+            Exam.objects.bulk_create(new_exams.values(), batch_size=500, ignore_conflicts=True)
+            Question.objects.bulk_create(new_questions.values(), batch_size=500, ignore_conflicts=True)
+            Question.syllabus_points.through.objects.bulk_create(question_points, batch_size=500,
+                                                                 ignore_conflicts=True)
+        new_question_exams.update(question.exam_id for question in new_questions.values())
+        status.created += len(new_questions)
+        status.skipped += len(chunk) - len(new_questions)
+        status.report()
+
+    # bulk_create skips the post_save signal that gives existing sittings marks
+    # for new questions, so do that for every exam in one go:
+    sync_marks(Sitting.objects.filter(exam__in=new_question_exams))
+    status.finished = True
+    status.report()
+    return status
+
+
+def import_sittings_from_csv(path, chunk_size=IMPORT_CHUNK_SIZE, status=None):
+    """
+    Import sittings from a CSV of exam pk, sitting pk, teaching group pk, date.
+    Existing sittings are updated to match.
+    """
+    status = status or ImportStatus()
+    for chunk in read_csv_chunks(path, chunk_size):
+        status.rows += len(chunk)
+        existing_exams = set(Exam.objects.filter(pk__in={row[0] for row in chunk}).values_list('pk', flat=True))
+        groups = set(TeachingGroup.objects.filter(pk__in={row[2] for row in chunk}).values_list('pk', flat=True))
+        sittings = Sitting.objects.in_bulk({row[1] for row in chunk})
+
+        new_exams = {}
+        new_sittings = {}
+        changed_sittings = {}
+        for row in chunk:
+            exam_pk, sitting_pk, group_pk = int(row[0]), int(row[1]), int(row[2])
+            if group_pk not in groups:
+                status.error(row, 'Teaching group ' + row[2] + ' does not exist.')
+                continue
+            if exam_pk not in existing_exams:
+                new_exams.setdefault(exam_pk, Exam(pk=exam_pk))
+            if sitting_pk in sittings:
+                sitting = sittings[sitting_pk]
+                changed_sittings[sitting_pk] = sitting
+            else:
+                sitting = new_sittings.setdefault(sitting_pk, Sitting(pk=sitting_pk))
             sitting.date = row[3]
-            sitting.exam = exam
-            sitting.group = TeachingGroup.objects.get(pk=row[2])
-            sitting.save()
+            sitting.exam_id = exam_pk
+            sitting.group_id = group_pk
 
+        with transaction.atomic():
+            Exam.objects.bulk_create(new_exams.values(), batch_size=500, ignore_conflicts=True)
+            Sitting.objects.bulk_create(new_sittings.values(), batch_size=500)
+            Sitting.objects.bulk_update(changed_sittings.values(), ['date', 'exam', 'group'], batch_size=500)
+        status.created += len(new_sittings)
+        status.updated += len(changed_sittings)
+        status.report()
+
+    status.finished = True
+    status.report()
+    return status
 
-def import_marks_from_csv(path):
-    with open(path, newline='') as csvfile:
-        qs = csv.reader(csvfile, delimiter=',', quotechar='"')
-        # Skip headers
-        next(qs, None)
 
-        for row in qs:
-            print('Adding ' + str(row))
+def import_marks_from_csv(path, chunk_size=IMPORT_CHUNK_SIZE, status=None):
+    """
+    Import marks from a CSV of question pk, student id (Student.student_id),
+    score, sitting pk, notes. Marks that already have a score are left alone,
+    and rows without a numeric score are skipped.
+
+    Each chunk of rows is matched to its students and existing marks with one
+    query each, and written with one bulk_create that inserts new marks and
+    updates existing ones (an upsert on student, question and sitting). Ratings
+    are recalculated once at the end, rather than for every row.
+    """
+    status = status or ImportStatus()
+    changed = set()
+    imported_questions = set()
+    for chunk in read_csv_chunks(path, chunk_size):
+        status.rows += len(chunk)
+        rows = []
+        for row in chunk:
             try:
-                float(row[2])
-            except ValueError:
+                rows.append((int(row[0]), int(row[1]), float(row[2]), int(row[3]), row[4]))
+            except (ValueError, IndexError):
+                status.skipped += 1
+
+        students = dict(Student.objects.filter(student_id__in={row[1] for row in rows}
+                                               ).values_list('student_id', 'pk'))
+        questions = set(Question.objects.filter(pk__in={row[0] for row in rows}).values_list('pk', flat=True))
+        sittings = set(Sitting.objects.filter(pk__in={row[3] for row in rows}).values_list('pk', flat=True))
+        marks = {(mark.question_id, mark.student_id, mark.sitting_id): mark
+                 for mark in Mark.objects.filter(question__in=questions,
+                                                 student__in=students.values(),
+                                                 sitting__in=sittings)}
+
+        to_create = []
+        to_update = []
+        for question, student_id, score, sitting, notes in rows:
+            if student_id not in students or question not in questions or sitting not in sittings:
+                status.error((question, student_id, score, sitting, notes), 'Unknown student, question or sitting.')
                 continue
-            try:
-                mark, created = Mark.objects.get_or_create(question_id=row[0],
-                                                           student=Student.objects.get(student_id=row[1]),
-                                                           sitting_id=row[3])
-            except:
-                print('Failed above' + str(row))
-            if mark.score is None:
-                mark.score = row[2]
-                mark.student_notes = row[4]
-                mark.save()
+            key = (question, students[student_id], sitting)
+            if key in marks and marks[key].score is not None:
+                status.skipped += 1
+                continue
+            # Existing marks are written as new rows too, and updated by the
+            # upsert below:
+            mark = Mark(question_id=question, student_id=students[student_id], sitting_id=sitting,
+                        score=score, student_notes=notes)
+            (to_update if key in marks else to_create).append(mark)
+            marks[key] = mark
+
+        with transaction.atomic():
+            # Rows created since we looked (e.g. by another import) are
+            # updated rather than dropped:
+            Mark.objects.bulk_create(to_create + to_update, batch_size=500, update_conflicts=True,
+                                     unique_fields=['student', 'question', 'sitting'],
+                                     update_fields=['score', 'student_notes'])
+            if settings.DEFER_RATING_UPDATES:
+                queue_rating_updates(to_create + to_update)
+        changed.update((mark.student_id, mark.sitting_id) for mark in to_create + to_update)
+        imported_questions.update(mark.question_id for mark in to_create + to_update)
+        status.created += len(to_create)
+        status.updated += len(to_update)
+        status.report()
+
+    # Recalculate the ratings once for everything imported:
+    if not settings.DEFER_RATING_UPDATES:
+        recalculate_imported_ratings(changed)
+    bump_question_data_versions(imported_questions)
+    status.finished = True
+    status.report()
+    return status
 
 
 def update_groups(path):
@@ -198,7 +386,50 @@ def update_group_assignments(path):
             teachinggroup.students.add(Student.objects.get(student_id=row[3]))
 
 
-def import_groups_from_sims(path, rollover=False):
+class RosterSyncReport:
+    """
+    What a SIMS roster sync changed (or, for a dry run, would change).
+    `groups` maps each group's SIMS name to the admission numbers of the
+    students added and removed, and how many were already there.
+    """
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.groups = {}
+        self.groups_created = 0
+        self.groups_updated = 0
+        self.users_created = 0
+        self.users_updated = 0
+        self.students_created = 0
+        self.students_updated = 0
+        self.teachers_added = 0
+        self.errors = []
+
+    def added(self):
+        return sum(len(group['added']) for group in self.groups.values())
+
+    def removed(self):
+        return sum(len(group['removed']) for group in self.groups.values())
+
+    def __str__(self):
+        return "%s%d groups (%d new, %d updated): %d students added to groups, %d removed; " \
+               "%d students created, %d updated; %d users created, %d updated; %d errors" % (
+                   'DRY RUN: ' if self.dry_run else '', len(self.groups), self.groups_created,
+                   self.groups_updated, self.added(), self.removed(), self.students_created,
+                   self.students_updated, self.users_created, self.users_updated, len(self.errors))
+
+
+def set_changed(instance, **values):
+    """ Set the values on an instance, returning True if any of them changed. """
+    changed = False
+    for field, value in values.items():
+        if getattr(instance, field) != value:
+            setattr(instance, field, value)
+            changed = True
+    return changed
+
+
+def import_groups_from_sims(path, rollover=False, dry_run=False):
     """
     Take a CSV file from SIMS that includes the class listing for
     all groups, and import the classes, students and teachers from
@@ -227,109 +458,197 @@ def import_groups_from_sims(path, rollover=False):
     in the CSV (i.e. respect name changes etc),
     but WILL NOT UPDATE STAFF (since these are usually made more centrally).
 
-    Also, this script will REMOVE ALL STUDENTS from each teachingroup
-    before re-populating them. This is to keep accurate records as
-    students are moved from one class to another.
-
-    """
-
-    # If this is part of a rollover exercise, add these to the next
-    # academic year in the `year_taught` field.
-    # Otherwise, add them to the current academic year.
-    if rollover:
-        academic_year_legacy = CURRENT_ACADEMIC_YEAR + 1
-    else:
-        academic_year_legacy = CURRENT_ACADEMIC_YEAR
+    Each group's students are set to exactly those listed for it, so students
+    moved from one class to another are taken out of the old one. This is done
+    by comparing the whole CSV with the current memberships and only adding
+    and removing the differences, in bulk. Likewise only users, students and
+    groups whose details have changed are saved.
 
+    Groups always go into the current AcademicYear; `rollover` is kept for
+    existing callers but, as before, makes no difference.
 
+    :param dry_run: work out and report the changes, but don't keep them
+    :return: a RosterSyncReport
+    """
+    report = RosterSyncReport(dry_run)
     with open(path, newline='') as csvfile:
-        students = csv.reader(csvfile, delimiter=',', quotechar='"')
+        rows = csv.reader(csvfile, delimiter=',', quotechar='"')
         # Skip headers
-        next(students, None)
-
-        # Make sure auth groups exist for adding staff/ students
-        teacher_auth_group, created = Group.objects.get_or_create(name='Teachers')
-        student_auth_group, created = Group.objects.get_or_create(name='Students')
-        academic_year = AcademicYear.objects.get(current=True)
-        current_group_name = ''
-        for row in students:
-            if current_group_name != row[0]:
-
-                # Only create a group and update a teacher once
-                current_group_name = row[0]
-                current_group, created = TeachingGroup.objects.get_or_create(sims_name=current_group_name,
-                                                                             archived=False)
-
-                # Set this group to the new academic year
-                current_group.academic_year = academic_year
-                current_group.year_taught = academic_year.order
-
-                # Remove old members:
-                current_group.students.clear()
-                if created:
-                    # We've added a new teaching group, so must set up its details:
-                    current_group.name = row[0] + " " + current_group.academic_year.name
-                    current_group.archived = False
-                # Set the rollover name
-
-                current_group.rollover_name = row[13]
-
-                # Set the group syllabus
-                if row[14]:
-                    current_group.syllabus = Syllabus.objects.get(pk=row[14])
-                current_group.save()
-
-                teacher_user, created = User.objects.get_or_create(email=row[5], defaults={'username': row[5]})
-                if created:
-                    teacher_user.first_name = row[2]
-                    teacher_user.last_name = row[3]
-                    teacher.save()
-                    teacher_auth_group.user_set.add(teacher_user)
-
-                teacher, created = Teacher.objects.get_or_create(user=teacher_user)
-                if created:
-                    teacher.title = row[1]
-                    teacher.staff_code = row[4]
-                current_group.teachers.add(teacher)
-
-
-            # Now we add the students:
-            student_user, created = User.objects.get_or_create(email=row[9],
-                                                               defaults={'username': row[10]})
-
-            # No 'if created' here, as we want to update for next academic year's data:
-            student_user.first_name = row[7]
-            student_user.last_name = row[6]
-            student_user.username = row[10]
-            student_user.save()
-
-            # Sometimes multiple student users have been created. In this instance,
-            # we want to keep the pre-existing one so that we still have the
-            # assessment data etc.
-            try:
-                student, created = Student.objects.get_or_create(student_id=row[10])
-                student.user = student_user
-                student.tutor_group = row[11]
-                student.year_group = row[12]
-                student.student_id = row[10]
-                student.save()
-            except IntegrityError:
-
-                clash_user = User.objects.get(student=student)
-                student.user = clash_user
-                student.user.first_name = row[7]
-                student.user.last_name = row[6]
-                student.user.username = row[10]
-
-                student_user.delete() # No point keeping the added user.
-                student.save()
-                print("WARNING: user clash found between {} and {}".format(clash_user, student_user))
-
-
-            student_auth_group.user_set.add(student.user)
-            current_group.students.add(student)
-
-            print("Added " + str(student) + " to group " + str(current_group_name))
+        next(rows, None)
+        rows = list(rows)
+
+    with transaction.atomic():
+        sync_sims_students(rows, report)
+        sync_sims_groups(rows, report)
+        if dry_run:
+            transaction.set_rollback(True)
+
+    return report
+
+
+def sync_sims_students(rows, report):
+    """ Create or update the users and students listed in a SIMS CSV, in bulk. """
+    student_auth_group, created = Group.objects.get_or_create(name='Students')
+
+    # One row per student; later rows win.
+    listed = {}
+    for row in rows:
+        try:
+            listed[int(row[10])] = row
+        except ValueError:
+            report.errors.append((row, 'Admission number must be a number.'))
+
+    students = {student.student_id: student
+                for student in Student.objects.filter(student_id__in=listed.keys()).select_related('user')}
+    users = {}
+    for user in User.objects.filter(email__in={row[9] for row in listed.values()}).select_related('student'):
+        users.setdefault(user.email, user)
+
+    users_to_update = {}
+    new_users = {}
+    for student_id, row in listed.items():
+        student = students.get(student_id)
+        # Keep a student's existing user, so that they keep their assessment data.
+        if student and student.user:
+            user = student.user
+        else:
+            user = users.get(row[9])
+            if user is not None and hasattr(user, 'student') and user.student.student_id != student_id:
+                report.errors.append((row, 'User ' + row[9] + ' already belongs to another student.'))
+                continue
+        if user is None:
+            new_users[row[9]] = User(email=row[9], username=row[10], first_name=row[7], last_name=row[6])
+        elif set_changed(user, first_name=row[7], last_name=row[6], username=row[10]):
+            users_to_update[user.pk] = user
+
+    User.objects.bulk_create(new_users.values(), batch_size=500)
+    User.objects.bulk_update(users_to_update.values(), ['first_name', 'last_name', 'username'], batch_size=500)
+    report.users_created += len(new_users)
+    report.users_updated += len(users_to_update)
+    # Fetch again, as bulk_create doesn't set pks on every database:
+    for user in User.objects.filter(email__in=new_users.keys()):
+        users[user.email] = user
+
+    new_students = []
+    students_to_update = []
+    for student_id, row in listed.items():
+        student = students.get(student_id)
+        user = student.user if student and student.user else users.get(row[9])
+        if user is None:
+            continue
+        values = {'user_id': user.pk, 'tutor_group': row[11], 'year_group': int(row[12]) if row[12] else None}
+        if student is None:
+            new_students.append(Student(student_id=student_id, **values))
+        elif set_changed(student, **values):
+            students_to_update.append(student)
+
+    Student.objects.bulk_create(new_students, batch_size=500)
+    Student.objects.bulk_update(students_to_update, ['user', 'tutor_group', 'year_group'], batch_size=500)
+    report.students_created += len(new_students)
+    report.students_updated += len(students_to_update)
+
+    user_pks = set(Student.objects.filter(student_id__in=listed.keys(),
+                                          user__isnull=False).values_list('user_id', flat=True))
+    User.groups.through.objects.bulk_create([User.groups.through(user_id=user_pk, group_id=student_auth_group.pk)
+                                             for user_pk in user_pks],
+                                            batch_size=500, ignore_conflicts=True)
+
+
+def sync_sims_groups(rows, report):
+    """
+    Create or update the teaching groups listed in a SIMS CSV and their teachers,
+    then set each group's students to those listed, adding and removing only
+    the differences.
+    """
+    teacher_auth_group, created = Group.objects.get_or_create(name='Teachers')
+    academic_year = AcademicYear.objects.get(current=True)
+
+    # The first row of each group gives its details:
+    group_rows = {}
+    for row in rows:
+        group_rows.setdefault(row[0], row)
+
+    groups = {}
+    for group in TeachingGroup.objects.filter(sims_name__in=group_rows.keys(), archived=False).order_by('pk'):
+        groups.setdefault(group.sims_name, group)
+
+    groups_to_update = []
+    for sims_name, row in group_rows.items():
+        group = groups.get(sims_name)
+        values = {'academic_year_id': academic_year.pk,
+                  'year_taught': academic_year.order,
+                  'rollover_name': row[13]}
+        if row[14]:
+            values['syllabus_id'] = int(row[14])
+        if group is None:
+            # We've added a new teaching group, so must set up its details:
+            groups[sims_name] = TeachingGroup.objects.create(sims_name=sims_name,
+                                                             name=sims_name + " " + academic_year.name,
+                                                             archived=False,
+                                                             **values)
+            report.groups_created += 1
+        elif set_changed(group, **values):
+            groups_to_update.append(group)
+    TeachingGroup.objects.bulk_update(groups_to_update, ['academic_year', 'year_taught', 'rollover_name', 'syllabus'],
+                                      batch_size=500)
+    report.groups_updated += len(groups_to_update)
+
+    # Teachers are only created if they're new; their details are left alone otherwise.
+    teachers = {}
+    for sims_name, row in group_rows.items():
+        if row[5] not in teachers:
+            teacher_user, created = User.objects.get_or_create(email=row[5], defaults={'username': row[5],
+                                                                                     'first_name': row[3],
+                                                                                     'last_name': row[2]})
+            if created:
+                teacher_auth_group.user_set.add(teacher_user)
+            teachers[row[5]], created = Teacher.objects.get_or_create(user=teacher_user,
+                                                                      defaults={'title': row[1],
+                                                                                'staff_code': row[4]})
+    group_teachers = TeachingGroup.teachers.through
+    current_teachers = set(group_teachers.objects.filter(teachinggroup__in=groups.values()
+                                                         ).values_list('teachinggroup_id', 'teacher_id'))
+    new_teachers = {(groups[sims_name].pk, teachers[row[5]].pk) for sims_name, row in group_rows.items()}
+    group_teachers.objects.bulk_create([group_teachers(teachinggroup_id=group, teacher_id=teacher)
+                                        for group, teacher in new_teachers - current_teachers], batch_size=500)
+    report.teachers_added += len(new_teachers - current_teachers)
+
+    # Now the memberships:
+    student_pks = dict(Student.objects.filter(student_id__in={int(row[10]) for row in rows if row[10].isdigit()}
+                                              ).values_list('student_id', 'pk'))
+    wanted = set()
+    for row in rows:
+        if row[10].isdigit() and int(row[10]) in student_pks:
+            wanted.add((groups[row[0]].pk, student_pks[int(row[10])]))
+
+    group_students = TeachingGroup.students.through
+    current = {(group, student): pk for pk, group, student in group_students.objects.filter(
+        teachinggroup__in=groups.values()).values_list('pk', 'teachinggroup_id', 'student_id')}
+    to_add = wanted - current.keys()
+    to_remove = current.keys() - wanted
+
+    admission_numbers = {pk: student_id for student_id, pk in student_pks.items()}
+    admission_numbers.update(Student.objects.filter(pk__in={student for group, student in to_remove}
+                                                    ).values_list('pk', 'student_id'))
+    group_names = {group.pk: sims_name for sims_name, group in groups.items()}
+    for sims_name in groups:
+        report.groups[sims_name] = {'added': [], 'removed': [], 'unchanged': 0}
+    for group, student in to_add:
+        report.groups[group_names[group]]['added'].append(admission_numbers[student])
+    for group, student in to_remove:
+        report.groups[group_names[group]]['removed'].append(admission_numbers[student])
+    for group, student in wanted & current.keys():
+        report.groups[group_names[group]]['unchanged'] += 1
+
+    group_students.objects.bulk_create([group_students(teachinggroup_id=group, student_id=student)
+                                        for group, student in to_add], batch_size=500)
+    group_students.objects.filter(pk__in=[current[membership] for membership in to_remove]).delete()
+
+    # Bulk changes to the through table skip the m2m_changed signal, so rebuild
+    # the rollups of the changed groups here:
+    changed_groups = {group for group, student in to_add | to_remove}
+    if changed_groups:
+        refresh_syllabus_rollups(groups=changed_groups)
 
 
 def import_syllabus_from_csv_new(path):
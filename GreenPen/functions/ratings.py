@@ -0,0 +1,85 @@
+import numpy as np
+
+# Upper bound of each children_x_y bucket, in order.
+BUCKET_LIMITS = [1, 2, 3, 4, 5]
+BUCKET_FIELDS = ['children_0_1', 'children_1_2', 'children_2_3', 'children_3_4', 'children_4_5']
+
+
+def rate_syllabus_tree(lft, rght, mark_nodes, mark_dates, mark_resets, mark_max_scores, mark_scores, date=None):
+    """
+    Roll a student's marks up a syllabus tree in one pass.
+
+    The nodes must be in lft order and make up whole subtrees (e.g. a whole
+    tree, or several trees one after another), so each node's descendants
+    are the nodes that immediately follow it. Totals for a subtree are then
+    the difference of two cumulative sums, with no walking up or down the tree.
+
+    Each mark is one (mark, syllabus point) pair. As in the assessment
+    records, only marks on or before `date` count, and if any of those at a
+    point came from a sitting that resets ratings, only marks from the latest
+    reset onwards count at that point.
+
+    :param lft: MPTT lft of each node
+    :param rght: MPTT rght of each node
+    :param mark_nodes: index into lft / rght of each mark's syllabus point
+    :param mark_dates: sitting date of each mark (datetime.date)
+    :param mark_resets: whether each mark's sitting resets ratings
+    :param mark_max_scores: question max score of each mark (None counts as 0)
+    :param mark_scores: score of each mark (None counts as 0)
+    :param date: optional cut-off date; defaults to every mark
+    :return: dict of arrays, one value per node, keyed by the
+             StudentSyllabusAssessmentRecord field names
+    """
+    lft = np.asarray(lft, dtype=np.int64)
+    rght = np.asarray(rght, dtype=np.int64)
+    total_nodes = len(lft)
+    nodes = np.asarray(mark_nodes, dtype=np.int64)
+    dates = np.asarray(mark_dates, dtype='datetime64[D]').astype(np.int64)
+    resets = np.asarray(mark_resets, dtype=bool)
+    max_scores = np.nan_to_num(np.asarray(mark_max_scores, dtype=float))
+    scores = np.nan_to_num(np.asarray(mark_scores, dtype=float))
+
+    if date is not None:
+        keep = dates <= np.datetime64(date, 'D').astype(np.int64)
+        nodes, dates, resets, max_scores, scores = nodes[keep], dates[keep], resets[keep], max_scores[keep], scores[keep]
+
+    # Drop marks from before the latest reset at their point:
+    last_reset = np.full(total_nodes, np.iinfo(np.int64).min)
+    np.maximum.at(last_reset, nodes[resets], dates[resets])
+    keep = dates >= last_reset[nodes]
+    nodes, max_scores, scores = nodes[keep], max_scores[keep], scores[keep]
+
+    attempted_this_level = np.bincount(nodes, weights=max_scores, minlength=total_nodes)
+    correct_this_level = np.bincount(nodes, weights=scores, minlength=total_nodes)
+
+    # A node's subtree is itself plus the next (size - 1) nodes:
+    ends = np.arange(total_nodes) + (rght - lft + 1) // 2
+
+    def subtree_sums(values):
+        cumulative = np.concatenate([[0], np.cumsum(values)])
+        return cumulative[ends] - cumulative[:total_nodes]
+
+    attempted = subtree_sums(attempted_this_level)
+    correct = subtree_sums(correct_this_level)
+
+    rated = attempted > 0
+    percentage = np.zeros(total_nodes)
+    percentage[rated] = np.round(correct[rated] / attempted[rated] * 100)
+    # Python's round() is used for the rating so that it matches the stored
+    # records exactly (numpy rounds x.x5 differently).
+    rating = np.zeros(total_nodes)
+    rating[rated] = [round(pc * 0.05, 1) for pc in percentage[rated].tolist()]
+
+    results = {'attempted_this_level': attempted_this_level,
+               'correct_this_level': correct_this_level,
+               'attempted_plus_children': attempted,
+               'correct_plus_children': correct,
+               'percentage': percentage,
+               'rating': rating}
+
+    # Count each rated node in its own buckets and those of its ancestors:
+    buckets = np.searchsorted(BUCKET_LIMITS, rating, side='left')
+    for i, field in enumerate(BUCKET_FIELDS):
+        results[field] = subtree_sums(rated & (buckets == i)).astype(np.int64)
+
+    return results
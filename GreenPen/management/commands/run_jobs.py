@@ -0,0 +1,66 @@
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from GreenPen.models import claim_job, requeue_stale_jobs, run_job
+
+
+def run_job_in_worker(job_pk):
+    """ Run a job in a pool process, closing its database connection afterwards. """
+    try:
+        return run_job(job_pk)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Run the background jobs (e.g. Google Quiz imports) waiting in the BackgroundJob queue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2,
+                            help='Most jobs to run at once, each in its own process.')
+        parser.add_argument('--once', action='store_true',
+                            help='Run the jobs that are ready and exit, rather than polling the queue.')
+        parser.add_argument('--interval', type=float, default=2,
+                            help='Seconds to wait between checks of an empty queue.')
+
+    def handle(self, *args, **options):
+        requeued = requeue_stale_jobs()
+        if requeued:
+            self.stdout.write('Queued {} stale jobs again'.format(requeued))
+
+        # Pool processes are started fresh (rather than forked) so that they
+        # don't share this process's database connection.
+        context = multiprocessing.get_context('spawn')
+        running = {}
+        with ProcessPoolExecutor(max_workers=options['processes'], mp_context=context,
+                                 initializer=django.setup) as pool:
+            while True:
+                while len(running) < options['processes']:
+                    job = claim_job()
+                    if job is None:
+                        break
+                    running[pool.submit(run_job_in_worker, job.pk)] = job
+
+                if not running:
+                    if options['once']:
+                        return
+                    time.sleep(options['interval'])
+                    requeue_stale_jobs()
+                    continue
+
+                done, pending = wait(running, timeout=options['interval'], return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    try:
+                        status = future.result()
+                    except Exception as e:
+                        # The pool process itself died; the job will be queued
+                        # again once it times out.
+                        self.stderr.write('Job {} crashed: {!r}'.format(job, e))
+                    else:
+                        self.stdout.write('Job {} {}: {}'.format(job.pk, job.task, status))
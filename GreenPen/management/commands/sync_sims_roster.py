@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from GreenPen.functions.imports import import_groups_from_sims
+
+
+class Command(BaseCommand):
+    help = 'Sync teaching groups, students and teachers from a SIMS class list CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='SIMS class list CSV (see import_groups_from_sims for the columns).')
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Report what would change without saving anything.")
+
+    def handle(self, *args, **options):
+        report = import_groups_from_sims(options['path'], dry_run=options['dry_run'])
+        for sims_name, changes in sorted(report.groups.items()):
+            if changes['added'] or changes['removed']:
+                self.stdout.write('{}: +{} -{} ({} unchanged)'.format(sims_name,
+                                                                      changes['added'],
+                                                                      changes['removed'],
+                                                                      changes['unchanged']))
+        for row, error in report.errors:
+            self.stderr.write('{}: {}'.format(error, row))
+        self.stdout.write(str(report))
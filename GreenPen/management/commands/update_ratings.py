@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from GreenPen.models import flush_rating_updates
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the assessment records waiting in the PendingRatingUpdate queue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Empty the queue once and exit, rather than polling it.')
+        parser.add_argument('--interval', type=float, default=2,
+                            help='Seconds to wait between checks of an empty queue.')
+
+    def handle(self, *args, **options):
+        while True:
+            total = flush_rating_updates()
+            if total:
+                self.stdout.write('Recalculated ratings for {} student sittings'.format(total))
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.8 on 2026-10-18 10:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import mptt.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('GreenPen', '0063_alter_studentsyllabusassessmentrecord_comments'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingRatingUpdate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('sitting', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='GreenPen.sitting')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='GreenPen.student')),
+                ('syllabus_point', mptt.fields.TreeForeignKey(on_delete=django.db.models.deletion.CASCADE, to='GreenPen.syllabus')),
+            ],
+            options={
+                'unique_together': {('student', 'syllabus_point', 'sitting')},
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.8 on 2026-10-18 10:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+import mptt.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('GreenPen', '0064_pendingratingupdate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyllabusGroupRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('records', models.IntegerField(default=0, help_text='number of assessment records averaged')),
+                ('percentage', models.FloatField(blank=True, null=True)),
+                ('rating', models.FloatField(blank=True, null=True)),
+                ('children_0_1', models.IntegerField(default=0)),
+                ('children_1_2', models.IntegerField(default=0)),
+                ('children_2_3', models.IntegerField(default=0)),
+                ('children_3_4', models.IntegerField(default=0)),
+                ('children_4_5', models.IntegerField(default=0)),
+                ('sitting', models.ForeignKey(blank=True, help_text='Blank for the statistics from the most recent records.', null=True, on_delete=django.db.models.deletion.CASCADE, to='GreenPen.sitting')),
+                ('syllabus_point', mptt.fields.TreeForeignKey(on_delete=django.db.models.deletion.CASCADE, to='GreenPen.syllabus')),
+                ('teaching_group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='GreenPen.teachinggroup')),
+            ],
+            options={
+                'unique_together': {('teaching_group', 'sitting', 'syllabus_point')},
+            },
+        ),
+    ]
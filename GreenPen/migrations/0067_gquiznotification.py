@@ -0,0 +1,27 @@
+# Generated by Django 3.2.8 on 2026-10-18 10:55
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('GreenPen', '0066_backgroundjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GQuizNotification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scores_sheet_url', models.URLField()),
+                ('student_email', models.EmailField(max_length=254)),
+                ('timestamp', models.DateTimeField()),
+                ('received', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'unique_together': {('scores_sheet_url', 'student_email')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.8 on 2026-10-18 11:11
+
+from django.db import migrations, models
+
+
+def set_full_identifiers(apps, schema_editor):
+    # We get the model from the versioned app registry;
+    # if we directly import it, it'll be the wrong version
+    Syllabus = apps.get_model("GreenPen", "Syllabus")
+    prefixes = {}
+    points = []
+    for point in Syllabus.objects.order_by('tree_id', 'lft').only('pk', 'identifier', 'level'):
+        prefix = prefixes.get(point.level - 1, '')
+        point.full_identifier = prefix + (point.identifier or '')
+        prefixes[point.level] = prefix + (point.identifier + '.' if point.identifier else '')
+        points.append(point)
+    Syllabus.objects.bulk_update(points, ['full_identifier'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('GreenPen', '0067_gquiznotification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syllabus',
+            name='full_identifier',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(set_full_identifiers, migrations.RunPython.noop),
+    ]
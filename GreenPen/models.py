@@ -1,19 +1,26 @@
 from django.db import models
 from django.utils import timezone
 from django.db.models import Q, Sum, Avg, QuerySet
-from django.db.models.signals import m2m_changed, post_save
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
 from django.contrib.auth.models import User, Group
 from mptt.models import MPTTModel, TreeForeignKey, TreeManyToManyField
 from mptt.querysets import TreeQuerySet
+from mptt.managers import TreeManager
+from mptt.signals import node_moved
 import datetime
+import time
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 from django.db import IntegrityError, transaction
 from django.urls import reverse
+from django.conf import settings
+from django.core.cache import cache
+from django.core import checks
 from GreenPen.settings import CALENDAR_START_DATE, CALENDAR_END_DATE, ACADEMIC_YEARS
 from django.db.models import Max
 from .validators import validate_g_form, validate_g_sheet
 from ckeditor.fields import RichTextField
 from .exceptions import MarkScoreError, AlreadyImportingScoreError
+from GreenPen.functions.ratings import rate_syllabus_tree
 import gspread
 import re
 from django.dispatch import receiver
@@ -23,6 +30,7 @@ import dash_html_components as html
 from django.utils.html import mark_safe
 import dash_bootstrap_components as dbc
 from statistics import mean
+from itertools import accumulate
 from django.utils.timezone import now as dj_now
 
 
@@ -154,6 +162,92 @@ class TeachingGroup(models.Model):
         return round(relevant_records / total * 100, 0)
 
 
+# The rating ranges used by the group performance chart. The top range goes
+# above 5 so that ratings of 5.0 are included.
+RATING_RANGES = [(0, 1), (1, 2), (2, 3), (3, 4), (4, 5.1)]
+
+
+def ratings_pc_by_range(groups=TeachingGroup.objects.none(), by='group', sittings=False, students=False,
+                        syllabus_pts=False):
+    """
+    TeachingGroup.ratings_pc_between_range() for every range in RATING_RANGES at
+    once, for each of the groups or for each student in them. Uses a single query,
+    with the records in each range counted conditionally.
+
+    :param groups: the teaching groups to report on
+    :param by: 'group' for one set of percentages per group, 'student' for one per student
+    :param sittings: optional queryset of sittings to restrict the records to
+    :param students: optional queryset of students to restrict the records to
+    :param syllabus_pts: optional queryset of syllabus points to restrict the records to
+    :return: dict keyed by group (or student) pk of the percentage of records in
+             each rating range, in RATING_RANGES order. Groups / students without
+             any records are left out.
+    """
+    all_records = StudentSyllabusAssessmentRecord.objects.filter(student__teachinggroup__in=groups)
+    if isinstance(sittings, QuerySet):
+        all_records = all_records.filter(sitting__in=sittings)
+    if isinstance(students, QuerySet):
+        all_records = all_records.filter(student__in=students)
+    if isinstance(syllabus_pts, TreeQuerySet):
+        all_records = all_records.filter(syllabus_point__in=syllabus_pts)
+
+    key = 'student__teachinggroup' if by == 'group' else 'student'
+    counts = {'total': models.Count('pk', distinct=True)}
+    for i, (min_rating, max_rating) in enumerate(RATING_RANGES):
+        counts['range_' + str(i)] = models.Count(models.Case(models.When(rating__gte=min_rating,
+                                                                         rating__lt=max_rating,
+                                                                         then='pk')),
+                                                 distinct=True)
+
+    results = {}
+    for data in all_records.values(key).order_by().annotate(**counts):
+        if data['total']:
+            results[data[key]] = [round(data['range_' + str(i)] / data['total'] * 100, 0)
+                                  for i in range(len(RATING_RANGES))]
+    return results
+
+
+def sitting_rating_series(syllabus, sittings, students=False, max_points=None):
+    """
+    The average rating at a syllabus point for each of a set of sittings, in date
+    order, as used by the dashboard time graphs. This replaces calling
+    Sitting.avg_syllabus_rating() for each sitting: the averages, dates, group
+    and exam names all come from a single grouped query.
+
+    :param syllabus: the syllabus point to take the ratings from
+    :param sittings: queryset of sittings to include
+    :param students: optional queryset of students to restrict the ratings to
+    :param max_points: optional maximum length of the series. Longer series (e.g.
+                       a student with hundreds of self-assessments) are split into
+                       max_points runs of consecutive sittings, each reported as the
+                       last sitting of the run with the mean rating over the run.
+    :return: list of (sitting pk, date, group name, exam name, average rating) tuples.
+             Sittings without any ratings at this point are left out.
+    """
+    # The record filters go in a single filter() so that they, and the average,
+    # all use the same join:
+    record_filters = {'studentsyllabusassessmentrecord__syllabus_point': syllabus,
+                      'studentsyllabusassessmentrecord__rating__isnull': False}
+    if isinstance(students, QuerySet):
+        record_filters['studentsyllabusassessmentrecord__student__in'] = students
+    ratings = Sitting.objects.filter(pk__in=sittings.values('pk'), **record_filters)
+    ratings = ratings.select_related('group', 'exam').annotate(
+        avg_rating=Avg('studentsyllabusassessmentrecord__rating')).order_by('date', 'pk')
+
+    series = [(sitting.pk,
+               sitting.date,
+               sitting.group.name if sitting.group else '',
+               sitting.exam.name,
+               sitting.avg_rating) for sitting in ratings]
+
+    if max_points and len(series) > max_points:
+        runs = [series[len(series) * i // max_points:len(series) * (i + 1) // max_points]
+                for i in range(max_points)]
+        series = [run[-1][:4] + (mean(point[4] for point in run),) for run in runs]
+
+    return [point[:4] + (round(point[4], 1),) for point in series]
+
+
 def post_tg_lesson_add(sender, **kwargs):
     """
     This function is tiggered after adding a lesson to a teaching group.
@@ -170,31 +264,159 @@ def post_tg_lesson_add(sender, **kwargs):
 m2m_changed.connect(post_tg_lesson_add, sender=TeachingGroup.lessons.through)
 
 
+class VersionedTreeManager(TreeManager):
+    """
+    A TreeManager that bumps the model's tree version (see tree_version())
+    when trees are rebuilt. Rebuilds rewrite the tree fields without sending
+    any signals, so the tree_changed() receivers don't see them.
+    """
+
+    def rebuild(self, *args, **kwargs):
+        super().rebuild(*args, **kwargs)
+        bump_cache_counter(tree_version_key(self.model))
+
+    def partial_rebuild(self, tree_id, *args, **kwargs):
+        super().partial_rebuild(tree_id, *args, **kwargs)
+        bump_cache_counter(tree_version_key(self.model))
+
+
+def syllabus_full_identifiers(rows):
+    """
+    Work out the full identifier (e.g. "1.2.3") of each syllabus point in one
+    pass over its tree, rather than looking up the ancestors of each point.
+
+    :param rows: (pk, identifier, level) of each point, ordered by tree_id then
+                 lft, making up whole subtrees, so each point's ancestors come
+                 before it
+    :return: dict of full identifiers keyed by pk
+    """
+    # prefixes[level] is the part of the label that points one level further
+    # down get from their ancestors:
+    prefixes = {}
+    full_identifiers = {}
+    for pk, identifier, level in rows:
+        prefix = prefixes.get(level - 1, '')
+        full_identifiers[pk] = prefix + (identifier or '')
+        prefixes[level] = prefix + (identifier + '.' if identifier else '')
+    return full_identifiers
+
+
+class SyllabusManager(VersionedTreeManager):
+    def update_full_identifiers(self, node=None, tree_ids=None):
+        """
+        Bring the stored full_identifier of syllabus points up to date after
+        points have been added, renamed or moved. Only points whose label has
+        changed are written.
+
+        :param node: only update this point and the points below it
+        :param tree_ids: only update these trees. Defaults to every tree.
+        :return: the number of points updated
+        """
+        points = self.get_queryset()
+        if node is not None:
+            points = points.filter(Q(tree_id=node.tree_id, lft__lte=node.lft, rght__gte=node.rght) |
+                                   Q(tree_id=node.tree_id, lft__gt=node.lft, rght__lt=node.rght))
+        elif tree_ids is not None:
+            points = points.filter(tree_id__in=tree_ids)
+        rows = list(points.order_by('tree_id', 'lft').values_list('pk', 'identifier', 'level', 'full_identifier'))
+
+        full_identifiers = syllabus_full_identifiers((pk, identifier, level) for pk, identifier, level, _ in rows)
+        changed = [self.model(pk=pk, full_identifier=full_identifiers[pk])
+                   for pk, _, _, full_identifier in rows if full_identifiers[pk] != full_identifier]
+        self.bulk_update(changed, ['full_identifier'], batch_size=1000)
+        if node is not None:
+            node.full_identifier = full_identifiers.get(node.pk, node.full_identifier)
+        return len(changed)
+
+    def rebuild(self, *args, **kwargs):
+        super().rebuild(*args, **kwargs)
+        self.update_full_identifiers()
+
+    def partial_rebuild(self, tree_id, *args, **kwargs):
+        super().partial_rebuild(tree_id, *args, **kwargs)
+        self.update_full_identifiers(tree_ids=[tree_id])
+
+    def cohort_stats_tree(self, root, students=Student.objects.none(), sittings=False,
+                          include_self_assessment=False):
+        """
+        Syllabus.cohort_stats() for every point in one or more subtrees, worked out
+        in a single query grouped by syllabus point rather than one query per point.
+
+        :param root: the syllabus point at the top of the subtree, or a queryset /
+                     list of points to include the subtrees of each
+        :return: dict of cohort_stats() dicts keyed by syllabus point pk. Points
+                 without any records are left out.
+        """
+        roots = [root] if isinstance(root, self.model) else list(root)
+        if not roots:
+            return {}
+        subtrees = Q()
+        for node in roots:
+            subtrees |= Q(syllabus_point__tree_id=node.tree_id,
+                          syllabus_point__lft__gte=node.lft,
+                          syllabus_point__lft__lt=node.rght)
+
+        records = StudentSyllabusAssessmentRecord.objects.filter(subtrees,
+                                                                 student__in=students,
+                                                                 self_assessment=include_self_assessment)
+        if sittings:
+            records = records.filter(sitting__in=sittings)
+        else:
+            records = records.filter(most_recent=True)
+
+        children = ['children_0_1', 'children_1_2', 'children_2_3', 'children_3_4', 'children_4_5']
+        aggregates = {'avg_percentage': Avg('percentage'),
+                      'avg_rating': Avg('rating')}
+        for field in children:
+            aggregates['total_' + field] = Sum(field)
+
+        stats = {}
+        for data in records.values('syllabus_point').order_by().annotate(**aggregates):
+            point_stats = {'percentage': data['avg_percentage'],
+                           'rating': data['avg_rating']}
+            for field in children:
+                point_stats[field] = data['total_' + field]
+            # Round these values, as cohort_stats does
+            if point_stats['percentage']:
+                point_stats['percentage'] = round(point_stats['percentage'], 1)
+            if point_stats['rating']:
+                point_stats['rating'] = round(point_stats['rating'], 1)
+            stats[data['syllabus_point']] = point_stats
+        return stats
+
+
 class Syllabus(MPTTModel):
     text = models.TextField(blank=False, null=False)
     parent = TreeForeignKey('Syllabus', blank=True, null=True, on_delete=models.CASCADE)
     identifier = models.CharField(max_length=20, blank=True, null=True,
                                   help_text='This would be a sub point number, e.g. if this is 1.1.1 Blah blah, enter 1')
     tier = models.CharField(max_length=20, blank=True, null=True)
+    # The identifiers of this point and its ancestors, e.g. "1.2.3", kept up to
+    # date by save(), moves and rebuilds (see SyllabusManager.update_full_identifiers):
+    full_identifier = models.CharField(max_length=255, blank=True, default='', editable=False, db_index=True)
 
     class Meta:
         ordering = ['identifier']
 
+    objects = SyllabusManager()
+
     class MPTTMeta:
         order_insertion_by = ['identifier']
 
     def __str__(self):
-        string = ''
-        for ancestor in self.get_ancestors():
-            if ancestor.identifier:
-                string = string + ancestor.identifier + "."
-        if self.identifier:
-            string = string + self.identifier
+        string = self.full_identifier if self.pk else (self.identifier or '')
         if string != '':
             string = string + ": "
         string = string + self.text
         return string
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Inside delay_mptt_updates() the tree fields aren't right yet; the
+        # rebuild at the end updates the labels instead.
+        if self._mptt_updates_enabled and not self._mptt_is_tracking:
+            Syllabus.objects.update_full_identifiers(node=self)
+
     def percent_correct(self, students=Student.objects.all()):
         total_attempted = StudentSyllabusAssessmentRecord.objects. \
             filter(student__in=students,
@@ -236,6 +458,80 @@ class Syllabus(MPTTModel):
             data['rating'] = round(data['rating'], 1)
         return data
 
+    def group_rollup_stats(self, groups=TeachingGroup.objects.none(), sittings=False):
+        """
+        cohort_stats() for this point and every point below it, for the students of
+        the given teaching groups, read from SyllabusGroupRollup in one query.
+        Where several groups or sittings are included they are combined weighted by
+        their number of records. If the groups share students, the rollups would
+        count those students once per group, so the statistics are worked out
+        from the records instead (see SyllabusManager.cohort_stats_tree()).
+
+        :return: dict of cohort_stats() dicts keyed by syllabus point pk. Points
+                 without any records are left out.
+        """
+        memberships = TeachingGroup.students.through.objects.filter(teachinggroup__in=groups).aggregate(
+            rows=models.Count('pk'), students=models.Count('student', distinct=True))
+        if memberships['rows'] != memberships['students']:
+            return Syllabus.objects.cohort_stats_tree(self, Student.objects.filter(teachinggroup__in=groups).distinct(),
+                                                      sittings)
+
+        rows = SyllabusGroupRollup.objects.filter(teaching_group__in=groups,
+                                                  syllabus_point__tree_id=self.tree_id,
+                                                  syllabus_point__lft__gte=self.lft,
+                                                  syllabus_point__lft__lt=self.rght)
+        if sittings:
+            rows = rows.filter(sitting__in=sittings)
+        else:
+            rows = rows.filter(sitting__isnull=True)
+
+        totals = {'total_records': Sum('records'),
+                  'total_percentage': Sum(models.F('percentage') * models.F('records')),
+                  'total_rating': Sum(models.F('rating') * models.F('records'))}
+        children = ['children_0_1', 'children_1_2', 'children_2_3', 'children_3_4', 'children_4_5']
+        for field in children:
+            totals['total_' + field] = Sum(field)
+
+        stats = {}
+        for data in rows.values('syllabus_point').order_by().annotate(**totals):
+            if not data['total_records']:
+                continue
+            stats[data['syllabus_point']] = {
+                'percentage': round(data['total_percentage'] / data['total_records'], 1),
+                'rating': round(data['total_rating'] / data['total_records'], 1),
+            }
+            for field in children:
+                stats[data['syllabus_point']][field] = data['total_' + field]
+        return stats
+
+    def student_ratings(self, student, date=None):
+        """
+        Work out a student's totals, percentage, rating and children_x_y counts for
+        this point and every point below it straight from their marks, using
+        rate_syllabus_tree(). These match the student's most recent assessment
+        records (or those as of `date` if given).
+
+        :return: (points, results) - the syllabus points in lft order, and a dict of
+                 arrays in the same order keyed by the assessment record field names.
+        """
+        points = list(self.get_descendants(include_self=True).order_by('lft'))
+        index = {point.pk: i for i, point in enumerate(points)}
+        marks = list(Mark.objects.filter(student=student,
+                                         sitting__isnull=False,
+                                         question__syllabus_points__in=points).
+                     values_list('question__syllabus_points',
+                                 'sitting__date',
+                                 'sitting__resets_ratings',
+                                 'question__max_score',
+                                 'score'))
+        marks = list(zip(*marks)) or [[]] * 5
+        results = rate_syllabus_tree([point.lft for point in points],
+                                     [point.rght for point in points],
+                                     [index[point] for point in marks[0]],
+                                     *marks[1:],
+                                     date=date)
+        return points, results
+
     def resources(self, user=False):
         resources = Resource.objects.filter(syllabus__in=self.get_descendants(include_self=True))
         if user:
@@ -426,11 +722,8 @@ class Question(models.Model):
 
 
 def new_question_created(sender, instance, **kwargs):
-    # Debug:
-    exam = instance.exam
-    sittings = exam.sitting_set.all()
-    for sitting in sittings:
-        sync_marks_with_sittings(sitting)
+    # Only this question can be missing marks, so just sync it across the exam's sittings.
+    sync_exam_marks(instance.exam, questions=[instance])
 
 
 post_save.connect(new_question_created, sender=Question)
@@ -494,11 +787,125 @@ class Sitting(models.Model):
         else:
             return False
 
+    def ratings_up_to_date(self):
+        """
+        False while any rating recalculations for this sitting are still
+        waiting in the PendingRatingUpdate queue.
+        """
+        return not PendingRatingUpdate.objects.filter(sitting=self).exists()
+
     def student_total(self, student=Student.objects.none()):
         marks = Mark.objects.filter(sitting=self,
                                     student=student)
         return marks.aggregate(total=Sum('score'))['total']
 
+    def student_totals(self, students=Student.objects.none()):
+        """ student_total() for each of the students, from one grouped query. Keyed by student pk. """
+        totals = Mark.objects.filter(sitting=self,
+                                     student__in=students).values('student').order_by().annotate(total=Sum('score'))
+        return {data['student']: data['total'] for data in totals}
+
+    def question_average_pcs(self, questions=None):
+        """
+        Question.average_pc() for this sitting's cohort on each question, from one
+        grouped query. Keyed by question pk; questions without scores are None.
+        """
+        if questions is None:
+            questions = self.exam.question_set.all()
+        averages = Mark.objects.filter(sitting=self,
+                                       student__in=self.student_qs(),
+                                       question__in=questions).values('question').order_by().annotate(avg=Avg('score'))
+        averages = {data['question']: data['avg'] for data in averages}
+        pcs = {}
+        for question in questions:
+            avg = averages.get(question.pk)
+            pcs[question.pk] = round(avg / question.max_score * 100, 0) if question.max_score and avg else None
+        return pcs
+
+    def mark_grid(self, students, questions):
+        """
+        This sitting's marks for each student and question, keyed by
+        (student pk, question pk), from a single query. Any missing marks are
+        created together with one bulk_create.
+        """
+        def fetch():
+            marks = Mark.objects.filter(sitting=self,
+                                        student__in=[student.pk for student in students],
+                                        question__in=[question.pk for question in questions]
+                                        ).select_related('question')
+            return {(mark.student_id, mark.question_id): mark for mark in marks}
+
+        grid = fetch()
+        missing = [Mark(sitting=self, student=student, question=question)
+                   for student in students for question in questions
+                   if (student.pk, question.pk) not in grid]
+        if missing:
+            # Blank marks don't affect any ratings, so they don't need Mark.save().
+            # ignore_conflicts covers marks created since we looked; as it means the
+            # new pks aren't returned, fetch the grid again.
+            Mark.objects.bulk_create(missing, batch_size=500, ignore_conflicts=True)
+            grid = fetch()
+        return grid
+
+    def save_scores(self, scores):
+        """
+        Save a whole grid of scores for this sitting at once, e.g. a class set
+        entered as a spreadsheet.
+
+        Every score is checked against its question's max_score before anything
+        is written. If they are all valid, the changed marks are written with one
+        bulk_update in a single transaction, and the ratings are recalculated (or
+        queued, with DEFER_RATING_UPDATES) once for the lot.
+
+        :param scores: iterable of (student pk, question pk, score) triples. A
+                       score of None or '' clears the mark.
+        :return: (number of marks changed, list of errors). Nothing is saved if
+                 there are any errors.
+        """
+        scores = list(scores)
+        students = self.student_qs().filter(pk__in={student for student, question, score in scores})
+        questions = self.exam.question_set.filter(pk__in={question for student, question, score in scores})
+        grid = self.mark_grid(list(students), list(questions))
+
+        changed = []
+        errors = []
+        for student, question, score in scores:
+            mark = grid.get((int(student), int(question)))
+            if mark is None:
+                errors.append({'student': student, 'question': question,
+                               'error': 'No such student or question in this sitting.'})
+                continue
+            if score is None or score == '':
+                score = None
+            else:
+                try:
+                    score = float(score)
+                except (TypeError, ValueError):
+                    errors.append({'student': student, 'question': question, 'error': 'Score must be a number.'})
+                    continue
+                if score < 0:
+                    errors.append({'student': student, 'question': question, 'error': 'Score cannot be negative.'})
+                    continue
+                if mark.question.max_score is not None and score > mark.question.max_score:
+                    errors.append({'student': student, 'question': question,
+                                   'error': 'Score is higher than max for that question!'})
+                    continue
+            if mark.score != score:
+                mark.score = score
+                changed.append(mark)
+
+        if errors or not changed:
+            return 0, errors
+
+        with transaction.atomic():
+            Mark.objects.bulk_update(changed, ['score'], batch_size=500)
+            if settings.DEFER_RATING_UPDATES:
+                queue_rating_updates(changed)
+            else:
+                recalculate_assessment_records({(mark.student_id, mark.sitting_id) for mark in changed})
+        bump_question_data_versions({mark.question_id for mark in changed})
+        return len(changed), errors
+
     def student_qs(self):
         if self.students.count():
             return self.students.all()
@@ -530,26 +937,104 @@ class Sitting(models.Model):
             return group
 
 
-def student_added_to_sitting(sender, instance, action, **kwargs):
+def student_added_to_sitting(sender, instance, action, reverse, pk_set, **kwargs):
     if action == 'post_add':
-        sync_marks_with_sittings(instance)
+        if not reverse:
+            sync_marks([instance], students=pk_set)
+        else:
+            sync_marks(pk_set, students=[instance])
+
+
+def sync_marks(sittings, students=None, questions=None):
+    """
+    Make sure each student in each of the sittings has a mark for every
+    question on the exam, creating the missing ones as blanks.
+
+    Works out which (student, question, sitting) marks are missing from one
+    query of the existing marks, and creates them all with one bulk_create,
+    rather than a get_or_create for every student and question.
+
+    :param sittings: sittings (or pks) to sync
+    :param students: optional students (or pks) to sync; defaults to each sitting's students
+    :param questions: optional questions (or pks) to sync; defaults to all those on each exam
+    """
+    if not isinstance(sittings, QuerySet):
+        sittings = Sitting.objects.filter(pk__in=[getattr(sitting, 'pk', sitting) for sitting in sittings])
+    sitting_exams = dict(sittings.values_list('pk', 'exam_id'))
+    if not sitting_exams:
+        return
+
+    exam_questions = Question.objects.filter(exam__in=set(sitting_exams.values()))
+    if questions is not None:
+        exam_questions = exam_questions.filter(pk__in=[getattr(question, 'pk', question) for question in questions])
+    questions_by_exam = {}
+    for exam_id, question_id in exam_questions.values_list('exam_id', 'pk'):
+        questions_by_exam.setdefault(exam_id, []).append(question_id)
+
+    if students is not None:
+        student_pks = [getattr(student, 'pk', student) for student in students]
+        sitting_students = [(sitting_id, student_id) for sitting_id in sitting_exams for student_id in student_pks]
+    else:
+        sitting_students = Sitting.students.through.objects.filter(sitting__in=sitting_exams.keys()
+                                                                   ).values_list('sitting_id', 'student_id')
+
+    existing = set(Mark.objects.filter(sitting__in=sitting_exams.keys()
+                                       ).values_list('student_id', 'question_id', 'sitting_id'))
+    missing = [Mark(student_id=student_id, question_id=question_id, sitting_id=sitting_id)
+               for sitting_id, student_id in sitting_students
+               for question_id in questions_by_exam.get(sitting_exams[sitting_id], [])
+               if (student_id, question_id, sitting_id) not in existing]
+    # Blank marks don't change any ratings, so they don't need Mark.save().
+    Mark.objects.bulk_create(missing, batch_size=500, ignore_conflicts=True)
 
 
 def sync_marks_with_sittings(sitting):
-    for student in sitting.students.all():
-        for question in sitting.exam.question_set.all():
-            Mark.objects.get_or_create(student=student,
-                                       question=question,
-                                       sitting=sitting)
+    sync_marks([sitting])
+
+
+def sync_exam_marks(exam, questions=None):
+    """ sync_marks() for every sitting of an exam at once. """
+    sync_marks(exam.sitting_set.all(), questions=questions)
 
 
 m2m_changed.connect(student_added_to_sitting, sender=Sitting.students.through)
 
 
+class MistakeManager(VersionedTreeManager):
+    def cohort_totals_tree(self, cohort=Student.objects.all(), syllabus=Syllabus.objects.all(),
+                           sittings=Sitting.objects.all(), include_descendants=False):
+        """
+        Mistake.cohort_totals() for every mistake at once, from a single query
+        grouped by mistake rather than one count per mistake.
+
+        :param include_descendants: also add each mistake's descendants' totals
+                                    to its own, using the MPTT ranges
+        :return: dict of totals keyed by mistake pk, including mistakes with none
+        """
+        counts = Mark.objects.filter(mistakes__isnull=False,
+                                     student__in=cohort,
+                                     sitting__in=sittings,
+                                     question__syllabus_points__in=syllabus
+                                     ).values('mistakes').order_by().annotate(total=models.Count('pk'))
+        counts = {data['mistakes']: data['total'] for data in counts}
+
+        mistakes = list(self.order_by('tree_id', 'lft').values_list('pk', 'lft', 'rght'))
+        totals = [counts.get(pk, 0) for pk, lft, rght in mistakes]
+        if include_descendants:
+            # A mistake's descendants are the (rght - lft - 1) / 2 mistakes after it,
+            # so each subtree total is the difference of two running totals:
+            running = [0] + list(accumulate(totals))
+            totals = [running[i + (rght - lft + 1) // 2] - running[i]
+                      for i, (pk, lft, rght) in enumerate(mistakes)]
+        return {pk: total for (pk, lft, rght), total in zip(mistakes, totals)}
+
+
 class Mistake(MPTTModel):
     mistake_type = models.CharField(blank=False, null=False, max_length=256)
     parent = TreeForeignKey('Mistake', blank=True, null=True, on_delete=models.CASCADE)
 
+    objects = MistakeManager()
+
     def __str__(self):
         return self.mistake_type
 
@@ -572,10 +1057,16 @@ class Mark(models.Model):
     class Meta:
         unique_together = ['student', 'question', 'sitting']
 
-    def save(self, *args, **kwargs):
+    def save(self, *args, bypass_ratings=False, **kwargs):
         super(Mark, self).save(*args, **kwargs)
-        if self.score is not None:
-            self.set_student_syllabus_assessment_records()
+        # Bulk imports save with bypass_ratings and recalculate once at the end.
+        if not bypass_ratings:
+            bump_question_data_versions([self.question_id])
+        if self.score is not None and not bypass_ratings:
+            if settings.DEFER_RATING_UPDATES:
+                queue_rating_updates([self])
+            else:
+                self.set_student_syllabus_assessment_records()
 
     def pc(self):
         if self.question.max_score and self.score:
@@ -601,23 +1092,7 @@ class Mark(models.Model):
             return "secondary"
 
     def set_student_syllabus_assessment_records(self):
-        for point in self.question.syllabus_points.all():
-            record, created = StudentSyllabusAssessmentRecord.objects.get_or_create(student=self.student,
-                                                                                    syllabus_point=point,
-                                                                                    sitting=self.sitting)
-            # Here be dragons! When we create a record, logic in the background then sets
-            # it to the most recent. HOWEVER, we've loaded this into memory, so the instance
-            # that gets sent to set_assessment_record_chain is the OLD one, without
-            # the correct 'most recent' flag.
-            record.refresh_from_db()
-            set_assessment_record_chain(record)
-            # If the record chain was not the most recent, we also need to re-set
-            # the records that came after it:
-            if not record.most_recent:
-                for newerrec in StudentSyllabusAssessmentRecord.objects.filter(student=self.student,
-                                                                               syllabus_point=point,
-                                                                               sitting__date__gte=record.sitting.date):
-                    set_assessment_record_chain(newerrec)
+        recalculate_assessment_records([(self.student_id, self.sitting_id)])
 
     def get_absolute_url(self):
         return reverse('edit-mark', kwargs={'pk': self.pk})
@@ -993,100 +1468,492 @@ def syllabus_record_created(sender, instance, created, **kwargs):
         return instance, newer_reset_reqd
 
 
-def set_assessment_record_chain(record=StudentSyllabusAssessmentRecord.objects.none()):
-    """ This is used to set an assessment record for a given sitting for a student. Note that this shouldn't be
-    used for all sittings, as we'd end up with lots of identical scores."""
-
-    # Hold old values in memory to use to re-set parents:
-    # We need to check if there was a previous value from a different sitting. However,
-    # we also need to be aware that the previous record may be from this same sitting, so
-    # need to test if we're the only one:
-
-    # Be careful here; if we're working with a chain that occured BEFORE another assessment
-    # (e.g. a student forgot to add an assessment score and has just put it in)
-    # then the retrieval of the preivious one could fail.
-    total_records = StudentSyllabusAssessmentRecord.objects.filter(student=record.student,
-                                                                   syllabus_point=record.syllabus_point,
-                                                                   ).count()
-    if StudentSyllabusAssessmentRecord.objects.filter(student=record.student,
-                                                      syllabus_point=record.syllabus_point).count() <= 1:
-        old_attempted_plus_children = record.attempted_plus_children
-        old_correct_plus_children = record.correct_plus_children
+ASSESSMENT_RECORD_CALCULATED_FIELDS = ['attempted_this_level',
+                                       'correct_this_level',
+                                       'attempted_plus_children',
+                                       'correct_plus_children',
+                                       'percentage',
+                                       'rating',
+                                       'children_0_1',
+                                       'children_1_2',
+                                       'children_2_3',
+                                       'children_3_4',
+                                       'children_4_5']
+
+
+def recalculate_assessment_records(pairs):
+    """
+    Recalculate the exam-assessed StudentSyllabusAssessmentRecords affected by
+    a set of (student, sitting) pairs. Students and sittings may be given as
+    objects or pks.
+
+    Every record for the student on or after the earliest affected sitting is
+    recalculated, since later records include the earlier marks. Records are
+    created for each syllabus point scored in a sitting and all of its
+    ancestors.
+
+    The marks, tree and existing records are loaded in a handful of grouped
+    queries, the totals worked out by rate_syllabus_tree() and the results
+    written back with one bulk_create and bulk_update, rather than the chain
+    of get_or_create / aggregate calls per point. Only records whose values
+    have changed are written.
+
+    :param pairs: iterable of (student, sitting)
+    :return: the number of records created or updated
+    """
+    pairs = {(getattr(student, 'pk', student), getattr(sitting, 'pk', sitting)) for student, sitting in pairs}
+    pairs = {(student, sitting) for student, sitting in pairs if student is not None and sitting is not None}
+    if not pairs:
+        return 0
+
+    # Each student only needs recalculating from their earliest changed sitting onwards:
+    sitting_dates = dict(Sitting.objects.filter(pk__in={sitting for student, sitting in pairs}).
+                         values_list('pk', 'date'))
+    earliest = {}
+    for student, sitting in pairs:
+        date = sitting_dates.get(sitting)
+        if date is not None and (student not in earliest or date < earliest[student]):
+            earliest[student] = date
+    if not earliest:
+        return 0
+
+    # 1. Load every mark these students have against a syllabus point (one row per mark and point).
+    marks = {}  # student -> [(point, date, resets, max_score, score)]
+    scored_points = {}  # (student, sitting) -> set of points with a score in that sitting
+    for student, sitting, point, date, resets, max_score, score in Mark.objects.filter(
+            student__in=earliest,
+            sitting__isnull=False,
+            question__syllabus_points__isnull=False).values_list('student_id',
+                                                                 'sitting_id',
+                                                                 'question__syllabus_points',
+                                                                 'sitting__date',
+                                                                 'sitting__resets_ratings',
+                                                                 'question__max_score',
+                                                                 'score'):
+        marks.setdefault(student, []).append((point, date, resets, max_score, score))
+        sitting_dates[sitting] = date
+        if score is not None:
+            scored_points.setdefault((student, sitting), set()).add(point)
+
+    # 2. Load the existing records. All types are needed to set the order field.
+    records = list(StudentSyllabusAssessmentRecord.objects.filter(student__in=earliest).
+                   annotate(sitting_date=models.F('sitting__date')))
+    existing = {}
+    history = {}  # (student, point) -> [records]
+    for record in records:
+        history.setdefault((record.student_id, record.syllabus_point_id), []).append(record)
+        if record.sitting_id:
+            existing[(record.student_id, record.sitting_id, record.syllabus_point_id)] = record
+            sitting_dates[record.sitting_id] = record.sitting_date
+
+    # 3. Load the shape of every tree those marks and records belong to, in lft order:
+    tree_points = {mark[0] for student_marks in marks.values() for mark in student_marks}
+    tree_points.update(point for student, sitting, point in existing)
+    tree = list(Syllabus.objects.filter(tree_id__in=Syllabus.objects.filter(pk__in=tree_points).values('tree_id')).
+                order_by('tree_id', 'lft').values_list('pk', 'parent_id', 'lft', 'rght'))
+    index = {pk: i for i, (pk, parent, lft, rght) in enumerate(tree)}
+    parents = {pk: parent for pk, parent, lft, rght in tree}
+    chains = {}
+
+    def chain(point):
+        # The point followed by all of its ancestors.
+        if point not in chains:
+            parent = parents.get(point)
+            chains[point] = [point] + (chain(parent) if parent else [])
+        return chains[point]
+
+    # 4. Work out which records need calculating:
+    targets = {}  # (student, sitting) -> set of points
+    for (student, sitting), points in scored_points.items():
+        if sitting_dates[sitting] >= earliest[student]:
+            for point in points:
+                targets.setdefault((student, sitting), set()).update(chain(point))
+    for (student, sitting, point), record in existing.items():
+        if record.exam_assessment and sitting_dates[sitting] >= earliest[student]:
+            targets.setdefault((student, sitting), set()).add(point)
+
+    # 5. Calculate the totals as they stood on each sitting date:
+    calculated = {}  # (student, date) -> {field: array}
+    lft = [node[2] for node in tree]
+    rght = [node[3] for node in tree]
+    for student, sitting in targets:
+        date = sitting_dates[sitting]
+        if (student, date) not in calculated:
+            student_marks = list(zip(*marks.get(student, []))) or [[]] * 5
+            calculated[(student, date)] = rate_syllabus_tree(lft, rght,
+                                                             [index[point] for point in student_marks[0]],
+                                                             *student_marks[1:],
+                                                             date=date)
+
+    # 6. Compare against what is stored:
+    to_create = []
+    to_update = {}
+    for (student, sitting), points in targets.items():
+        date = sitting_dates[sitting]
+        for point in points:
+            results = calculated[(student, date)]
+            values = {field: results[field][index[point]].item() for field in ASSESSMENT_RECORD_CALCULATED_FIELDS}
+            record = existing.get((student, sitting, point))
+            if record is None:
+                record = StudentSyllabusAssessmentRecord(student_id=student,
+                                                         sitting_id=sitting,
+                                                         syllabus_point_id=point,
+                                                         created=datetime.datetime.combine(date, datetime.time()),
+                                                         exam_assessment=True,
+                                                         **values)
+                to_create.append(record)
+                history.setdefault((student, point), []).append(record)
+            elif record.exam_assessment:
+                if any(getattr(record, field) != value for field, value in values.items()):
+                    for field, value in values.items():
+                        setattr(record, field, value)
+                    to_update[record.pk] = record
+
+    # 7. New records need slotting into the order, and may be the new most recent:
+    reordered = []
+    for key in {(record.student_id, record.syllabus_point_id) for record in to_create}:
+        ordered = sorted(history[key], key=lambda r: (r.created, r.pk is None, r.order))
+        exam_records = [r for r in ordered if r.exam_assessment]
+        for i, record in enumerate(ordered):
+            most_recent = record is exam_records[-1] if record.exam_assessment else record.most_recent
+            if record.pk is None:
+                record.order = i + 1
+                record.most_recent = most_recent
+            elif record.order != i + 1 or record.most_recent != most_recent:
+                reordered.append(record)
+                record.order = i + 1
+                record.most_recent = most_recent
+                to_update[record.pk] = record
+
+    with transaction.atomic():
+        # Move re-ordered records out of the way first so that the (student, point, order)
+        # constraint can't clash part way through:
+        final_orders = {record.pk: record.order for record in reordered}
+        for record in reordered:
+            record.order = -record.pk
+        StudentSyllabusAssessmentRecord.objects.bulk_update(reordered, ['order'], batch_size=500)
+        for record in reordered:
+            record.order = final_orders[record.pk]
+
+        StudentSyllabusAssessmentRecord.objects.bulk_create(to_create, batch_size=500)
+        StudentSyllabusAssessmentRecord.objects.bulk_update(list(to_update.values()),
+                                                            ASSESSMENT_RECORD_CALCULATED_FIELDS +
+                                                            ['order', 'most_recent'],
+                                                            batch_size=500)
+
+        if to_create or to_update:
+            changed = to_create + list(to_update.values())
+            refresh_syllabus_rollups(students={record.student_id for record in changed},
+                                     points={record.syllabus_point_id for record in changed},
+                                     sittings={record.sitting_id for record in changed})
+
+    if to_create or to_update:
+        bump_data_versions(Syllabus.objects.filter(pk__in={record.syllabus_point_id for record in changed}
+                                                   ).values_list('tree_id', flat=True).distinct())
+
+    return len(to_create) + len(to_update)
+
+
+class PendingRatingUpdate(models.Model):
+    """
+    A student's syllabus point in a sitting whose assessment records need
+    recalculating. When DEFER_RATING_UPDATES is set, saving a mark only adds
+    one of these; they are worked through in batches by flush_rating_updates()
+    (run continuously by `manage.py update_ratings`).
+    """
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, blank=False, null=False)
+    syllabus_point = TreeForeignKey(Syllabus, on_delete=models.CASCADE, blank=False, null=False)
+    sitting = models.ForeignKey(Sitting, on_delete=models.CASCADE, blank=False, null=False)
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ['student', 'syllabus_point', 'sitting']
+
+    def __str__(self):
+        return str(self.student) + " " + str(self.syllabus_point) + " (" + str(self.sitting_id) + ")"
+
+
+def queue_rating_updates(marks):
+    """
+    Add the student, syllabus points and sitting of each mark to the
+    PendingRatingUpdate queue. Entries already waiting are left as they are,
+    so repeated saves of the same mark only queue one recalculation.
+    """
+    marks = [mark for mark in marks if mark.sitting_id is not None]
+    points = {}
+    for question, point in Question.syllabus_points.through.objects.filter(
+            question_id__in={mark.question_id for mark in marks}).values_list('question_id', 'syllabus_id'):
+        points.setdefault(question, []).append(point)
+
+    PendingRatingUpdate.objects.bulk_create([PendingRatingUpdate(student_id=mark.student_id,
+                                                                 syllabus_point_id=point,
+                                                                 sitting_id=mark.sitting_id)
+                                             for mark in marks
+                                             for point in points.get(mark.question_id, [])],
+                                            ignore_conflicts=True)
+
+
+def flush_rating_updates(sittings=None, batch_size=500):
+    """
+    Recalculate the records for everything waiting in the PendingRatingUpdate
+    queue. Entries are de-duplicated down to (student, sitting) pairs and
+    handed to recalculate_assessment_records() a batch at a time.
+
+    :param sittings: optional queryset or list to only process those sittings
+    :param batch_size: number of queue entries taken per batch
+    :return: the number of (student, sitting) pairs recalculated
+    """
+    total = 0
+    while True:
+        with transaction.atomic():
+            pending = PendingRatingUpdate.objects.select_for_update(skip_locked=True).order_by('created')
+            if sittings is not None:
+                pending = pending.filter(sitting__in=sittings)
+            entries = list(pending.values_list('pk', 'student_id', 'sitting_id')[:batch_size])
+            if not entries:
+                return total
+            PendingRatingUpdate.objects.filter(pk__in=[pk for pk, student, sitting in entries]).delete()
+            # If the recalculation fails the entries are rolled back into the queue.
+            pairs = {(student, sitting) for pk, student, sitting in entries}
+            recalculate_assessment_records(pairs)
+        total += len(pairs)
+
+
+class SyllabusGroupRollup(models.Model):
+    """
+    The cohort_stats() of a teaching group at one syllabus point, either for one
+    sitting or, where sitting is blank, from each student's most recent record.
+    Only exam / teacher assessed records are included (as cohort_stats does by default).
+
+    These are kept up to date by refresh_syllabus_rollups() whenever assessment
+    records are recalculated or group membership changes, so the dashboards can
+    read a whole subtree in one query (see Syllabus.group_rollup_stats()).
+    """
+    syllabus_point = TreeForeignKey(Syllabus, on_delete=models.CASCADE, blank=False, null=False)
+    teaching_group = models.ForeignKey(TeachingGroup, on_delete=models.CASCADE, blank=False, null=False)
+    sitting = models.ForeignKey(Sitting, on_delete=models.CASCADE, blank=True, null=True,
+                                help_text='Blank for the statistics from the most recent records.')
+    records = models.IntegerField(default=0, help_text='number of assessment records averaged')
+    percentage = models.FloatField(blank=True, null=True)
+    rating = models.FloatField(blank=True, null=True)
+    children_0_1 = models.IntegerField(default=0)
+    children_1_2 = models.IntegerField(default=0)
+    children_2_3 = models.IntegerField(default=0)
+    children_3_4 = models.IntegerField(default=0)
+    children_4_5 = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ['teaching_group', 'sitting', 'syllabus_point']
+
+
+def refresh_syllabus_rollups(students=None, groups=None, points=None, sittings=None):
+    """
+    Rebuild SyllabusGroupRollup rows from the assessment records. Each argument
+    narrows what is rebuilt; with none, every row is rebuilt.
+
+    :param students: rebuild the groups these students belong to
+    :param groups: rebuild these teaching groups (instead of the students' groups)
+    :param points: only rebuild these syllabus points
+    :param sittings: only rebuild the rows for these sittings (the most recent rows
+                     for the points are always rebuilt)
+    """
+    if groups is None and students is not None:
+        groups = list(TeachingGroup.objects.filter(students__in=students).values_list('pk', flat=True).distinct())
+
+    records = StudentSyllabusAssessmentRecord.objects.filter(self_assessment=False)
+    rows = SyllabusGroupRollup.objects.all()
+    if groups is not None:
+        records = records.filter(student__teachinggroup__in=groups)
+        rows = rows.filter(teaching_group__in=groups)
     else:
+        records = records.filter(student__teachinggroup__isnull=False)
+    if points is not None:
+        records = records.filter(syllabus_point__in=points)
+        rows = rows.filter(syllabus_point__in=points)
+    sitting_records = records.filter(sitting__isnull=False)
+    if sittings is not None:
+        sitting_records = sitting_records.filter(sitting__in=sittings)
+        rows = rows.filter(Q(sitting__isnull=True) | Q(sitting__in=sittings))
+
+    stats = {'records_count': models.Count('pk'),
+             'avg_percentage': Avg('percentage'),
+             'avg_rating': Avg('rating')}
+    for field in ASSESSMENT_RECORD_CALCULATED_FIELDS[6:]:
+        stats[field + '_sum'] = Sum(field)
+
+    new_rows = []
+    for data in list(sitting_records.values('student__teachinggroup', 'syllabus_point', 'sitting').
+                     order_by().annotate(**stats)) + \
+            list(records.filter(most_recent=True).values('student__teachinggroup', 'syllabus_point').
+                 order_by().annotate(**stats)):
+        row = SyllabusGroupRollup(teaching_group_id=data['student__teachinggroup'],
+                                  syllabus_point_id=data['syllabus_point'],
+                                  sitting_id=data.get('sitting'),
+                                  records=data['records_count'],
+                                  percentage=data['avg_percentage'],
+                                  rating=data['avg_rating'])
+        for field in ASSESSMENT_RECORD_CALCULATED_FIELDS[6:]:
+            setattr(row, field, data[field + '_sum'])
+        new_rows.append(row)
+
+    with transaction.atomic():
+        rows.delete()
+        SyllabusGroupRollup.objects.bulk_create(new_rows, batch_size=500)
+
+
+def group_students_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """ Rebuild the rollups of any teaching group whose students change. """
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if not reverse:
+        refresh_syllabus_rollups(groups=[instance.pk])
+    elif pk_set:
+        refresh_syllabus_rollups(groups=pk_set)
+    else:
+        # A student's groups were cleared, so we no longer know which groups they were in:
+        refresh_syllabus_rollups()
+
+
+m2m_changed.connect(group_students_changed, sender=TeachingGroup.students.through)
+
+
+def sitting_deleting(sender, instance, **kwargs):
+    """
+    Note whose records a sitting being deleted has, and delete them now: the
+    order Django deletes related rows in isn't fixed, and they must be gone
+    before sitting_deleted() rebuilds the rollups.
+    """
+    records = StudentSyllabusAssessmentRecord.objects.filter(sitting=instance)
+    instance.deleted_record_students = set(records.values_list('student_id', flat=True))
+    instance.deleted_record_points = set(records.values_list('syllabus_point_id', flat=True))
+    records.delete()
+
+
+def sitting_deleted(sender, instance, **kwargs):
+    """
+    Rebuild the rollups that counted a deleted sitting's records. The sitting's
+    own rollup rows are deleted with it, but the most recent rows would still
+    include its records.
+    """
+    students = getattr(instance, 'deleted_record_students', None)
+    if students:
+        refresh_syllabus_rollups(students=students, points=instance.deleted_record_points)
+
+
+pre_delete.connect(sitting_deleting, sender=Sitting)
+post_delete.connect(sitting_deleted, sender=Sitting)
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """ Warn when rating updates run in another process but the cache isn't shared with it. """
+    if settings.DEFER_RATING_UPDATES and not settings.SHARED_CACHE:
+        return [checks.Warning(
+            "DJANGO_DEFER_RATING_UPDATES is on, but the cache isn't shared between processes.",
+            hint="Set DJANGO_REDIS_CACHE_URL, or the dashboards won't see ratings recalculated by update_ratings "
+                 "until their cached responses expire.",
+            id='GreenPen.W001')]
+    return []
+
+
+def cache_counter(key):
+    """ The value of a counter kept in the cache, used to version cached data. """
+    # Start new counters from the time, so a counter that is evicted can't
+    # come back at a value that has already been used.
+    cache.add(key, int(time.time() * 1000), timeout=None)
+    return cache.get(key)
+
+
+def bump_cache_counter(key):
+    if not cache.add(key, int(time.time() * 1000), timeout=None):
         try:
-            previous_record = StudentSyllabusAssessmentRecord.objects.get(student=record.student,
-                                                                          syllabus_point=record.syllabus_point,
-                                                                          order=record.order - 1)
-            old_attempted_plus_children = previous_record.attempted_plus_children
-            old_correct_plus_children = previous_record.correct_plus_children
-        except ObjectDoesNotExist:
-            old_attempted_plus_children = record.attempted_plus_children
-            old_correct_plus_children = record.correct_plus_children
-    # 1. Set the levels for the current assessment record
-    # - Find all marks for this level (and ONLY this level) after the last reset point. We want ones scored after
-    #   the last reset, and not after this sitting.
-    # - Store these marks in 'level_totals'.
-
-    marks = Mark.objects.filter(question__syllabus_points=record.syllabus_point,
-                                student=record.student,
-                                sitting__date__lte=record.sitting.date)
-    if marks.filter(sitting__resets_ratings=True).count():
-        last_relevant_sitting = marks.filter(sitting__resets_ratings=True).order_by('-sitting__date').first()
-        marks = marks.filter(sitting__date__gte=last_relevant_sitting.sitting.date)
-
-    data = marks.aggregate(Sum('question__max_score'), Sum('score'))
-    record.attempted_this_level = data['question__max_score__sum']
-    record.correct_this_level = data['score__sum']
-
-    # 2. Get total marks at this level by adding on children totals (use just children and their whole tree totals)
-    children_data = StudentSyllabusAssessmentRecord.objects.filter(student=record.student,
-                                                                   syllabus_point__in=record.syllabus_point.get_descendants(),
-                                                                   most_recent=True). \
-        aggregate(Sum('attempted_this_level'), Sum('correct_this_level'))
-
-    record.attempted_plus_children = float(data['question__max_score__sum'] or 0) + float(
-        children_data['attempted_this_level__sum'] or 0)
-    record.correct_plus_children = float(data['score__sum'] or 0) + float(children_data['correct_this_level__sum'] or 0)
-
-    # Set calculated fields:
-    record.save()
-    record.set_calculated_fields()
-
-    # 3. Iterate up through parents. Take parent old score, and add the difference between my previous totals
-    #    and my new total.
-
-    delta_attempted = record.attempted_plus_children - old_attempted_plus_children
-    delta_correct = record.correct_plus_children - old_correct_plus_children
-    parents = list(record.syllabus_point.get_ancestors(ascending=True))
-    for parent in parents:
-
-        # Need to get the last record since this may have been from a previous sitting.
-        # If we didn't do this, we'd always start with 0 as our attempted_plus_children etc.
-        # THIS IS WRONG; previous should be closest by date.
-        previous, created = StudentSyllabusAssessmentRecord.objects.get_or_create(student=record.student,
-                                                                                  syllabus_point=parent,
-                                                                                  most_recent=True,
-                                                                                  defaults={'sitting': record.sitting,
-                                                                                            'attempted_plus_children': delta_attempted,
-                                                                                            'correct_plus_children': delta_correct})
-        if created:
-            previous = StudentSyllabusAssessmentRecord.objects.get(student=record.student,
-                                                                   syllabus_point=parent,
-                                                                   most_recent=True)
-            previous.set_calculated_fields()
-            continue
-        else:
-            # Todo: remove debug statement
-            student_record, created = StudentSyllabusAssessmentRecord.objects.get_or_create(student=record.student,
-                                                                                            syllabus_point=parent,
-                                                                                            sitting=record.sitting)
-            # Here be dragons again! We need to refresh the db because we have to automatically set the order.
-            student_record = StudentSyllabusAssessmentRecord.objects.get(student=record.student,
-                                                                         syllabus_point=parent,
-                                                                         sitting=record.sitting)
-            student_record.attempted_plus_children = previous.attempted_plus_children + delta_attempted
-            student_record.correct_plus_children = previous.correct_plus_children + delta_correct
-            student_record.set_calculated_fields()
+            cache.incr(key)
+        except ValueError:
+            # Expired between add() and incr():
+            cache.add(key, int(time.time() * 1000), timeout=None)
+
+
+def data_version_key(tree_id=None):
+    if tree_id is None:
+        return 'greenpen_data_version'
+    return 'greenpen_data_version_' + str(tree_id)
+
+
+def data_version(tree_id=None):
+    """
+    A counter that changes whenever the marks or assessment records of a
+    syllabus tree (i.e. a subject) change, or of any subject if tree_id is None.
+    Cached dashboard responses include it in their key, so bumping it means they
+    are worked out afresh next time.
+    """
+    return cache_counter(data_version_key(tree_id))
+
+
+def bump_data_versions(tree_ids):
+    """ Bump the data version of each of the syllabus trees given, and the overall one. """
+    for tree_id in set(tree_ids) | {None}:
+        bump_cache_counter(data_version_key(tree_id))
+
+
+def tree_version_key(model):
+    return 'greenpen_tree_version_' + model._meta.model_name
+
+
+def tree_version(model):
+    """
+    A counter that changes whenever a node of an MPTT model's trees (e.g.
+    Syllabus or Mistake) is added, changed, moved or deleted. Tree JSON
+    responses are cached against it.
+    """
+    return cache_counter(tree_version_key(model))
+
+
+def tree_changed(sender, **kwargs):
+    bump_cache_counter(tree_version_key(sender))
+
+
+def bump_question_data_versions(questions):
+    """ Bump the data versions of the syllabus trees that a set of questions (or pks) cover. """
+    bump_data_versions(Syllabus.objects.filter(question__in=questions).values_list('tree_id', flat=True).distinct())
+
+
+def mark_deleted(sender, instance, **kwargs):
+    bump_question_data_versions([instance.question_id])
+
+
+def mark_mistakes_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if not reverse:
+        bump_question_data_versions([instance.question_id])
+    else:
+        bump_question_data_versions(Question.objects.filter(mark__mistakes=instance))
+
+
+def assessment_record_changed(sender, instance, **kwargs):
+    """
+    Bump the data version when a record is saved or deleted one at a time,
+    e.g. a student's self-assessment. Bulk writes bump it themselves.
+    """
+    # Look the tree up rather than using instance.syllabus_point, which is
+    # already gone when records are deleted along with their point:
+    bump_data_versions(Syllabus.objects.filter(pk=instance.syllabus_point_id).values_list('tree_id', flat=True))
+
+
+@receiver(node_moved, sender=Syllabus)
+def syllabus_moved(sender, instance, **kwargs):
+    Syllabus.objects.update_full_identifiers(node=instance)
+
+
+for tree_model in [Syllabus, Mistake]:
+    post_save.connect(tree_changed, sender=tree_model)
+    post_delete.connect(tree_changed, sender=tree_model)
+    node_moved.connect(tree_changed, sender=tree_model)
+
+post_delete.connect(mark_deleted, sender=Mark)
+m2m_changed.connect(mark_mistakes_changed, sender=Mark.mistakes.through)
+post_save.connect(assessment_record_changed, sender=StudentSyllabusAssessmentRecord)
+post_delete.connect(assessment_record_changed, sender=StudentSyllabusAssessmentRecord)
 
 
 # post_save.connect(syllabus_record_created, sender=StudentSyllabusAssessmentRecord)
@@ -1109,15 +1976,6 @@ class StudentSyllabusManualTeacherRecord(models.Model):
     created_by = models.ForeignKey(User, blank=False, null=True, on_delete=models.SET_NULL)
 
 
-@receiver(post_save, sender=Mark)
-def student_mark_changed(sender, instance=Mark.objects.none(), **kwargs):
-    if instance.score is not None:
-        instance.set_student_syllabus_assessment_records()
-
-
-# post_save.connect(student_mark_changed, sender=Mark)
-
-
 class CSVDoc(models.Model):
     description = models.CharField(max_length=255, blank=True)
     document = models.FileField(upload_to='documents/')
@@ -1299,32 +2157,48 @@ class CalendaredPeriod(models.Model):
         super(CalendaredPeriod, self).save(*args, **kwargs)
 
 
-def set_up_slots(academic_year=AcademicYear.objects.none()):
-    # Create weekly slots
-    i = 0
+def build_calendar(academic_year, first_week=0, weeks=None):
+    """
+    Create the timetable slots, weeks and calendared periods of an academic
+    year. Dates are worked out in memory and the rows are inserted in bulk;
+    any that already exist are left alone, so this is safe to run again.
 
-    for day in Day.objects.filter(year=academic_year):
-        for period in Period.objects.filter(year=academic_year):
-            TTSlot.objects.get_or_create(order=i,
-                                         day=day,
-                                         period=period,
-                                         year=academic_year)
-            i += 1
+    :param first_week: number of the first week to create
+    :param weeks: number of weeks to create; defaults to the rest of the year's total_weeks
+    """
+    days = list(Day.objects.filter(year=academic_year))
+    periods = list(Period.objects.filter(year=academic_year))
+    TTSlot.objects.bulk_create([TTSlot(order=i, day=day, period=period, year=academic_year)
+                                for i, (day, period) in enumerate((day, period)
+                                                                  for day in days
+                                                                  for period in periods)],
+                               ignore_conflicts=True)
+    tt_slots = list(TTSlot.objects.filter(year=academic_year).select_related('day'))
+
+    if weeks is None:
+        weeks = academic_year.total_weeks - first_week
+    numbers = range(first_week, first_week + weeks)
+    existing = set(Week.objects.filter(year=academic_year, number__in=numbers).values_list('number', flat=True))
+    Week.objects.bulk_create([Week(year=academic_year, number=number) for number in numbers
+                              if number not in existing])
+    # Fetched again, as not every database returns the pks of bulk created rows:
+    week_pks = dict(Week.objects.filter(year=academic_year, number__in=numbers).values_list('number', 'pk'))
+
+    CalendaredPeriod.objects.bulk_create(
+        [CalendaredPeriod(year=academic_year,
+                          order=number * len(tt_slots) + i,
+                          tt_slot=tt_slot,
+                          week_id=week_pks[number],
+                          date=academic_year.first_monday + datetime.timedelta(weeks=number,
+                                                                               days=tt_slot.day.order))
+         for number in numbers
+         for i, tt_slot in enumerate(tt_slots)],
+        ignore_conflicts=True, batch_size=500)
+    bump_timetable_version()
 
-    # Set up weekly slots
-    i = 0
-    for week_num in range(academic_year.total_weeks):
-        week, created = Week.objects.get_or_create(year=academic_year,
-                                                   number=week_num)
-        for slot in TTSlot.objects.filter(year=academic_year):
-            CalendaredPeriod.objects.get_or_create(year=academic_year,
-                                                   order=i,
-                                                   tt_slot=slot,
-                                                   week=week,
-                                                   date=academic_year.first_monday + datetime.timedelta(
-                                                       weeks=week.number,
-                                                       days=slot.day.order))
-            i += 1
+
+def set_up_slots(academic_year=AcademicYear.objects.none()):
+    build_calendar(academic_year)
 
 
 class Suspension(models.Model):
@@ -1352,89 +2226,76 @@ class Suspension(models.Model):
         if not self.set_slot(automatic=False):
             # This occurs if we are trying to suspend a non-teaching day
             pass
-        if self.whole_school:
-            # Assign self to a correct slot
-            self.set_slot(automatic=False)
-            super(Suspension, self).save(*args, **kwargs)
-
-            # Re-organise lessons affected by this suspension:
-
-            affected_lessons = Lesson.objects.filter(slot=self.slot)
-
-            # We'll need to re-slot these lessons. The recuersion that checks
-            # for clashing peers should magically make all the other lessons in the series
-            # re-time too.:
-            for lesson in affected_lessons:
-                lesson.save()  # Save automatically calls 'set_slot'.
-
-        else:
-            super(Suspension, self).save(*args, **kwargs)
+        super(Suspension, self).save(*args, **kwargs)
+        if self.whole_school and self.slot:
+            # Re-slot the lessons of every group taught in this period:
+            reslot_lessons(TeachingGroup.objects.filter(lessons=self.slot.tt_slot))
 
     def delete(self, *args, **kwargs):
         # find the classes affected by this:
-        # todo: remove debug filter
-        tgs = list(TeachingGroup.objects.filter(lessons=self.slot.tt_slot))
-        # Find lessons affected by this suspension:
-        tt_lessons = Lesson.objects.filter(slot__date__gte=self.date,
-                                           teachinggroup__in=tgs)
-
+        tgs = TeachingGroup.objects.filter(lessons=self.slot.tt_slot)
         if not self.whole_school:
-            tt_lessons = tt_lessons.filter(teachinggroup__in=self.teachinggroups.all())
-        list(tt_lessons)  # This shouldn't be required, but for some reason
-        # either PyCharm or docker refuses to evaluate the qs without it.
+            tgs = tgs.filter(pk__in=self.teachinggroups.all())
+        tgs = list(tgs)  # Evaluate before the suspension's groups are deleted with it.
         super(Suspension, self).delete(*args, **kwargs)
-        for lesson in tt_lessons:
-            lesson.save()
+        reslot_lessons(tgs)
 
 
 def class_suspended(sender, **kwargs):
     suspension = kwargs['instance']
-    if 'post_add' in kwargs['action']:
-        classgroups = suspension.teachinggroups.all()
-        if classgroups.count():
-            affected_lessons = Lesson.objects.filter(teachinggroup__in=classgroups,
-                                                     slot__date=suspension.date,
-                                                     slot__tt_slot__period=suspension.period)
+    if 'post_add' in kwargs['action'] or 'post_remove' in kwargs['action']:
+        # Lessons of the groups added or removed move into or out of this period.
+        reslot_lessons(TeachingGroup.objects.filter(pk__in=kwargs['pk_set']))
 
-            for lesson in affected_lessons:
-                lesson.save()
+    elif 'post_clear' in kwargs['action'] and suspension.slot:
+        # The cleared groups are no longer known, so re-slot every group taught in this period.
+        reslot_lessons(TeachingGroup.objects.filter(lessons=suspension.slot.tt_slot))
 
-    elif 'post_remove' in kwargs['action']:
-        print('1')
-        # find the classes affected by this:
-        # todo: remove debug filter
-        tgs = list(TeachingGroup.objects.filter(lessons=suspension.slot.tt_slot))
-        # Find lessons affected by this suspension:
-        tt_lessons = Lesson.objects.filter(slot__date__gte=suspension.date,
-                                           teachinggroup__in=tgs)
-
-        # Exclude any that are still suspended.
-        tt_lessons = tt_lessons.exclude(teachinggroup__in=suspension.teachinggroups.all())
-        # list(tt_lessons) # This shouldn't be required, but for some reason
-        # either PyCharm or docker refuses to evaluate the qs without it.
-
-        for lesson in tt_lessons:
-            lesson.save()
-
-    elif 'post_clear' in kwargs['action']:
-        print('2')
-        # find the classes affected by this:
-        # todo: remove debug filter
-        tgs = list(TeachingGroup.objects.filter(lessons=suspension.slot.tt_slot))
-        # Find lessons affected by this suspension:
-        tt_lessons = Lesson.objects.filter(slot__date__gte=suspension.date,
-                                           teachinggroup__in=tgs)
 
-        # Exclude any that are still suspended.
-        tt_lessons = tt_lessons.exclude(teachinggroup=suspension.teachinggroups.all())
-        list(tt_lessons)  # This shouldn't be required, but for some reason
-        # either PyCharm or docker refuses to evaluate the qs without it.
+m2m_changed.connect(class_suspended, sender=Suspension.teachinggroups.through)
 
-        for lesson in tt_lessons:
-            lesson.save()
 
+def suspend_periods(start_date, end_date, reason, whole_school=False, teachinggroups=TeachingGroup.objects.none(),
+                    periods=None):
+    """
+    Suspend every period between two dates (inclusive), e.g. for a trip or
+    a school closure, then re-slot each affected group's lessons once.
 
-m2m_changed.connect(class_suspended, sender=Suspension.teachinggroups.through)
+    The periods are found in one query and the suspensions, and their links
+    to the teaching groups, are created in bulk. Days with no timetabled
+    periods (e.g. weekends) are skipped.
+
+    :param periods: the Periods to suspend on each day; defaults to all of the current year's
+    :return: list of the new Suspensions
+    """
+    if periods is None:
+        periods = Period.objects.filter(year__current=True)
+    teachinggroups = list(teachinggroups)
+    slots = list(CalendaredPeriod.objects.filter(date__gte=start_date, date__lte=end_date,
+                                                 tt_slot__period__in=periods
+                                                 ).values_list('pk', 'date', 'tt_slot__period_id', 'tt_slot_id'))
+    suspensions = [Suspension(date=date, period_id=period, slot_id=slot, reason=reason, whole_school=whole_school)
+                   for slot, date, period, tt_slot in slots]
+
+    with transaction.atomic():
+        Suspension.objects.bulk_create(suspensions)
+        if teachinggroups and not whole_school:
+            if any(suspension.pk is None for suspension in suspensions):
+                # Some database backends don't return the pks of bulk created rows:
+                suspensions = list(Suspension.objects.filter(slot__in=[slot[0] for slot in slots], reason=reason,
+                                                             whole_school=whole_school, teachinggroups=None))
+            Suspension.teachinggroups.through.objects.bulk_create(
+                [Suspension.teachinggroups.through(suspension_id=suspension.pk, teachinggroup_id=group.pk)
+                 for suspension in suspensions
+                 for group in teachinggroups])
+    bump_timetable_version()
+
+    if whole_school:
+        groups = TeachingGroup.objects.filter(lessons__in={slot[3] for slot in slots}).distinct()
+    else:
+        groups = teachinggroups
+    reslot_lessons(groups)
+    return suspensions
 
 
 class Lesson(models.Model):
@@ -1457,72 +2318,76 @@ class Lesson(models.Model):
         unique_together = ['teachinggroup', 'order']
         ordering = ['order']
 
-    def __set_slot(self, save=False, candidates=False):
-
-        # Find lesson slots for this class
-        tt_slots = TTSlot.objects.filter(teachinggroup=self.teachinggroup)
-
-        # Include the candidates in the recursion to prevent mutliple db hits.
-        if not candidates:
-            # Get a list of all possible lesson slots
-            candidates = list(CalendaredPeriod.objects.filter(tt_slot__in=tt_slots). \
-                              exclude(suspension__teachinggroups=self.teachinggroup) \
-                              .exclude(suspension__whole_school=True).order_by('date'))
-        # Place this lesson in the [order-th] slot
-        try:
-            self.slot = candidates[int(self.order)]
-        except IndexError:
-            # Todo: Add warning message that lessons go past last day of year.
-            # Get last item:
-            last_slot = CalendaredPeriod.objects.latest('order')
-            year = AcademicYear.objects.get(current=True)
-            week = Week.objects.latest('number')
-            next_week, created = Week.objects.get_or_create(year=year,
-                                                            number=week.number + 1)
-            # Add an extra week
-            for day in Day.objects.filter(year=year):
-                for period in Period.objects.filter(year=year):
-                    CalendaredPeriod.objects.get_or_create(year=year,
-                                                           order=last_slot.order + 1,
-                                                           week=next_week,
-                                                           tt_slot=TTSlot.objects.get(year=year,
-                                                                                      day=day,
-                                                                                      period=period))
-
-            # Try again with newly created days:
-            candidates = list(CalendaredPeriod.objects.filter(tt_slot__in=tt_slots). \
-                              exclude(suspension__teachinggroups=self.teachinggroup) \
-                              .exclude(suspension__whole_school=True))
-            self.slot = candidates[int(self.order)]
-        # Check if this will now clash with another lesson:
-        # NB this works because we've not saved yet, so the DB will return only
-        # the saved compeitior lesson.
-        competitor = list(Lesson.objects.exclude(pk=self.pk).filter(teachinggroup=self.teachinggroup,
-                                                                    slot=self.slot))
-
-        if competitor:
-            # Recursion goes BRRRRRR
-            competitor[0].__set_slot(save=True, candidates=candidates)
-
-        if save:
-            self.save(bypass_set_slot=True)
-
-        else:
-            return self.slot
-
     def save(self, bypass_set_slot=False, *args, **kwargs):
-        if not bypass_set_slot:
-            self.__set_slot(save=False)
         super(Lesson, self).save(*args, **kwargs)
+        if not bypass_set_slot:
+            self.slot_id = reslot_lessons([self.teachinggroup]).get(self.pk)
 
     def delete(self, *args, **kwargs):
         super(Lesson, self).delete(*args, **kwargs)
-        # Find the lessons that previously came after this:
+        # Close the gap in the order of the lessons that came after this,
+        # one at a time to keep the orders unique:
         following = Lesson.objects.filter(teachinggroup=self.teachinggroup,
-                                          order__gt=self.order)
-        for lesson in following:
-            lesson.order = lesson.order - 1
-            lesson.save()  # will re-apply the ordering
+                                          order__gt=self.order).order_by('order')
+        for pk, order in following.values_list('pk', 'order'):
+            Lesson.objects.filter(pk=pk).update(order=order - 1)
+        reslot_lessons([self.teachinggroup])
+
+
+def add_calendar_weeks(year, weeks):
+    """
+    Add weeks to the end of an academic year's calendar, e.g. when a group
+    has more lessons than there are periods left in the year.
+    """
+    last_week = Week.objects.filter(year=year).order_by('number').last()
+    build_calendar(year, first_week=last_week.number + 1 if last_week else 0, weeks=weeks)
+
+
+def lesson_slot_candidates(teachinggroup):
+    """
+    The pks of the CalendaredPeriods a group could be taught in, in date order:
+    those of its timetabled slots, less any suspended for the group or the whole school.
+    """
+    return list(CalendaredPeriod.objects.filter(tt_slot__teachinggroup=teachinggroup)
+                .exclude(suspension__teachinggroups=teachinggroup)
+                .exclude(suspension__whole_school=True)
+                .order_by('date', 'tt_slot__order')
+                .values_list('pk', flat=True))
+
+
+def reslot_lessons(teachinggroups):
+    """
+    Put the lessons of each teaching group into their slots, in one pass per
+    group. The group's lessons, in order, are paired off with its available
+    periods from lesson_slot_candidates(). If there are more lessons than
+    periods, weeks are added to the current year's calendar to fit them in.
+    Only lessons that have moved are saved.
+
+    :param teachinggroups: queryset or list of TeachingGroups
+    :return: dict of the slot pk given to each lesson, keyed by lesson pk
+    """
+    slots = {}
+    for group in teachinggroups:
+        lessons = list(Lesson.objects.filter(teachinggroup=group).order_by('order').only('pk', 'order', 'slot'))
+        candidates = lesson_slot_candidates(group)
+        if len(lessons) > len(candidates):
+            year = AcademicYear.objects.filter(current=True).first()
+            slots_per_week = TTSlot.objects.filter(teachinggroup=group, year=year).count()
+            if slots_per_week:
+                add_calendar_weeks(year, -(-(len(lessons) - len(candidates)) // slots_per_week))
+                candidates = lesson_slot_candidates(group)
+
+        moved = []
+        for i, lesson in enumerate(lessons):
+            slot = candidates[i] if i < len(candidates) else None
+            slots[lesson.pk] = slot
+            if lesson.slot_id != slot:
+                lesson.slot_id = slot
+                moved.append(lesson)
+        Lesson.objects.bulk_update(moved, ['slot'], batch_size=500)
+        if moved:
+            bump_timetable_version()
+    return slots
 
 
 def copy_lesson(request, lesson_pk):
@@ -1534,23 +2399,116 @@ def copy_lesson(request, lesson_pk):
 
 
 def setup_lessons(teachinggrousp=TeachingGroup.objects.all()):
-    current_year = AcademicYear.objects.get(current=True)
     for group in teachinggrousp:
         max_lessons = group.lessons.count() * 52 * 2 # Temporary hack - should find the actual total number of expected lessons.
         # If we have a group that has been taught over multiple years (.e.g AS to A2),
         # we need to start from the first lesson of last year.
-        lessons = Lesson.objects.filter(teachinggroup=group).order_by('order')
-        if lessons.count() > 0:
-            lesson_number = lessons.last().order
-        else:
-            lesson_number = 0
-        for lesson in range(max_lessons):
-            lesson, created = Lesson.objects.get_or_create(teachinggroup=group,
-                                                           order=lesson_number)
-            lesson.save()  # Required to force a re-slot.
-            lesson_number += 1
-            if lesson_number > max_lessons:
-                break
+        existing = set(Lesson.objects.filter(teachinggroup=group).values_list('order', flat=True))
+        lesson_number = int(max(existing)) if existing else 0
+        Lesson.objects.bulk_create([Lesson(teachinggroup=group, order=order)
+                                    for order in range(lesson_number, min(lesson_number + max_lessons, max_lessons + 1))
+                                    if order not in existing])
+        reslot_lessons([group])
+
+
+TIMETABLE_INDEX_TIMEOUT = 60 * 60 * 24
+
+
+def bump_timetable_version():
+    """ Mark cached timetable indexes as out of date, e.g. after lessons or suspensions change. """
+    bump_cache_counter('greenpen_timetable_version')
+
+
+def timetable_changed(sender, action=None, **kwargs):
+    # action is only sent for m2m changes:
+    if action in [None, 'post_add', 'post_remove', 'post_clear']:
+        bump_timetable_version()
+
+
+post_save.connect(timetable_changed, sender=Lesson)
+post_delete.connect(timetable_changed, sender=Lesson)
+post_save.connect(timetable_changed, sender=Suspension)
+post_delete.connect(timetable_changed, sender=Suspension)
+m2m_changed.connect(timetable_changed, sender=Suspension.teachinggroups.through)
+m2m_changed.connect(timetable_changed, sender=TeachingGroup.teachers.through)
+
+
+def timetable_index(year=None):
+    """
+    Every lesson and suspension of an academic year, arranged by teacher,
+    for views that show more than a week at a time. It is built from one
+    scan each of the year's periods, lessons and suspensions, and cached
+    until a lesson or suspension changes. The version it is cached against is
+    kept in the cache, so it is only cached if settings.SHARED_CACHE is on;
+    otherwise a change made by one process wouldn't be seen by the others.
+
+    :param year: the AcademicYear; defaults to the current one
+    :return: dict with:
+             'periods': (date, period name) of every calendared period in the year, in order
+             'teachers': {teacher pk: {(date, period name): [lesson dicts]}}
+             'suspensions': {(date, period name): [(reason, teaching group pks or None if whole school)]}
+    """
+    if year is None:
+        year = AcademicYear.objects.get(current=True)
+    key = None
+    if settings.SHARED_CACHE:
+        key = 'greenpen_timetable_index_{}_{}'.format(year.pk, cache_counter('greenpen_timetable_version'))
+        index = cache.get(key)
+        if index is not None:
+            return index
+
+    slots = {}
+    for pk, date, period in CalendaredPeriod.objects.filter(year=year).order_by(
+            'date', 'tt_slot__period__order').values_list('pk', 'date', 'tt_slot__period__name'):
+        slots[pk] = (date, period)
+
+    group_teachers = {}
+    for group, teacher in TeachingGroup.teachers.through.objects.values_list('teachinggroup_id', 'teacher_id'):
+        group_teachers.setdefault(group, []).append(teacher)
+
+    teachers = {}
+    for lesson in Lesson.objects.filter(slot__year=year).order_by('teachinggroup__name').values(
+            'pk', 'slot_id', 'title', 'description', 'requirements', 'teachinggroup_id', 'teachinggroup__name'):
+        for teacher in group_teachers.get(lesson['teachinggroup_id'], []):
+            teachers.setdefault(teacher, {}).setdefault(slots[lesson['slot_id']], []).append(lesson)
+
+    suspension_groups = {}
+    for suspension, group in Suspension.teachinggroups.through.objects.filter(
+            suspension__slot__year=year).values_list('suspension_id', 'teachinggroup_id'):
+        suspension_groups.setdefault(suspension, []).append(group)
+
+    suspensions = {}
+    for pk, slot, reason, whole_school in Suspension.objects.filter(slot__year=year).values_list(
+            'pk', 'slot_id', 'reason', 'whole_school'):
+        groups = None if whole_school else suspension_groups.get(pk, [])
+        suspensions.setdefault(slots[slot], []).append((reason, groups))
+
+    index = {'periods': list(slots.values()),
+             'teachers': teachers,
+             'suspensions': suspensions}
+    if key is not None:
+        cache.set(key, index, TIMETABLE_INDEX_TIMEOUT)
+    return index
+
+
+def teacher_timetable(teacher, start_date=None, end_date=None, year=None):
+    """
+    A teacher's lessons and suspensions for each period between two dates
+    (inclusive), read from timetable_index().
+
+    :return: list of (date, period name, lessons, suspension reasons) in date order
+    """
+    index = timetable_index(year)
+    lessons = index['teachers'].get(teacher.pk, {})
+    groups = set(TeachingGroup.objects.filter(teachers=teacher).values_list('pk', flat=True))
+    timetable = []
+    for date, period in index['periods']:
+        if (start_date and date < start_date) or (end_date and date > end_date):
+            continue
+        reasons = [reason for reason, suspended in index['suspensions'].get((date, period), [])
+                   if suspended is None or groups.intersection(suspended)]
+        timetable.append((date, period, lessons.get((date, period), []), reasons))
+    return timetable
 
 
 class GQuizExam(Exam):
@@ -1642,9 +2600,11 @@ class GQuizSitting(Sitting):
         exam = GQuizExam.objects.get(pk=self.exam.pk)
         return "<a href='{url}' target='blank'>{name}</a>".format(url=str(exam.master_form_url), name=str(exam.name))
 
-    def import_scores(self, email=False, timestamp=False):
+    def import_scores(self, email=False, timestamp=False, client=None):
         """ Use Google API to get the score data.
         If an email is supplied, only process the data for that student.
+
+        :param client: gspread client to read the sheet with; defaults to the service account
         """
         if self.importing:
             if not email:
@@ -1652,59 +2612,80 @@ class GQuizSitting(Sitting):
 
         self.importing = True
         self.save()
-        marks_entered = False
+        try:
+            gc = client or gspread.service_account()
+            ss = gc.open_by_url(self.scores_sheet_url)
+            rows = ss.worksheet("Scores").get_all_records()
+            if email:
+                rows = [row for row in rows if row['Student Email Address'] == email]
+            return self.import_score_rows(rows)
+        finally:
+            self.importing = False
+            self.save()
 
-        gc = gspread.service_account()
-        ss = gc.open_by_url(self.scores_sheet_url)
-        qs = ss.worksheet("Scores").get_all_records()
-        # Get the sitting:
+    def import_score_rows(self, rows):
+        """
+        Save the rows of a "Scores" sheet as GQuizMarks for this sitting.
 
-        for row in qs:
-            if email:
-                time_string = str(row['Timestamp'])
-                time_string = time_string.replace('T', ' ')
-                time_string = re.match(r'(.*)\.', time_string).group()
-                time_string = time_string[:-1]
-                response_timestamp = datetime.datetime.strptime(time_string, "%Y-%m-%d %H:%M:%S")
-                if email != row['Student Email Address']:
-                    continue
-                # elif timestamp != response_timestamp:
-                #     continue
-            # We have found at least one row to import
-            marks_entered = True
+        Students and questions are looked up with one query each. Every row is
+        checked before anything is saved, existing marks are updated together,
+        and the ratings are recalculated once for each student at the end.
+        Rows for unknown students or questions are skipped.
 
-            print(row)
-            student = Student.objects.get(user__email=row['Student Email Address'])
+        :return: True if there were any rows to import
+        """
+        if not rows:
+            return False
 
-            question = GQuizQuestion.objects.get(exam=self.exam,
-                                                 google_id=row['ID'])
-            try:
-                # Check if there's a normal Mark object:
-                mark = Mark.objects.get(question=question,
-                                        sitting=self,
-                                        student=student)
-                mark.delete()
-            except ObjectDoesNotExist:
-                pass
+        students = {student.user.email: student for student in Student.objects.filter(
+            user__email__in={row['Student Email Address'] for row in rows}).select_related('user')}
+        questions = {question.google_id: question for question in GQuizQuestion.objects.filter(exam=self.exam)}
 
+        scores = {}
+        for row in rows:
+            student = students.get(row['Student Email Address'])
+            question = questions.get(row['ID'])
+            if student is None or question is None:
+                continue
             # Sanity check for max score in case of changed questions.
             if row['Maximum score'] > question.max_score:
                 raise MarkScoreError
-
-            mark, created = GQuizMark.objects.get_or_create(question=question,
-                                                            sitting=self, student=student)
-            mark.score = row['Student Score']
-            mark.student_response = row['Student Answer']
-            mark.teacher_response = row['Teacher Feedback']
-            mark.student_notes = "You were asked: " + str(
-                mark.question.gquizquestion.text) + ".<br>You answered: " + str(
-                mark.student_response) + "<br><strong>Teacher response:</strong>: " + str(mark.teacher_response)
-            mark.save()
-
-        self.importing = False
-        self.save()
-
-        return marks_entered
+            # Later rows are later responses, so they win.
+            scores[(student.pk, question.pk)] = (question, row)
+
+        student_pks = {student for student, question in scores}
+        question_pks = {question for student, question in scores}
+        marks = {(mark.student_id, mark.question_id): mark
+                 for mark in GQuizMark.objects.filter(sitting=self, student__in=student_pks, question__in=question_pks)}
+        # Normal Mark objects (e.g. the blank ones made for the sitting) are replaced by GQuizMarks:
+        plain_marks = [pk for pk, student, question in Mark.objects.filter(
+            sitting=self, student__in=student_pks, question__in=question_pks, gquizmark__isnull=True
+        ).values_list('pk', 'student_id', 'question_id') if (student, question) in scores]
+
+        with transaction.atomic():
+            Mark.objects.filter(pk__in=plain_marks).delete()
+            to_update = []
+            for (student, question_pk), (question, row) in scores.items():
+                mark = marks.get((student, question_pk)) or GQuizMark(question=question, sitting=self,
+                                                                      student_id=student)
+                mark.score = row['Student Score']
+                mark.student_response = row['Student Answer']
+                mark.teacher_response = row['Teacher Feedback']
+                mark.student_notes = "You were asked: " + str(
+                    question.text) + ".<br>You answered: " + str(
+                    mark.student_response) + "<br><strong>Teacher response:</strong>: " + str(mark.teacher_response)
+                if mark.pk:
+                    to_update.append(mark)
+                else:
+                    # GQuizMark is a multi-table child of Mark, so can't be bulk created.
+                    mark.save(bypass_ratings=True)
+            GQuizMark.objects.bulk_update(to_update, ['score', 'student_response', 'teacher_response',
+                                                      'student_notes'], batch_size=500)
+
+        recalculate_assessment_records([(student, self.pk) for student in student_pks])
+        bump_question_data_versions(question_pks)
+
+        return True
 
 
 class GQuizMark(Mark):
@@ -1712,12 +2693,251 @@ class GQuizMark(Mark):
     teacher_response = RichTextField(blank=True, null=True)
 
 
-def student_mark_changed(sender, instance=GQuizMark.objects.none(), **kwargs):
-    if instance.score is not None:
-        instance.set_student_syllabus_assessment_records()
+class BackgroundJob(models.Model):
+    """
+    A piece of slow work (e.g. importing a Google Quiz) to be done outside of
+    a request. Jobs are added with enqueue_job() and run by `manage.py run_jobs`,
+    so they survive restarts of the web server, and are retried if Google
+    limits our API requests.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+    ACTIVE = [QUEUED, RUNNING]
+
+    task = models.CharField(max_length=100, blank=False, null=False)
+    sitting = models.ForeignKey(Sitting, on_delete=models.CASCADE, blank=True, null=True)
+    arguments = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.IntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    created = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_after'])]
+
+    def __str__(self):
+        return str(self.task) + " (" + str(self.sitting_id) + "): " + str(self.status)
+
+    def status_dict(self):
+        return {'pk': self.pk,
+                'task': self.task,
+                'status': self.status,
+                'attempts': self.attempts,
+                'error': self.error}
+
+
+def import_gquiz_scores_job(job):
+    """ Job task: import the scores of a GQuizSitting from its Google Sheet. """
+    GQuizSitting.objects.get(pk=job.sitting_id).import_scores(**job.arguments)
+
+
+class GQuizNotification(models.Model):
+    """
+    A student's Google Quiz response waiting to be imported, as reported by
+    the gquizalert webhook. There is at most one per student per response
+    sheet, so repeated submissions are imported once.
+    """
+    scores_sheet_url = models.URLField(blank=False, null=False)
+    student_email = models.EmailField(blank=False, null=False)
+    timestamp = models.DateTimeField(blank=False, null=False)
+    received = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ['scores_sheet_url', 'student_email']
+
+    def __str__(self):
+        return str(self.student_email) + " " + str(self.scores_sheet_url)
+
+    def find_sitting(self, sittings):
+        """
+        The sitting this response belongs to, from the sittings using its sheet.
+        Only self-assessment quizzes may share a sheet, in which case the
+        student's sitting closest to the response is used.
+        """
+        if len(sittings) == 1:
+            return sittings[0]
+        if not all(sitting.self_assessment for sitting in sittings):
+            raise IntegrityError("Multiple sittings using the same URL")
+        return GQuizSitting.objects.filter(pk__in=[sitting.pk for sitting in sittings],
+                                           students__user__email=self.student_email
+                                           ).get_closest_to(self.timestamp.date())
+
+
+def notify_gquiz_response(scores_sheet_url, student_email, timestamp):
+    """
+    Record that a student has submitted a Google Quiz, and queue a job to
+    import it. The job waits settings.GQUIZ_ALERT_DELAY seconds, so that
+    when a whole class submits together their responses are imported from
+    one read of the sheet.
+
+    :return: the BackgroundJob that will do the import
+    """
+    GQuizNotification.objects.update_or_create(scores_sheet_url=scores_sheet_url,
+                                               student_email=student_email,
+                                               defaults={'timestamp': timestamp,
+                                                         'received': timezone.now()})
+    return enqueue_job('import_gquiz_responses', delay=settings.GQUIZ_ALERT_DELAY,
+                       scores_sheet_url=scores_sheet_url)
+
+
+def import_gquiz_responses_job(job, client=None):
+    """
+    Job task: import the responses waiting in GQuizNotification for one
+    response sheet, reading the sheet once for all of them.
+
+    :param client: gspread client to read the sheet with; defaults to the service account
+    """
+    url = job.arguments['scores_sheet_url']
+    started = timezone.now()
+    notifications = list(GQuizNotification.objects.filter(scores_sheet_url=url))
+    if not notifications:
+        return
+
+    sittings = list(GQuizSitting.objects.filter(scores_sheet_url=url))
+    emails = {}
+    problems = []
+    for notification in notifications:
+        try:
+            sitting = notification.find_sitting(sittings)
+        except GQuizSitting.DoesNotExist:
+            # Not a student of any sitting using this sheet.
+            continue
+        except IntegrityError as e:
+            # The sheet is set up wrongly; import everyone else's responses
+            # and note this one on the job (it is dropped with the rest).
+            problems.append(notification.student_email + ": " + str(e))
+            continue
+        emails.setdefault(sitting, set()).add(notification.student_email)
+    if problems:
+        job.error = "\n".join(problems)
+
+    if emails:
+        gc = client or gspread.service_account()
+        rows = gc.open_by_url(url).worksheet("Scores").get_all_records()
+        for sitting, sitting_emails in emails.items():
+            sitting.import_score_rows([row for row in rows if row['Student Email Address'] in sitting_emails])
+        GQuizSitting.objects.filter(pk__in=[sitting.pk for sitting in emails]).update(imported=True)
+
+    # Students who submitted again while we were working are left for the next job.
+    GQuizNotification.objects.filter(pk__in=[notification.pk for notification in notifications],
+                                     received__lte=started).delete()
+
+
+# Functions that can be run as background jobs, keyed by BackgroundJob.task:
+JOB_TASKS = {
+    'import_gquiz_scores': import_gquiz_scores_job,
+    'import_gquiz_responses': import_gquiz_responses_job,
+}
+
 
+def enqueue_job(task, sitting=None, delay=0, **arguments):
+    """
+    Add a job to the queue, unless the same task is already waiting to run
+    for the same sitting, in which case that job is returned instead.
+
+    :param task: a key of JOB_TASKS
+    :param sitting: the Sitting the job works on, if any
+    :param delay: seconds to wait before running a new job
+    :param arguments: keyword arguments for the task (must be JSON serialisable)
+    :return: the BackgroundJob
+    """
+    if task not in JOB_TASKS:
+        raise ValueError("Unknown job task: " + str(task))
+    with transaction.atomic():
+        job = BackgroundJob.objects.select_for_update().filter(task=task, sitting=sitting, arguments=arguments,
+                                                               status=BackgroundJob.QUEUED).first()
+        if job is None:
+            job = BackgroundJob.objects.create(task=task, sitting=sitting, arguments=arguments,
+                                               run_after=timezone.now() + datetime.timedelta(seconds=delay))
+    return job
+
+
+def requeue_stale_jobs():
+    """
+    Queue again any jobs that have been running for longer than
+    settings.JOB_TIMEOUT, as their worker has probably died. Google Quiz
+    sittings they were importing are marked as no longer importing.
+
+    :return: the number of jobs queued again
+    """
+    cutoff = timezone.now() - datetime.timedelta(seconds=settings.JOB_TIMEOUT)
+    with transaction.atomic():
+        stale = BackgroundJob.objects.select_for_update().filter(status=BackgroundJob.RUNNING, started__lt=cutoff)
+        sittings = list(stale.exclude(sitting=None).values_list('sitting_id', flat=True))
+        GQuizSitting.objects.filter(pk__in=sittings).update(importing=False)
+        return stale.update(status=BackgroundJob.QUEUED, run_after=timezone.now())
 
-post_save.connect(student_mark_changed, sender=GQuizMark)
+
+def claim_job():
+    """
+    Take the oldest job that is ready to run and mark it as running. Jobs for
+    a sitting, or a Google Sheet, that already has a job running are left
+    until that one finishes, so two jobs never import the same marks at once.
+
+    :return: the BackgroundJob, or None if there is nothing to do
+    """
+    with transaction.atomic():
+        running = BackgroundJob.objects.filter(status=BackgroundJob.RUNNING)
+        busy_sittings = set(running.exclude(sitting=None).values_list('sitting_id', flat=True))
+        busy_urls = set(running.filter(task='import_gquiz_responses').values_list('arguments__scores_sheet_url',
+                                                                                   flat=True))
+        busy_urls |= set(GQuizSitting.objects.filter(pk__in=busy_sittings).values_list('scores_sheet_url', flat=True))
+        busy_sittings |= set(GQuizSitting.objects.filter(scores_sheet_url__in=busy_urls).values_list('pk', flat=True))
+
+        job = BackgroundJob.objects.select_for_update(skip_locked=True).filter(
+            status=BackgroundJob.QUEUED, run_after__lte=timezone.now()
+        ).exclude(sitting__in=busy_sittings).exclude(
+            task='import_gquiz_responses', arguments__scores_sheet_url__in=busy_urls
+        ).order_by('run_after', 'pk').first()
+        if job is None:
+            return None
+        job.status = BackgroundJob.RUNNING
+        job.attempts += 1
+        job.started = timezone.now()
+        job.save(update_fields=['status', 'attempts', 'started'])
+    return job
+
+
+def is_rate_limit_error(error):
+    """ Whether an exception is Google telling us to slow down. """
+    response = getattr(error, 'response', None)
+    return isinstance(error, gspread.exceptions.APIError) and getattr(response, 'status_code', None) == 429
+
+
+def run_job(job_pk):
+    """
+    Run a claimed job and record the result. Jobs that fail because of a
+    Google rate limit are queued again after a delay that doubles with each
+    attempt (see settings.JOB_RETRY_DELAY and JOB_MAX_ATTEMPTS); any other
+    error fails the job.
+
+    :return: the job's new status
+    """
+    job = BackgroundJob.objects.get(pk=job_pk)
+    # Tasks may note problems that didn't stop them in job.error:
+    job.error = None
+    try:
+        JOB_TASKS[job.task](job)
+    except Exception as e:
+        job.error = repr(e)
+        if is_rate_limit_error(e) and job.attempts < settings.JOB_MAX_ATTEMPTS:
+            job.status = BackgroundJob.QUEUED
+            job.run_after = timezone.now() + datetime.timedelta(
+                seconds=settings.JOB_RETRY_DELAY * 2 ** (job.attempts - 1))
+        else:
+            job.status = BackgroundJob.FAILED
+            job.finished = timezone.now()
+    else:
+        job.status = BackgroundJob.DONE
+        job.finished = timezone.now()
+    job.save(update_fields=['status', 'error', 'run_after', 'finished'])
+    return job.status
 
 
 def generate_analsysios_df(marks=Mark.objects.none):
@@ -319,4 +319,49 @@ MESSAGE_TAGS = {
 
 DATA_UPLOAD_MAX_NUMBER_FIELDS = None
 
+# Set to True to queue rating recalculations when marks are saved, rather than
+# running them in the request. The queue is processed by `manage.py update_ratings`.
+DEFER_RATING_UPDATES = os.getenv('DJANGO_DEFER_RATING_UPDATES') == 'True'
+
+# Dashboard callback responses are cached in Redis when DJANGO_REDIS_CACHE_URL is
+# set (e.g. redis://redis:6379/1), and in local memory otherwise.
+if os.getenv('DJANGO_REDIS_CACHE_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.getenv('DJANGO_REDIS_CACHE_URL'),
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                'IGNORE_EXCEPTIONS': True,
+            },
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Whether every process (web workers, update_ratings and run_jobs) shares the
+# same cache. Cached data is versioned by counters kept in the cache, so a
+# change made in one process is only seen by the others if it is shared. Set
+# DJANGO_SHARED_CACHE=True if the cache isn't Redis but is shared anyway.
+SHARED_CACHE = bool(os.getenv('DJANGO_REDIS_CACHE_URL')) or os.getenv('DJANGO_SHARED_CACHE') == 'True'
+
+# Seconds to keep cached dashboard callback responses. 0 turns the cache off.
+DASH_CALLBACK_CACHE_TIMEOUT = int(os.getenv('DJANGO_DASH_CALLBACK_CACHE_TIMEOUT', 300))
+
+# Background jobs (e.g. Google Quiz imports) are run by `manage.py run_jobs`.
+# Jobs that hit a Google API rate limit are retried after JOB_RETRY_DELAY seconds,
+# doubling each time, up to JOB_MAX_ATTEMPTS attempts in all. Jobs still running
+# after JOB_TIMEOUT seconds are assumed lost (e.g. the worker restarted) and queued again.
+JOB_MAX_ATTEMPTS = int(os.getenv('DJANGO_JOB_MAX_ATTEMPTS', 5))
+JOB_RETRY_DELAY = int(os.getenv('DJANGO_JOB_RETRY_DELAY', 30))
+JOB_TIMEOUT = int(os.getenv('DJANGO_JOB_TIMEOUT', 1800))
+
+# Seconds to wait after a Google Quiz response before importing it, so that
+# responses submitted together are imported from one read of the sheet.
+GQUIZ_ALERT_DELAY = int(os.getenv('DJANGO_GQUIZ_ALERT_DELAY', 10))
+
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
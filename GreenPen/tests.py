@@ -1,7 +1,10 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from GreenPen.models import *
 from django.contrib.auth.models import User
 import datetime
+import json
+import os
+from unittest import mock
 
 
 class StudentTestCase(TestCase):
@@ -192,6 +195,26 @@ class SyllabusTestCase(TestCase):
         root_1_2 = Syllabus.objects.get(text='second grandchild')
         self.assertEqual(str(root_1_2), '1.1.2: second grandchild')
 
+    def test_full_identifier(self):
+        """ Labels are stored, so choice lists need no ancestor queries, and follow renames and moves. """
+        with self.assertNumQueries(1):
+            labels = [str(point) for point in Syllabus.objects.order_by('tree_id', 'lft')]
+        self.assertEqual(labels, ['1: root', '1.1: first child', '1.1.1: first grandchild',
+                                  '1.1.2: second grandchild', '1.2: second child'])
+
+        first_child = Syllabus.objects.get(text='first child')
+        first_child.identifier = '3'
+        first_child.save()
+        self.assertEqual(str(Syllabus.objects.get(text='second grandchild')), '1.3.2: second grandchild')
+
+        grandchild = Syllabus.objects.get(text='first grandchild')
+        grandchild.move_to(Syllabus.objects.get(text='second child'))
+        self.assertEqual(str(Syllabus.objects.get(text='first grandchild')), '1.2.1: first grandchild')
+
+        Syllabus.objects.all().update(full_identifier='')
+        Syllabus.objects.rebuild()
+        self.assertEqual(str(Syllabus.objects.get(text='second grandchild')), '1.3.2: second grandchild')
+
 
 def setUpSyllabus():
     root, created = Syllabus.objects.get_or_create(text='root',
@@ -319,6 +342,72 @@ class SittingTestCase(TestCase):
 
         self.assertEqual(Mark.objects.filter(student=skinner_student).count(), 3)
 
+    def test_sync_exam_marks(self):
+        """ Marks are synced across every sitting of an exam with a fixed number of queries. """
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        q1, q2 = setUpQuestion()
+        first = Sitting.objects.create(exam=q1.exam)
+        second = Sitting.objects.create(exam=q1.exam)
+        first.students.add(skinner_student, chalke_student)
+        second.students.add(chalke_student)
+        self.assertEqual(Mark.objects.filter(sitting__exam=q1.exam).count(), 6)
+
+        Mark.objects.filter(sitting=first, student=skinner_student).delete()
+        # Sittings, questions, students, existing marks and the insert:
+        with self.assertNumQueries(5):
+            sync_exam_marks(q1.exam)
+        self.assertEqual(Mark.objects.filter(sitting__exam=q1.exam).count(), 6)
+        self.assertEqual(Mark.objects.filter(sitting=first, student=skinner_student).count(), 2)
+
+    def test_save_scores(self):
+        """ A grid of scores is validated up front and saved with one ratings recalculation. """
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        q1, q2 = setUpQuestion()
+        hb1.students.add(skinner_student)
+        sitting = Sitting.objects.create(exam=q1.exam, group=hb1)
+
+        # One bad score means nothing is saved:
+        saved, errors = sitting.save_scores([(chalke_student.pk, q1.pk, 1),
+                                             (skinner_student.pk, q2.pk, q2.max_score + 1)])
+        self.assertEqual(saved, 0)
+        self.assertEqual(len(errors), 1)
+        self.assertFalse(Mark.objects.filter(sitting=sitting, score__isnull=False).exists())
+
+        saved, errors = sitting.save_scores([(chalke_student.pk, q1.pk, 1),
+                                             (chalke_student.pk, q2.pk, ''),
+                                             (skinner_student.pk, q2.pk, q2.max_score)])
+        self.assertEqual((saved, errors), (2, []))
+        self.assertEqual(Mark.objects.get(sitting=sitting, student=chalke_student, question=q1).score, 1)
+        self.assertTrue(StudentSyllabusAssessmentRecord.objects.filter(sitting=sitting,
+                                                                       student=skinner_student).exists())
+
+    def test_mark_grid(self):
+        """ The results grid comes from one query, creating missing marks in bulk. """
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        q1, q2 = setUpQuestion()
+        hb1.students.add(skinner_student)
+        sitting = Sitting.objects.create(exam=q1.exam, group=hb1)
+        Mark.objects.create(student=chalke_student, question=q1, sitting=sitting, score=1)
+        Mark.objects.create(student=skinner_student, question=q1, sitting=sitting, score=0)
+        Mark.objects.create(student=chalke_student, question=q2, sitting=sitting, score=2)
+        students = list(hb1.students.all())
+        questions = [q1, q2]
+
+        grid = sitting.mark_grid(students, questions)
+        self.assertEqual(len(grid), 4)
+        self.assertIsNone(grid[(skinner_student.pk, q2.pk)].score)
+        with self.assertNumQueries(1):
+            self.assertEqual(grid, sitting.mark_grid(students, questions))
+
+        totals = sitting.student_totals(students)
+        averages = sitting.question_average_pcs(questions)
+        for student in students:
+            self.assertEqual(totals[student.pk], sitting.student_total(student))
+        for question in questions:
+            self.assertEqual(averages[question.pk],
+                             question.average_pc(cohort=sitting.student_qs(),
+                                                 sittings=Sitting.objects.filter(pk=sitting.pk)))
+
 
 def setUpSitting(require_self_assessment=False):
     bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
@@ -678,6 +767,255 @@ class StudentSyllabusAssessmentRecordTestCase(TestCase):
         self.assertEqual(older.rating, 0)
 
 
+    def test_bulk_recalculation(self):
+        """ Marks saved with bypass_ratings are picked up by a single recalculation
+        for the whole sitting, and give the same records as saving one at a time."""
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        q1, q2 = setUpQuestion()
+        sitting = Sitting.objects.create(exam=q1.exam)
+
+        # Skinner is entered one mark at a time:
+        Mark.objects.create(student=skinner_student, question=q1, sitting=sitting, score=1)
+        Mark.objects.create(student=skinner_student, question=q2, sitting=sitting, score=2)
+
+        # Chalke is imported in bulk:
+        Mark(student=chalke_student, question=q1, sitting=sitting, score=1).save(bypass_ratings=True)
+        Mark(student=chalke_student, question=q2, sitting=sitting, score=2).save(bypass_ratings=True)
+        self.assertEqual(StudentSyllabusAssessmentRecord.objects.filter(student=chalke_student).count(), 0)
+
+        recalculate_assessment_records([(chalke_student, sitting)])
+
+        fields = ['syllabus_point', 'order', 'most_recent'] + ASSESSMENT_RECORD_CALCULATED_FIELDS
+        skinner = list(StudentSyllabusAssessmentRecord.objects.filter(student=skinner_student).
+                       order_by('syllabus_point').values_list(*fields))
+        chalke = list(StudentSyllabusAssessmentRecord.objects.filter(student=chalke_student).
+                      order_by('syllabus_point').values_list(*fields))
+        self.assertEqual(len(chalke), 3)  # root, first child and second child
+        self.assertEqual(skinner, chalke)
+
+        root = StudentSyllabusAssessmentRecord.objects.get(student=chalke_student,
+                                                           syllabus_point__text='root')
+        self.assertEqual(root.attempted_plus_children, 5)
+        self.assertEqual(root.correct_plus_children, 3)
+        self.assertEqual(root.rating, 3)
+        # first child 1/3, second child 2/2, root 3/5:
+        self.assertEqual([root.children_0_1, root.children_1_2, root.children_2_3, root.children_3_4,
+                          root.children_4_5], [0, 1, 1, 0, 1])
+
+        # Recalculating again when nothing has changed writes nothing:
+        self.assertEqual(recalculate_assessment_records([(chalke_student, sitting)]), 0)
+
+    @override_settings(DEFER_RATING_UPDATES=True)
+    def test_deferred_rating_updates(self):
+        """ With DEFER_RATING_UPDATES, saving marks only queues the recalculation
+        until the queue is flushed. """
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        q1, q2 = setUpQuestion()
+        sitting = Sitting.objects.create(exam=q1.exam)
+
+        m1 = Mark.objects.create(student=skinner_student, question=q1, sitting=sitting, score=1)
+        m1.score = 3
+        m1.save()
+        Mark.objects.create(student=skinner_student, question=q2, sitting=sitting, score=2)
+
+        # Saving the same mark twice only queues it once:
+        self.assertEqual(PendingRatingUpdate.objects.count(), 2)
+        self.assertEqual(StudentSyllabusAssessmentRecord.objects.count(), 0)
+        self.assertFalse(sitting.ratings_up_to_date())
+
+        self.assertEqual(flush_rating_updates(), 1)
+        self.assertTrue(sitting.ratings_up_to_date())
+        root = StudentSyllabusAssessmentRecord.objects.get(student=skinner_student,
+                                                           syllabus_point__text='root')
+        self.assertEqual(root.percentage, 100)
+
+    def test_student_ratings_match_records(self):
+        """ The in-memory calculator gives the same values as the stored records,
+        including after a sitting that resets ratings and with a date cut-off. """
+        student = Student.objects.create()
+        r = Syllabus.objects.create(text='r')
+        c1 = Syllabus.objects.create(parent=r, text='c1')
+        g1 = Syllabus.objects.create(parent=c1, text='g1')
+        g2 = Syllabus.objects.create(parent=c1, text='g2')
+        c2 = Syllabus.objects.create(parent=r, text='c2')
+
+        e1 = Exam.objects.create()
+        q1 = Question.objects.create(exam=e1, order=1, number='1', max_score=5)
+        q1.syllabus_points.add(g1)
+        q2 = Question.objects.create(exam=e1, order=2, number='2', max_score=3)
+        q2.syllabus_points.add(g2, c2)
+        s1 = Sitting.objects.create(exam=e1, date=datetime.date.today() - datetime.timedelta(days=7))
+        s2 = Sitting.objects.create(exam=e1, resets_ratings=True)
+        Mark.objects.create(student=student, question=q1, sitting=s1, score=1)
+        Mark.objects.create(student=student, question=q2, sitting=s1, score=3)
+        Mark.objects.create(student=student, question=q1, sitting=s2, score=4)
+
+        fields = ASSESSMENT_RECORD_CALCULATED_FIELDS
+        for sitting, date in [(s2, None), (s1, s1.date)]:
+            points, results = r.student_ratings(student, date=date)
+            self.assertEqual([point.text for point in points], ['r', 'c1', 'g1', 'g2', 'c2'])
+            for i, point in enumerate(points):
+                record = StudentSyllabusAssessmentRecord.objects.filter(student=student,
+                                                                        syllabus_point=point,
+                                                                        sitting__date__lte=sitting.date).\
+                    order_by('-order').first()
+                self.assertEqual([record.__dict__[field] for field in fields],
+                                 [results[field][i] for field in fields])
+
+    def test_group_rollups(self):
+        """ The group rollups match cohort_stats for the group's students, and follow
+        changes to marks and to group membership. """
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        q1, q2 = setUpQuestion()
+        root = Syllabus.objects.get(text='root')
+        sitting = Sitting.objects.create(exam=q1.exam, group=hb1)
+        Mark.objects.create(student=chalke_student, question=q1, sitting=sitting, score=1)
+        Mark.objects.create(student=chalke_student, question=q2, sitting=sitting, score=2)
+        Mark.objects.create(student=skinner_student, question=q1, sitting=sitting, score=3)
+
+        def check(students):
+            for sittings in [False, Sitting.objects.filter(pk=sitting.pk)]:
+                stats = root.group_rollup_stats(TeachingGroup.objects.filter(pk=hb1.pk), sittings)
+                for point in root.get_descendants(include_self=True):
+                    expected = point.cohort_stats(students, sittings)
+                    if expected['rating'] is None:
+                        self.assertNotIn(point.pk, stats)
+                    else:
+                        self.assertEqual(stats[point.pk], expected)
+
+        # Only Chalke is in hb1:
+        check(hb1.students.all())
+        self.assertEqual(root.group_rollup_stats(TeachingGroup.objects.filter(pk=hb1.pk))[root.pk]['rating'], 3)
+
+        hb1.students.add(skinner_student)
+        check(hb1.students.all())
+
+        m = Mark.objects.get(student=skinner_student, question=q1)
+        m.score = 0
+        m.save()
+        check(hb1.students.all())
+
+        # Students in more than one of the groups are only counted once:
+        hb2 = TeachingGroup.objects.create(name='hb2', syllabus=hb1.syllabus)
+        hb2.students.add(chalke_student)
+        both = TeachingGroup.objects.filter(pk__in=[hb1.pk, hb2.pk])
+        self.assertEqual(root.group_rollup_stats(both),
+                         Syllabus.objects.cohort_stats_tree(root, hb1.students.all()))
+        self.assertEqual(root.group_rollup_stats(both)[root.pk], root.cohort_stats(hb1.students.all()))
+
+        # Deleting the sitting removes its records from the most recent rollups:
+        sitting.delete()
+        self.assertEqual(root.group_rollup_stats(TeachingGroup.objects.filter(pk=hb1.pk)), {})
+
+    def test_cohort_stats_tree(self):
+        """ cohort_stats_tree gives the same statistics as cohort_stats for every point,
+        in a constant number of queries. """
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        q1, q2 = setUpQuestion()
+        root = Syllabus.objects.get(text='root')
+        s1 = Sitting.objects.create(exam=q1.exam, date=datetime.date.today() - datetime.timedelta(days=1))
+        s2 = Sitting.objects.create(exam=q1.exam)
+        Mark.objects.create(student=chalke_student, question=q1, sitting=s1, score=1)
+        Mark.objects.create(student=chalke_student, question=q2, sitting=s2, score=2)
+        Mark.objects.create(student=skinner_student, question=q1, sitting=s2, score=3)
+        StudentSyllabusAssessmentRecord.objects.create(student=skinner_student,
+                                                       syllabus_point=root,
+                                                       rating=2,
+                                                       self_assessment=True,
+                                                       exam_assessment=False)
+
+        students = Student.objects.all()
+        points = list(root.get_descendants(include_self=True))
+        for sittings, include_self_assessment in [(False, False),
+                                                  ([s1], False),
+                                                  (False, True)]:
+            with self.assertNumQueries(1):
+                stats = Syllabus.objects.cohort_stats_tree(root, students, sittings, include_self_assessment)
+            for point in points:
+                expected = point.cohort_stats(students, sittings, include_self_assessment)
+                self.assertEqual(stats.get(point.pk, dict.fromkeys(expected)), expected)
+
+    def test_ratings_pc_by_range(self):
+        """ The batched rating ranges match ratings_pc_between_range for each group and student. """
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        q1, q2 = setUpQuestion()
+        hb2 = TeachingGroup.objects.create(name='10A/Hb2', subject=herbology)
+        hb2.students.add(skinner_student)
+        sitting = Sitting.objects.create(exam=q1.exam)
+        Mark.objects.create(student=chalke_student, question=q1, sitting=sitting, score=1)
+        Mark.objects.create(student=chalke_student, question=q2, sitting=sitting, score=2)
+        Mark.objects.create(student=skinner_student, question=q1, sitting=sitting, score=0)
+
+        groups = TeachingGroup.objects.filter(pk__in=[hb1.pk, hb2.pk])
+        sittings = Sitting.objects.all()
+        students = Student.objects.all()
+        points = Syllabus.objects.get(text='root').get_descendants()
+
+        by_group = ratings_pc_by_range(groups, 'group', sittings, students, points)
+        by_student = ratings_pc_by_range(groups, 'student', sittings, students, points)
+        for group in groups:
+            self.assertEqual(by_group[group.pk],
+                             [group.ratings_pc_between_range(low, high, sittings, students, points)
+                              for low, high in RATING_RANGES])
+            for student in group.students.all():
+                student_qs = Student.objects.filter(pk=student.pk)
+                self.assertEqual(by_student[student.pk],
+                                 [group.ratings_pc_between_range(low, high, sittings, student_qs, points)
+                                  for low, high in RATING_RANGES])
+        self.assertEqual(by_group[hb2.pk], [100, 0, 0, 0, 0])
+
+    def test_sitting_rating_series(self):
+        """ The time series matches avg_syllabus_rating() for each sitting, from one query. """
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        q1, q2 = setUpQuestion()
+        root = Syllabus.objects.get(text='root')
+        first = Sitting.objects.create(exam=q1.exam, group=hb1, date=datetime.date(2021, 1, 1))
+        second = Sitting.objects.create(exam=q1.exam, group=hb1, date=datetime.date(2021, 2, 1))
+        Mark.objects.create(student=chalke_student, question=q1, sitting=first, score=1)
+        Mark.objects.create(student=skinner_student, question=q1, sitting=first, score=0)
+        Mark.objects.create(student=chalke_student, question=q1, sitting=second, score=2)
+        Mark.objects.create(student=chalke_student, question=q2, sitting=second, score=1)
+
+        students = Student.objects.all()
+        with self.assertNumQueries(1):
+            series = sitting_rating_series(root, Sitting.objects.all(), students)
+        self.assertEqual([(pk, rating) for pk, date, group, exam, rating in series],
+                         [(first.pk, first.avg_syllabus_rating(root, students)),
+                          (second.pk, second.avg_syllabus_rating(root, students))])
+        self.assertEqual(series[0][1:4], (first.date, hb1.name, q1.exam.name))
+
+        # Downsampled, the run is reported as its last sitting with the mean rating:
+        downsampled = sitting_rating_series(root, Sitting.objects.all(), students, max_points=1)
+        self.assertEqual(len(downsampled), 1)
+        self.assertEqual(downsampled[0][:4], series[1][:4])
+        self.assertAlmostEqual(downsampled[0][4], (series[0][4] + series[1][4]) / 2, delta=0.1)
+
+    def test_mistake_cohort_totals_tree(self):
+        """ The grouped mistake totals match Mistake.cohort_totals(), and roll up when asked. """
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        q1, q2 = setUpQuestion()
+        sitting = Sitting.objects.create(exam=q1.exam, group=hb1)
+        careless = Mistake.objects.create(mistake_type='Careless')
+        units = Mistake.objects.create(mistake_type='Units', parent=careless)
+        reading = Mistake.objects.create(mistake_type='Misread question')
+        mark = Mark.objects.create(student=chalke_student, question=q1, sitting=sitting, score=1)
+        mark.mistakes.add(careless, units)
+        mark = Mark.objects.create(student=skinner_student, question=q1, sitting=sitting, score=0)
+        mark.mistakes.add(units)
+
+        syllabus = Syllabus.objects.get(text='root').get_descendants()
+        with self.assertNumQueries(2):
+            totals = Mistake.objects.cohort_totals_tree(Student.objects.all(), syllabus, Sitting.objects.all())
+        for mistake in Mistake.objects.all():
+            self.assertEqual(totals[mistake.pk],
+                             mistake.cohort_totals(Student.objects.all(), syllabus, Sitting.objects.all()))
+        self.assertEqual(totals[reading.pk], 0)
+
+        rolled_up = Mistake.objects.cohort_totals_tree(Student.objects.all(), syllabus, Sitting.objects.all(),
+                                                       include_descendants=True)
+        self.assertEqual(rolled_up[careless.pk], totals[careless.pk] + totals[units.pk])
+        self.assertEqual(rolled_up[units.pk], totals[units.pk])
+
 class CollectRatingsTestCase(TestCase):
     def test_ratings(self):
         student = Student.objects.create()
@@ -1173,6 +1511,26 @@ class TimetableTestCase(TestCase):
         self.assertEqual(datetime.date.today() + datetime.timedelta(weeks=11),
                          CalendaredPeriod.objects.get(order=0).date)
 
+    def test_build_calendar(self):
+        """ The calendar is built in bulk with the right dates, and building it again adds nothing. """
+        year = AcademicYear.objects.create(name='test year 3', order=2, current=False,
+                                           first_monday=datetime.date(2030, 9, 2), total_weeks=3)
+        for order in range(5):
+            Day.objects.create(order=order, name='day' + str(order), year=year)
+        for order in range(6):
+            Period.objects.create(order=order, name=str(order + 1), year=year)
+
+        set_up_slots(year)
+        set_up_slots(year)
+        self.assertEqual(TTSlot.objects.filter(year=year).count(), 30)
+        self.assertEqual(Week.objects.filter(year=year).count(), 3)
+        self.assertEqual(CalendaredPeriod.objects.filter(year=year).count(), 90)
+        last = CalendaredPeriod.objects.filter(year=year).order_by('order').last()
+        self.assertEqual((last.order, last.date, last.period), (89, datetime.date(2030, 9, 20), '6'))
+
+        add_calendar_weeks(year, 1)
+        self.assertEqual(CalendaredPeriod.objects.filter(year=year, week__number=3).count(), 30)
+
     def test_add_lesson(self):
         Lesson.objects.all().delete()
         tg1 = TeachingGroup.objects.get(name='tg1')
@@ -1563,6 +1921,152 @@ class TimetableTestCase(TestCase):
                          CalendaredPeriod.objects.get(date=datetime.date.today() + datetime.timedelta(weeks=13, days=1),
                                                       tt_slot__period=Period.objects.get(name='2')))
 
+    def test_reslot_lessons(self):
+        """ A group's lessons are slotted in one pass, skipping suspended periods, and unmoved lessons aren't saved. """
+        tg3 = TeachingGroup.objects.get(name='tg3')
+        Lesson.objects.all().delete()
+        Suspension.objects.create(date=datetime.date.today() + datetime.timedelta(weeks=11, days=1),
+                                  whole_school=True,
+                                  period=Period.objects.get(name='1'))
+        Lesson.objects.bulk_create([Lesson(teachinggroup=tg3, order=order) for order in range(4)])
+
+        slots = reslot_lessons([tg3])
+        lessons = list(Lesson.objects.filter(teachinggroup=tg3).order_by('order'))
+        self.assertEqual([lesson.slot.date for lesson in lessons],
+                         [datetime.date.today() + datetime.timedelta(weeks=11),
+                          datetime.date.today() + datetime.timedelta(weeks=12),
+                          datetime.date.today() + datetime.timedelta(weeks=12, days=1),
+                          datetime.date.today() + datetime.timedelta(weeks=13)])
+        self.assertEqual(slots, {lesson.pk: lesson.slot_id for lesson in lessons})
+
+        # Nothing has moved, so only the lessons and the periods are read:
+        with self.assertNumQueries(2):
+            reslot_lessons([tg3])
+
+    def test_suspend_periods(self):
+        """ Suspending a range of days suspends each period in it, and moves only the suspended groups' lessons. """
+        tg3 = TeachingGroup.objects.get(name='tg3')
+        tg4 = TeachingGroup.objects.get(name='tg4')
+        Suspension.objects.all().delete()
+        Lesson.objects.all().delete()
+        Lesson.objects.bulk_create([Lesson(teachinggroup=group, order=order)
+                                    for group in [tg3, tg4] for order in range(4)])
+        reslot_lessons([tg3, tg4])
+
+        start = datetime.date.today() + datetime.timedelta(weeks=12)
+        suspensions = suspend_periods(start, start + datetime.timedelta(days=6), 'Trip', teachinggroups=[tg3])
+        # Two days with two periods each:
+        self.assertEqual(len(suspensions), 4)
+        self.assertEqual(Suspension.objects.filter(teachinggroups=tg3, reason='Trip').count(), 4)
+
+        def lesson_dates(group):
+            return [lesson.slot.date for lesson in Lesson.objects.filter(teachinggroup=group).order_by('order')]
+
+        self.assertEqual(lesson_dates(tg3), [datetime.date.today() + datetime.timedelta(weeks=11),
+                                             datetime.date.today() + datetime.timedelta(weeks=11, days=1),
+                                             datetime.date.today() + datetime.timedelta(weeks=13),
+                                             datetime.date.today() + datetime.timedelta(weeks=13, days=1)])
+        self.assertEqual(lesson_dates(tg4)[2], start)
+
+        suspend_periods(start, start, 'Closure', whole_school=True)
+        self.assertEqual(lesson_dates(tg4)[2], start + datetime.timedelta(days=1))
+
+    def test_build_week_grid(self):
+        """ A teacher's week is laid out from one query each for the periods, lessons and suspensions. """
+        from GreenPen.views import build_week_grid
+
+        tg3 = TeachingGroup.objects.get(name='tg3')
+        user = User.objects.create(first_name='Joe', last_name='Bloggs', email='joe@school.com',
+                                   username='joe@school.com')
+        user.groups.add(Group.objects.get_or_create(name='Teachers')[0])
+        teacher = Teacher.objects.create(user=user, staff_code='JBL', title='Mrs')
+        tg3.teachers.add(teacher)
+        Lesson.objects.all().delete()
+        Lesson.objects.bulk_create([Lesson(teachinggroup=tg3, order=order, title='Lesson ' + str(order))
+                                    for order in range(4)])
+        reslot_lessons([tg3])
+        Suspension.objects.create(date=datetime.date.today() + datetime.timedelta(weeks=11, days=1),
+                                  whole_school=True, reason='Sports day', period=Period.objects.get(name='2'))
+        start = CalendaredPeriod.objects.get(date=datetime.date.today() + datetime.timedelta(weeks=11),
+                                             tt_slot__period=Period.objects.get(name='1'))
+
+        with self.assertNumQueries(7):
+            grid = build_week_grid(start, teacher)
+        self.assertEqual([period.name for period in grid[0]], ['1', '2'])
+        self.assertEqual([lesson.title for lesson in grid[1][1]['lessons']], ['Lesson 0'])
+        self.assertEqual(grid[1][2], {'lessons': False, 'suspensions': False, 'slot': CalendaredPeriod.objects.get(
+            date=start.date, tt_slot__period=Period.objects.get(name='2'))})
+        self.assertEqual([lesson.title for lesson in grid[2][1]['lessons']], ['Lesson 1'])
+        self.assertEqual([suspension.reason for suspension in grid[2][2]['suspensions']], ['Sports day'])
+
+        Group.objects.get_or_create(name='Students')
+        self.client.force_login(user)
+        response = self.client.get(reverse('tt_overview', args=[start.pk, teacher.pk]))
+        self.assertContains(response, 'Lesson 1')
+        self.assertContains(response, 'Sports day')
+
+    def test_timetable_index(self):
+        """ The year's timetable is indexed once and cached until a lesson or suspension changes. """
+        tg3 = TeachingGroup.objects.get(name='tg3')
+        user = User.objects.create(first_name='Joe', last_name='Bloggs', email='joe@school.com',
+                                   username='joe@school.com')
+        user.groups.add(Group.objects.get_or_create(name='Teachers')[0])
+        Group.objects.get_or_create(name='Students')
+        teacher = Teacher.objects.create(user=user, staff_code='JBL', title='Mrs')
+        tg3.teachers.add(teacher)
+        Lesson.objects.all().delete()
+        Lesson.objects.bulk_create([Lesson(teachinggroup=tg3, order=order, title='Lesson ' + str(order))
+                                    for order in range(3)])
+        reslot_lessons([tg3])
+        Suspension.objects.create(date=datetime.date.today() + datetime.timedelta(weeks=11, days=1),
+                                  whole_school=True, reason='Sports day', period=Period.objects.get(name='2'))
+        first_day = datetime.date.today() + datetime.timedelta(weeks=11)
+
+        timetable = teacher_timetable(teacher, first_day, first_day + datetime.timedelta(days=1))
+        self.assertEqual([(date, period, [lesson['title'] for lesson in lessons], suspensions)
+                          for date, period, lessons, suspensions in timetable],
+                         [(first_day, '1', ['Lesson 0'], []),
+                          (first_day, '2', [], []),
+                          (first_day + datetime.timedelta(days=1), '1', ['Lesson 1'], []),
+                          (first_day + datetime.timedelta(days=1), '2', [], ['Sports day'])])
+
+        # Served from the cache, apart from the year and the teacher's groups:
+        with override_settings(SHARED_CACHE=True):
+            teacher_timetable(teacher)
+            with self.assertNumQueries(2):
+                teacher_timetable(teacher)
+        # Without a shared cache, another process may have changed the timetable:
+        with override_settings(SHARED_CACHE=False):
+            with self.assertNumQueries(7):
+                teacher_timetable(teacher)
+
+        lesson = Lesson.objects.get(teachinggroup=tg3, order=0)
+        lesson.title = 'Renamed'
+        lesson.save()
+        self.assertEqual(teacher_timetable(teacher, first_day, first_day)[0][2][0]['title'], 'Renamed')
+
+        self.client.force_login(user)
+        response = self.client.get(reverse('tt_year', args=[teacher.pk]))
+        self.assertContains(response, 'Sports day')
+        response = self.client.get(reverse('tt_export', args=[teacher.pk, 'csv']))
+        self.assertContains(response, 'Lesson 1')
+        response = self.client.get(reverse('tt_export', args=[teacher.pk, 'ics']),
+                                   {'start': first_day.isoformat(), 'end': first_day.isoformat()})
+        self.assertContains(response, 'SUMMARY:P1 tg3: Renamed')
+        self.assertContains(response, 'UID:greenpen-lesson-{}@'.format(lesson.pk))
+        self.assertNotContains(response, 'Lesson 1')
+
+        # Long lines are folded:
+        from GreenPen.views import ical_text
+        lesson.description = 'Recap of the last topic, with an extended writing task. ' * 3
+        lesson.save()
+        response = self.client.get(reverse('tt_export', args=[teacher.pk, 'ics']),
+                                   {'start': first_day.isoformat(), 'end': first_day.isoformat()})
+        lines = response.content.split(b'\r\n')
+        self.assertTrue(all(len(line) <= 75 for line in lines))
+        unfolded = response.content.decode().replace('\r\n ', '')
+        self.assertIn('DESCRIPTION:' + ical_text(lesson.description), unfolded)
+
     def test_removing_classgroup(self):
         """
         Check that when we remove a teaching group from suspension list of
@@ -2125,3 +2629,462 @@ class SelfAssessmentTest(TestCase):
 
 
 
+
+
+class DashCallbackCacheTestCase(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+
+    def test_cached_callback(self):
+        """ Responses are reused for the same inputs and scope, until the subject's marks change. """
+        from types import SimpleNamespace
+        from GreenPen.dash_apps.callback_cache import cached_callback
+
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        q1, q2 = setUpQuestion()
+        sitting = Sitting.objects.create(exam=q1.exam, group=hb1)
+        teachers, created = Group.objects.get_or_create(name='Teachers')
+        students, created = Group.objects.get_or_create(name='Students')
+        bloggs_teacher.user.groups.add(teachers)
+        tubbs_teacher.user.groups.add(teachers)
+        skinner_student.user.groups.add(students)
+
+        calls = []
+
+        @cached_callback(timeout=60)
+        def callback(*args, **kwargs):
+            calls.append(kwargs['user'])
+            return {'data': [{'x': [datetime.date(2021, 1, 1)], 'y': [len(calls)]}]}
+
+        subject = q1.syllabus_points.first()
+        context = SimpleNamespace(inputs={'subject-dropdown.value': subject.pk}, states={})
+        first = callback(callback_context=context, user=bloggs_teacher.user)
+        # Another teacher asking for the same thing gets the cached response:
+        self.assertEqual(callback(callback_context=context, user=tubbs_teacher.user), first)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(first['data'][0]['x'], ['2021-01-01'])
+
+        # Students have their own scope:
+        callback(callback_context=context, user=skinner_student.user)
+        self.assertEqual(len(calls), 2)
+
+        # A teacher who is also in the Students group is scoped as a student, as
+        # the dashboards only show them their own data:
+        tubbs_teacher.user.groups.add(students)
+        callback(callback_context=context, user=tubbs_teacher.user)
+        self.assertEqual(len(calls), 3)
+        tubbs_teacher.user.groups.remove(students)
+
+        # As do different inputs:
+        other = SimpleNamespace(inputs={'subject-dropdown.value': subject.pk, 'student-dropdown.value': 1},
+                                states={})
+        callback(callback_context=other, user=bloggs_teacher.user)
+        self.assertEqual(len(calls), 4)
+
+        # Saving a mark in the subject bumps its data version:
+        Mark.objects.create(student=chalke_student, question=q1, sitting=sitting, score=1)
+        self.assertNotEqual(callback(callback_context=context, user=bloggs_teacher.user), first)
+        self.assertEqual(len(calls), 5)
+
+        # As does a student's self-assessment:
+        version = data_version(subject.tree_id)
+        StudentSyllabusAssessmentRecord.objects.create(student=skinner_student, syllabus_point=subject,
+                                                       self_assessment=True, exam_assessment=False, rating=4)
+        self.assertNotEqual(data_version(subject.tree_id), version)
+
+    def test_shared_cache_check(self):
+        """ Deferring rating updates without a shared cache is warned about. """
+        with override_settings(DEFER_RATING_UPDATES=True, SHARED_CACHE=False):
+            self.assertEqual([warning.id for warning in check_shared_cache(None)], ['GreenPen.W001'])
+        with override_settings(DEFER_RATING_UPDATES=True, SHARED_CACHE=True):
+            self.assertEqual(check_shared_cache(None), [])
+
+
+class CSVImportTestCase(TestCase):
+    def write_csv(self, rows):
+        import csv
+        import tempfile
+        csvfile = tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False)
+        self.addCleanup(os.remove, csvfile.name)
+        writer = csv.writer(csvfile)
+        writer.writerows(rows)
+        csvfile.close()
+        return csvfile.name
+
+    def test_import_marks_from_csv(self):
+        """ Marks are imported in chunks, leaving existing scores alone, and ratings are recalculated. """
+        from GreenPen.functions.imports import ImportStatus, import_marks_from_csv, import_sittings_from_csv
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        q1, q2 = setUpQuestion()
+        skinner_student.student_id = 101
+        skinner_student.save()
+        chalke_student.student_id = 102
+        chalke_student.save()
+
+        path = self.write_csv([['exam', 'sitting', 'group', 'date'],
+                               [q1.exam.pk, 50, hb1.pk, '2021-03-01'],
+                               [q1.exam.pk, 51, 999, '2021-03-01']])
+        status = import_sittings_from_csv(path)
+        self.assertEqual((status.created, len(status.errors)), (1, 1))
+        sitting = Sitting.objects.get(pk=50)
+        self.assertEqual(sitting.group, hb1)
+
+        Mark.objects.create(student=chalke_student, question=q2, sitting=sitting, score=2)
+        blank = Mark.objects.create(student=skinner_student, question=q1, sitting=sitting)
+        path = self.write_csv([['question', 'student', 'score', 'sitting', 'notes'],
+                               [q1.pk, 101, 1, sitting.pk, ''],
+                               [q2.pk, 101, 0, sitting.pk, 'Careless'],
+                               [q2.pk, 102, 0, sitting.pk, ''],
+                               [q1.pk, 102, 'absent', sitting.pk, ''],
+                               [q1.pk, 999, 1, sitting.pk, '']])
+        progress = []
+        status = import_marks_from_csv(path, chunk_size=2, status=ImportStatus(callback=progress.append))
+        self.assertEqual((status.rows, status.created, status.updated, status.skipped, len(status.errors)),
+                         (5, 1, 1, 2, 1))
+        # Marks without a score are filled in, in place:
+        blank.refresh_from_db()
+        self.assertEqual(blank.score, 1)
+        self.assertTrue(status.finished)
+        self.assertEqual(len(progress), 4)
+        self.assertEqual(Mark.objects.get(student=chalke_student, question=q2, sitting=sitting).score, 2)
+        self.assertEqual(Mark.objects.get(student=skinner_student, question=q2, sitting=sitting).student_notes,
+                         'Careless')
+        self.assertTrue(StudentSyllabusAssessmentRecord.objects.filter(student=skinner_student,
+                                                                       sitting=sitting).exists())
+
+    def test_import_groups_from_sims(self):
+        """ Group memberships are synced as a diff, and a dry run changes nothing. """
+        from GreenPen.functions.imports import import_groups_from_sims
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        AcademicYear.objects.create(name='2021-22', order=2, current=True, first_monday=datetime.date(2021, 8, 2),
+                                    total_weeks=40)
+        skinner_student.student_id = 101
+        skinner_student.save()
+        chalke_student.student_id = 102
+        chalke_student.save()
+        hb1.sims_name = '10A/Hb1'
+        hb1.save()
+
+        header = ['group', 'title', 'surname', 'forename', 'initials', 'email', 'student surname',
+                  'student forename', 'gender', 'student email', 'admission', 'tutor', 'year', 'rollover', 'syllabus']
+        teacher = ['Mrs', 'Bloggs', 'Joe', 'JBL', 'joe@school.com']
+        path = self.write_csv([header,
+                               ['10A/Hb1'] + teacher + ['Skinner', 'Simon', 'M', 'skinner@school.com', 101, '10Y', 10,
+                                                        '11A/Hb1', ''],
+                               ['10A/Hb2'] + teacher + ['Newton', 'Nina', 'F', 'newton@school.com', 103, '10Y', 10,
+                                                        '11A/Hb2', '']])
+
+        report = import_groups_from_sims(path, dry_run=True)
+        self.assertEqual(report.groups['10A/Hb1'], {'added': [101], 'removed': [102], 'unchanged': 0})
+        self.assertEqual((report.groups_created, report.students_created, report.users_created), (1, 1, 1))
+        self.assertEqual(list(hb1.students.all()), [chalke_student])
+        self.assertFalse(Student.objects.filter(student_id=103).exists())
+
+        report = import_groups_from_sims(path)
+        self.assertEqual(list(hb1.students.all()), [skinner_student])
+        newton = Student.objects.get(student_id=103)
+        self.assertEqual(newton.user.first_name, 'Nina')
+        self.assertTrue(newton.user.groups.filter(name='Students').exists())
+        self.assertEqual(list(TeachingGroup.objects.get(sims_name='10A/Hb2').students.all()), [newton])
+
+        # Nothing has changed, so nothing is touched the second time:
+        report = import_groups_from_sims(path)
+        self.assertEqual((report.added(), report.removed(), report.users_updated, report.students_updated,
+                          report.groups_updated), (0, 0, 0, 0, 0))
+
+
+class FakeGoogleSheets:
+    """ Stands in for a gspread client, serving fixed worksheet records. """
+
+    def __init__(self, worksheets):
+        self.worksheets = worksheets
+        self.reads = 0
+
+    def open_by_url(self, url):
+        self.reads += 1
+        return self
+
+    def worksheet(self, name):
+        return FakeWorksheet(self.worksheets[name])
+
+
+class FakeWorksheet:
+    def __init__(self, records):
+        self.records = records
+
+    def get_all_records(self):
+        return self.records
+
+
+class GQuizImportTestCase(TestCase):
+    def test_import_scores(self):
+        """ Scores are imported from the sheet in bulk, replacing blank marks and updating earlier imports. """
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        setUpSyllabus()
+        point = Syllabus.objects.get(text='first grandchild')
+        exam = GQuizExam.objects.create(name='Quiz',
+                                        master_form_url='https://docs.google.com/forms/d/abc',
+                                        master_response_sheet_url='https://docs.google.com/spreadsheets/d/abc/edit')
+        q1 = GQuizQuestion.objects.create(exam=exam, order=1, number='1', max_score=2, google_id=11, text='Q1')
+        q2 = GQuizQuestion.objects.create(exam=exam, order=2, number='2', max_score=2, google_id=12, text='Q2')
+        q1.syllabus_points.add(point)
+        q2.syllabus_points.add(point)
+        sitting = GQuizSitting.objects.create(exam=exam, group=hb1,
+                                              scores_sheet_url='https://docs.google.com/spreadsheets/d/xyz/edit')
+        sitting.students.add(chalke_student, skinner_student)
+
+        def row(student, question, score):
+            return {'Timestamp': '2021-01-01T10:00:00.000Z', 'Student Email Address': student.user.email,
+                    'ID': question.google_id, 'Maximum score': 2, 'Student Score': score,
+                    'Student Answer': 'answer', 'Teacher Feedback': 'feedback'}
+
+        sheets = FakeGoogleSheets({'Scores': [row(chalke_student, q1, 2), row(chalke_student, q2, 1),
+                                              row(skinner_student, q1, 0),
+                                              dict(row(chalke_student, q1, 2), **{'Student Email Address':
+                                                                                  'visitor@school.com'})]})
+        self.assertTrue(sitting.import_scores(client=sheets))
+        self.assertFalse(sitting.importing)
+        self.assertEqual(GQuizMark.objects.filter(sitting=sitting).count(), 3)
+        # The blank mark for skinner's second question is left alone:
+        self.assertEqual(Mark.objects.filter(sitting=sitting).count(), 4)
+        self.assertIn('You answered: answer', GQuizMark.objects.get(student=chalke_student, question=q2).student_notes)
+        self.assertTrue(StudentSyllabusAssessmentRecord.objects.filter(sitting=sitting, student=chalke_student,
+                                                                       syllabus_point=point).exists())
+
+        # A later response from one student only updates their marks:
+        sheets = FakeGoogleSheets({'Scores': [row(chalke_student, q1, 1), row(skinner_student, q1, 2)]})
+        self.assertTrue(sitting.import_scores(email=chalke_student.user.email, client=sheets))
+        self.assertEqual(GQuizMark.objects.get(student=chalke_student, question=q1).score, 1)
+        self.assertEqual(GQuizMark.objects.get(student=skinner_student, question=q1).score, 0)
+        self.assertEqual(GQuizMark.objects.filter(sitting=sitting).count(), 3)
+
+        sheets = FakeGoogleSheets({'Scores': [dict(row(chalke_student, q1, 1), **{'Maximum score': 5})]})
+        with self.assertRaises(MarkScoreError):
+            sitting.import_scores(client=sheets)
+        self.assertFalse(GQuizSitting.objects.get(pk=sitting.pk).importing)
+
+    def test_gquiz_alert(self):
+        """ The webhook queues responses straight away, and a burst of them is imported from one read of the sheet. """
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        exam = GQuizExam.objects.create(name='Quiz',
+                                        master_form_url='https://docs.google.com/forms/d/abc',
+                                        master_response_sheet_url='https://docs.google.com/spreadsheets/d/abc/edit')
+        q1 = GQuizQuestion.objects.create(exam=exam, order=1, number='1', max_score=2, google_id=11, text='Q1')
+        url = 'https://docs.google.com/spreadsheets/d/xyz/edit'
+        sitting = GQuizSitting.objects.create(exam=exam, group=hb1, scores_sheet_url=url)
+        sitting.students.add(chalke_student, skinner_student)
+
+        def alert(form_url, student, timestamp='2021-01-01T10:00:00.000Z'):
+            return self.client.post('/gquizalert', json.dumps({'form_url': form_url,
+                                                               'student_email': student.user.email,
+                                                               'timestamp': timestamp}),
+                                    content_type='application/json')
+
+        self.assertEqual(alert(url, chalke_student).status_code, 202)
+        self.assertEqual(alert(url, chalke_student, '2021-01-01T10:05:00.000Z').status_code, 202)
+        self.assertEqual(alert(url, skinner_student).status_code, 202)
+        self.assertEqual(alert('https://docs.google.com/spreadsheets/d/other/edit', skinner_student).status_code, 404)
+        self.assertEqual(self.client.post('/gquizalert', '{"form_url": 1}',
+                                          content_type='application/json').status_code, 400)
+        self.assertEqual(GQuizNotification.objects.count(), 2)
+        self.assertEqual(GQuizNotification.objects.get(student_email=chalke_student.user.email).timestamp,
+                         datetime.datetime(2021, 1, 1, 10, 5))
+        job = BackgroundJob.objects.get()
+        self.assertEqual(job.task, 'import_gquiz_responses')
+
+        def row(student, score):
+            return {'Timestamp': '2021-01-01T10:00:00.000Z', 'Student Email Address': student.user.email,
+                    'ID': q1.google_id, 'Maximum score': 2, 'Student Score': score,
+                    'Student Answer': 'answer', 'Teacher Feedback': 'feedback'}
+
+        sheets = FakeGoogleSheets({'Scores': [row(chalke_student, 2), row(skinner_student, 1)]})
+        import_gquiz_responses_job(job, client=sheets)
+        self.assertEqual(sheets.reads, 1)
+        self.assertEqual(GQuizMark.objects.get(sitting=sitting, student=chalke_student).score, 2)
+        self.assertEqual(GQuizMark.objects.get(sitting=sitting, student=skinner_student).score, 1)
+        self.assertFalse(GQuizNotification.objects.exists())
+
+        # Responses to a sheet shared by several (non self-assessment) sittings
+        # can't be imported; this is recorded on the job rather than failing it:
+        GQuizSitting.objects.create(exam=exam, group=hb1, scores_sheet_url=url)
+        alert(url, chalke_student)
+        job = BackgroundJob.objects.get(status=BackgroundJob.QUEUED)
+        BackgroundJob.objects.filter(pk=job.pk).update(status=BackgroundJob.RUNNING)
+        self.assertEqual(run_job(job.pk), BackgroundJob.DONE)
+        self.assertIn(chalke_student.user.email, BackgroundJob.objects.get(pk=job.pk).error)
+        self.assertFalse(GQuizNotification.objects.exists())
+
+
+class FakeResponse:
+    """ Stands in for the requests Response that gspread errors wrap. """
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = ''
+
+    def json(self):
+        return {'error': {'code': self.status_code, 'message': 'Quota exceeded'}}
+
+
+class BackgroundJobTestCase(TestCase):
+    def test_job_queue(self):
+        """ Jobs are de-duplicated per sitting, run one at a time per sitting, and retried when rate limited. """
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        exam = GQuizExam.objects.create(name='Quiz',
+                                        master_form_url='https://docs.google.com/forms/d/abc',
+                                        master_response_sheet_url='https://docs.google.com/spreadsheets/d/abc/edit')
+        sitting = GQuizSitting.objects.create(exam=exam, group=hb1,
+                                              scores_sheet_url='https://docs.google.com/spreadsheets/d/xyz/edit')
+
+        job = enqueue_job('import_gquiz_scores', sitting=sitting)
+        self.assertEqual(enqueue_job('import_gquiz_scores', sitting=sitting), job)
+        student_job = enqueue_job('import_gquiz_scores', sitting=sitting, email=chalke_student.user.email)
+        self.assertNotEqual(student_job, job)
+        with self.assertRaises(ValueError):
+            enqueue_job('make_tea')
+
+        self.assertEqual(claim_job(), job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (BackgroundJob.RUNNING, 1))
+        # The other job for the sitting waits until this one has finished:
+        self.assertIsNone(claim_job())
+
+        def rate_limited(job):
+            raise gspread.exceptions.APIError(FakeResponse(429))
+
+        with mock.patch.dict(JOB_TASKS, {'import_gquiz_scores': rate_limited}):
+            self.assertEqual(run_job(job.pk), BackgroundJob.QUEUED)
+            job.refresh_from_db()
+            self.assertGreater(job.run_after, timezone.now())
+            # The retry isn't due yet, so the other job runs next:
+            self.assertEqual(claim_job(), student_job)
+
+            BackgroundJob.objects.filter(pk=job.pk).update(status=BackgroundJob.RUNNING,
+                                                           attempts=settings.JOB_MAX_ATTEMPTS)
+            self.assertEqual(run_job(job.pk), BackgroundJob.FAILED)
+
+        with mock.patch.dict(JOB_TASKS, {'import_gquiz_scores': lambda job: None}):
+            self.assertEqual(run_job(student_job.pk), BackgroundJob.DONE)
+
+        # Jobs left running by a worker that died are queued again:
+        job = enqueue_job('import_gquiz_scores', sitting=sitting)
+        claim_job()
+        GQuizSitting.objects.filter(pk=sitting.pk).update(importing=True)
+        BackgroundJob.objects.filter(pk=job.pk).update(
+            started=timezone.now() - datetime.timedelta(seconds=settings.JOB_TIMEOUT + 1))
+        self.assertEqual(requeue_stale_jobs(), 1)
+        self.assertEqual(BackgroundJob.objects.get(pk=job.pk).status, BackgroundJob.QUEUED)
+        self.assertFalse(GQuizSitting.objects.get(pk=sitting.pk).importing)
+
+        # Only teachers can see how jobs are getting on, as errors may include sheet details:
+        teachers, created = Group.objects.get_or_create(name='Teachers')
+        bloggs_teacher.user.groups.add(teachers)
+        self.client.force_login(chalke_student.user)
+        self.assertEqual(self.client.get(reverse('job-status', args=[job.pk])).status_code, 302)
+        self.client.force_login(bloggs_teacher.user)
+        self.assertEqual(self.client.get(reverse('job-status', args=[job.pk])).json()['status'],
+                         BackgroundJob.QUEUED)
+
+    def test_sheet_jobs(self):
+        """ Jobs that read the same Google Sheet never run at the same time. """
+        bloggs_teacher, tubbs_teacher, skinner_student, chalke_student, potions, herbology, hb1 = set_up_class()
+        exam = GQuizExam.objects.create(name='Quiz',
+                                        master_form_url='https://docs.google.com/forms/d/abc',
+                                        master_response_sheet_url='https://docs.google.com/spreadsheets/d/abc/edit')
+        url = 'https://docs.google.com/spreadsheets/d/xyz/edit'
+        sitting = GQuizSitting.objects.create(exam=exam, group=hb1, scores_sheet_url=url)
+
+        responses_job = enqueue_job('import_gquiz_responses', scores_sheet_url=url)
+        self.assertEqual(claim_job(), responses_job)
+        scores_job = enqueue_job('import_gquiz_scores', sitting=sitting)
+        next_responses_job = enqueue_job('import_gquiz_responses', scores_sheet_url=url)
+        self.assertNotEqual(next_responses_job, responses_job)
+        self.assertIsNone(claim_job())
+
+        BackgroundJob.objects.filter(pk=responses_job.pk).update(status=BackgroundJob.DONE)
+        self.assertEqual(claim_job(), scores_job)
+        # The scores job's sitting uses the sheet too:
+        self.assertIsNone(claim_job())
+
+
+class TreeJSONTestCase(TestCase):
+    def test_syllabus_json(self):
+        """ Tree nodes are built from pk sets worked out once, and a whole subtree can be sent in one response. """
+        root = setUpSyllabus()
+        grandchild = Syllabus.objects.get(text='second grandchild')
+        first_child = Syllabus.objects.get(text='first child')
+        resource = Resource.objects.create(name='Worksheet')
+        resource.syllabus.add(grandchild)
+        url = reverse('resource-syllabus-json', args=[resource.pk])
+
+        self.assertEqual(self.client.get(url, {'id': '#'}).json(),
+                         [{'id': root.pk, 'parent': '#', 'text': '1: root', 'children': True,
+                           'state': {'selected': False, 'undetermined': True, 'opened': True}}])
+
+        with self.assertNumQueries(5):
+            nodes = self.client.get(url, {'id': first_child.pk}).json()
+        self.assertEqual([(node['text'], node['parent'], node['children'], node['state']['selected'])
+                          for node in nodes],
+                         [('1: first grandchild', first_child.pk, False, False),
+                          ('2: second grandchild', first_child.pk, False, True)])
+
+        nodes = self.client.get(url, {'id': root.pk, 'subtree': 1}).json()
+        self.assertEqual([(node['text'], node['parent'], node['state']['undetermined']) for node in nodes],
+                         [('1: first child', root.pk, True),
+                          ('1: first grandchild', first_child.pk, False),
+                          ('2: second grandchild', first_child.pk, False),
+                          ('2: second child', root.pk, False)])
+
+    @override_settings(SHARED_CACHE=True)
+    def test_syllabus_json_etag(self):
+        """ Unchanged trees are answered with a 304; changing the tree or the selection changes the ETag. """
+        root = setUpSyllabus()
+        first_child = Syllabus.objects.get(text='first child')
+        grandchild = Syllabus.objects.get(text='second grandchild')
+        resource = Resource.objects.create(name='Worksheet')
+        url = reverse('resource-syllabus-json', args=[resource.pk])
+
+        response = self.client.get(url, {'id': first_child.pk})
+        etag = response['ETag']
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('no-cache', response['Cache-Control'])
+        response = self.client.get(url, {'id': first_child.pk}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Selections are laid over the cached structure:
+        resource.syllabus.add(grandchild)
+        response = self.client.get(url, {'id': first_child.pk}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([node['state']['selected'] for node in response.json()], [False, True])
+        etag = response['ETag']
+
+        grandchild.text = 'renamed grandchild'
+        grandchild.save()
+        response = self.client.get(url, {'id': first_child.pk}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[1]['text'], '2: renamed grandchild')
+        etag = response['ETag']
+
+        grandchild.move_to(root)
+        response = self.client.get(url, {'id': first_child.pk}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([node['text'] for node in response.json()], ['1: first grandchild'])
+
+        # Rebuilds don't send signals, but change the version too:
+        etag = response['ETag']
+        Syllabus.objects.partial_rebuild(root.tree_id)
+        response = self.client.get(url, {'id': first_child.pk}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        version = tree_version(Mistake)
+        Mistake.objects.rebuild()
+        self.assertNotEqual(tree_version(Mistake), version)
+
+        response = self.client.get(reverse('json_syllabus_points'), {'id': root.pk})
+        self.assertIn('public', response['Cache-Control'])
+
+        # Without a shared cache, another process may have changed the tree:
+        with override_settings(SHARED_CACHE=False):
+            response = self.client.get(url, {'id': first_child.pk}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
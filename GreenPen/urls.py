@@ -68,9 +68,11 @@ urlpatterns = [
     path('sitting/<int:sitting_pk>/', sitting_splash, name='sitting-splash'),
     path('sitting/<int:sitting_pk>/results', exam_result_view, name='exam-results'),
     path('sitting/<int:sitting_pk>/alpresults', alp_result_view, name='alp-exam-resulgats'),
+    path('sitting/<int:sitting_pk>/marks', bulk_mark_entry, name='bulk-mark-entry'),
     path('sitting/<int:sitting_pk>/delete', confirm_delete_sitting, name='delete-sitting1'),
     path('sitting/<int:sitting_pk>/confirm_delete', delete_sitting, name='delete-sitting2'),
     path('sitting/<int:sitting_pk>/import_scores', import_sitting_scores, name='import_scores'),
+    path('jobs/<int:job_pk>', job_status, name='job-status'),
     path('sitting/<int:sitting_pk>/<int:student_pk>/import1', import_student_self_assessment_scores_pt1, name='import_student_self_assessment_scores')
     ,
     path('sitting/<int:sitting_pk>/<int:student_pk>/import2', import_student_self_assessment_scores_pt2, name='import_student_self_assessment_scores_2'),
@@ -83,6 +85,8 @@ urlpatterns = [
     path('rollover/1', AcademicYearRollover.as_view(), name='rollover1'),
     path('timetable', timetable_splash, name='tt_splash'),
     path('timetable/<int:start_slot_pk>/<int:teacher_pk>', timetable_overview, name='tt_overview'),
+    path('timetable/<int:teacher_pk>/year', timetable_year, name='tt_year'),
+    path('timetable/<int:teacher_pk>/export/<str:file_format>', timetable_export, name='tt_export'),
     path('timetable/<int:slot_pk>/add', add_tt_lesson, name='add_tt_lesson'),
     path('lesson/<int:lesson_pk>/<int:return_pk>', change_lesson, name='edit_lesson'),
     path('lesson/<int:lesson_pk>/<int:return_pk>/delete', delete_lesson, name='delete_lesson'),
@@ -1,21 +1,27 @@
 from django.views.generic.list import ListView, View
+import csv
+import hashlib
+import json
 import os
-import threading
 
 import gspread
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 # For authenticating views
 from django.contrib.auth.decorators import user_passes_test
 from django.contrib.auth.mixins import UserPassesTestMixin
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.db import IntegrityError
 from django.forms import inlineformset_factory, formset_factory
 from django.forms.widgets import HiddenInput
 from django.forms import modelformset_factory
 from django.http import JsonResponse, HttpResponseForbidden, Http404, HttpResponseRedirect, HttpResponse, \
-    HttpResponseBadRequest
+    HttpResponseBadRequest, HttpResponseNotAllowed
 from django.shortcuts import redirect, render, get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic.edit import CreateView
 from django.views.generic.edit import UpdateView
@@ -136,7 +142,8 @@ def import_questions(request):
         if csvform.is_valid():
             file = csvform.save()
             path = file.document.path
-            import_questions_from_csv(path)
+            status = import_questions_from_csv(path)
+            messages.info(request, 'Import complete: ' + str(status))
             os.remove(path)
             file.delete()
             return redirect('/')
@@ -155,7 +162,8 @@ def import_sittings(request):
         if csvform.is_valid():
             file = csvform.save()
             path = file.document.path
-            import_sittings_from_csv(path)
+            status = import_sittings_from_csv(path)
+            messages.info(request, 'Import complete: ' + str(status))
             os.remove(path)
             file.delete()
             return redirect('/')
@@ -174,7 +182,8 @@ def import_marks(request):
         if csvform.is_valid():
             file = csvform.save()
             path = file.document.path
-            import_marks_from_csv(path)
+            status = import_marks_from_csv(path)
+            messages.info(request, 'Import complete: ' + str(status))
             os.remove(path)
             file.delete()
             return redirect('/')
@@ -524,46 +533,37 @@ def exam_result_view(request, sitting_pk):
     context = {}
     sitting = Sitting.objects.get(pk=sitting_pk)
 
-    try:
-        if sitting.gquizsitting.importing:
-            messages.warning(request, "Scores for this exam are currently importing. Please check back in a few minutes.")
-    except Sitting.DoesNotExist:
-        # Will occur if this is not a Google Quiz subclass.
-        pass
+    jobs = list(sitting.backgroundjob_set.filter(status__in=BackgroundJob.ACTIVE))
+    if jobs:
+        messages.warning(request, "Scores for this exam are currently importing. Please check back in a few minutes.")
+    context['jobs'] = jobs
+    if not sitting.ratings_up_to_date():
+        messages.info(request, "Ratings for this exam are still being updated. Please check back in a few minutes.")
     context['sitting'] = sitting
-    students = sitting.group.students.all().order_by('user__last_name')
+    students = list(sitting.group.students.all().select_related('user').order_by('user__last_name'))
     context['students'] = students
+    questions = list(sitting.exam.question_set.all().order_by('order'))
+    grid = sitting.mark_grid(students, questions)
+    averages = sitting.question_average_pcs(questions)
+    totals = sitting.student_totals(students)
     marks = []
 
     # Build 2D array in the stucture:
     # Question number |  Student 1 score | Student 2 score .....
     # ...
     # Total           | Student 1 total  | Student 2 total
-    for question in sitting.exam.question_set.all().order_by('order'):
+    for question in questions:
         row = []
         row.append(question)
         for student in students:
-            try:
-                row.append(Mark.objects.get(sitting=sitting,
-                                            student=student,
-                                            question=question,
-                                            ))
-            except ObjectDoesNotExist:
-                # creating lots of marks can overload the server,
-                # so we will only create the first mark for each student.
-                if question.order == 1:
-                    row.append(Mark.objects.create(sitting=sitting,
-                                                   student=student,
-                                                   question=question))
-
-                row.append('')
+            row.append(grid[(student.pk, question.pk)])
         # Iterated through all scores, so lets add the average.
-        row.append(question.average_pc(cohort=sitting.student_qs(), sittings=Sitting.objects.filter(pk=sitting.pk)))
+        row.append(averages[question.pk])
         marks.append(row)
 
     lastrow = ['Total']
     for student in students:
-        lastrow.append(sitting.student_total(student))
+        lastrow.append(totals.get(student.pk))
     context['lastrow'] = lastrow
     context['marks'] = marks
 
@@ -574,34 +574,27 @@ def exam_result_view(request, sitting_pk):
 def alp_result_view(request, sitting_pk):
     context = {}
     sitting = Sitting.objects.get(pk=sitting_pk)
+    if not sitting.ratings_up_to_date():
+        messages.info(request, "Ratings for this exam are still being updated. Please check back in a few minutes.")
     context['sitting'] = sitting
-    students = sitting.group.students.all().order_by('user__last_name')
+    students = list(sitting.group.students.all().select_related('user').order_by('user__last_name'))
     context['students'] = students
-    questions = sitting.exam.question_set.all()
+    questions = list(sitting.exam.question_set.all())
     context['questions'] = questions
+    grid = sitting.mark_grid(students, questions)
+    totals = sitting.student_totals(students)
     marks = []
 
     # Build 2D array in the stucture:
     #          |           |  Q1 num   | Q2
     # stu name | stu total |  Q1 score | Q2 score
     #
-    for student in sitting.group.students.all():
+    for student in students:
         row = []
         row.append(student)
-        row.append(sitting.student_total(student))
+        row.append(totals.get(student.pk))
         for question in questions:
-            try:
-                row.append(Mark.objects.get(sitting=sitting,
-                                            student=student,
-                                            question=question,
-                                            ))
-            except ObjectDoesNotExist:
-                # creating lots of marks can overload the server,
-                # so we will only create the first mark for each student.
-                if question.order == 1:
-                    row.append(Mark.objects.create(sitting=sitting,
-                                                   student=student,
-                                                   question=question))
+            row.append(grid[(student.pk, question.pk)])
 
         marks.append(row)
 
@@ -610,6 +603,39 @@ def alp_result_view(request, sitting_pk):
     return render(request, 'GreenPen/alp_exam_results.html', context)
 
 
+@user_passes_test(check_teacher)
+def bulk_mark_entry(request, sitting_pk):
+    """
+    Enter a whole sitting's marks in one go.
+
+    GET returns the grid as JSON. POST takes
+    {"marks": [{"student": pk, "question": pk, "score": x}, ...]} and saves
+    them all together (see Sitting.save_scores), returning the number saved,
+    or a 400 with the errors if any score is invalid.
+    """
+    sitting = get_object_or_404(Sitting, pk=sitting_pk)
+
+    if request.method == 'POST':
+        try:
+            cells = json.loads(request.body)['marks']
+            scores = [(int(cell['student']), int(cell['question']), cell.get('score')) for cell in cells]
+        except (ValueError, KeyError, TypeError):
+            return HttpResponseBadRequest('Expected {"marks": [{"student": pk, "question": pk, "score": x}, ...]}')
+        saved, errors = sitting.save_scores(scores)
+        if errors:
+            return JsonResponse({'errors': errors}, status=400)
+        return JsonResponse({'saved': saved})
+
+    students = list(sitting.student_qs().select_related('user').order_by('user__last_name'))
+    questions = list(sitting.exam.question_set.all().order_by('order'))
+    grid = sitting.mark_grid(students, questions)
+    return JsonResponse({'students': [{'pk': student.pk, 'name': student.full_name()} for student in students],
+                         'questions': [{'pk': question.pk, 'number': question.number, 'max_score': question.max_score}
+                                       for question in questions],
+                         'marks': [{'student': student_pk, 'question': question_pk, 'score': mark.score}
+                                   for (student_pk, question_pk), mark in grid.items()]})
+
+
 @user_passes_test(check_teacher)
 def teacher_dashboard(request):
     return render(request, 'GreenPen/teacher_dashboard.html')
@@ -707,24 +733,15 @@ def year_rollover_part2(request):
     # Copy the days from previous calendar
     prev_year = list(AcademicYear.objects.all().order_by('order'))[-2]
     curr_year = AcademicYear.objects.get(current=True)
-    for new_day in Day.objects.filter(year=prev_year).order_by('order'):
-        new_day.pk = None
-        new_day.year = curr_year
-        try:
-            new_day.save()
-        except IntegrityError:
-            # Means the day alreay exists
-            continue
+    # (any that already exist are skipped)
+    Day.objects.bulk_create([Day(order=day.order, name=day.name, year=curr_year)
+                             for day in Day.objects.filter(year=prev_year).order_by('order')],
+                            ignore_conflicts=True)
 
     # Copy periods from last year
-    for new_period in Period.objects.filter(year=prev_year).order_by('order'):
-        new_period.pk = None
-        new_period.year = curr_year
-        try:
-            new_period.save()
-        except IntegrityError:
-            # Already exists
-            continue
+    Period.objects.bulk_create([Period(order=period.order, name=period.name, year=curr_year)
+                                for period in Period.objects.filter(year=prev_year).order_by('order')],
+                               ignore_conflicts=True)
 
     # Now set up the new calendar
     set_up_slots(curr_year)
@@ -771,10 +788,10 @@ def year_rollover_part3(request):
         if csvform.is_valid():
             file = csvform.save()
             path = file.document.path
-            import_groups_from_sims(path)
+            report = import_groups_from_sims(path)
             os.remove(path)
             file.delete()
-            messages.success(request, "Completed the rollover!")
+            messages.success(request, "Completed the rollover! " + str(report))
             return redirect('/')
     else:
         csvform = CSVDocForm()
@@ -786,7 +803,6 @@ def year_rollover_part3(request):
 @user_passes_test(check_teacher)
 def new_sitting(request, exam_pk):
     exam = Exam.objects.get(pk=exam_pk)
-    questions = Question.objects.filter(exam=exam)
     sittingform = NewSittingForm()
     # sittingform.set_group_choices(user=request.user)
     if request.method == 'POST':
@@ -805,9 +821,7 @@ def new_sitting(request, exam_pk):
                                                       scores_sheet_url=sittingform.cleaned_data['response_form_url']
                                                       )
 
-                 # Import the questions before we create
-                t = threading.Thread(target=sitting.import_scores, daemon=True)
-                t.start()
+                enqueue_job('import_gquiz_scores', sitting=sitting)
                 messages.warning(request, "Started importing questions. Return to the scores page in a few minutes to check they've imported correctly.")
 
             else:
@@ -815,10 +829,7 @@ def new_sitting(request, exam_pk):
                                                  group=classgroup,
                                                  date=sittingform.cleaned_data['date'],
                                                  )
-            students = classgroup.students.all()
-            for student in students:
-                for question in questions:
-                    Mark.objects.get_or_create(student=student, question=question, sitting=sitting)
+            sync_marks([sitting], students=classgroup.students.all())
             return redirect(reverse('exam-results', args=[sitting.pk, ]))
 
         else:
@@ -831,16 +842,21 @@ def new_sitting(request, exam_pk):
 
 def import_sitting_scores(request, sitting_pk):
     sitting = GQuizSitting.objects.get(pk=sitting_pk)
-    if sitting.importing:
-        messages.error(request, "There is already an import running for this sitting. Please check back later.")
+    if sitting.backgroundjob_set.filter(task='import_gquiz_scores', status=BackgroundJob.QUEUED).exists():
+        messages.error(request, "There is already an import waiting to run for this sitting. Please check back later.")
     else:
-        t = threading.Thread(target=sitting.import_scores, daemon=True)
-
-        t.start()
+        enqueue_job('import_gquiz_scores', sitting=sitting)
         messages.warning(request, "Started importing questions. Return to the scores page in a few minutes to check they've imported correctly.")
     return redirect(reverse('exam-results', args=[sitting.pk, ]))
 
 
+@user_passes_test(check_teacher)
+def job_status(request, job_pk):
+    """ Report the progress of a background job as JSON, for pages to poll. """
+    job = get_object_or_404(BackgroundJob, pk=job_pk)
+    return JsonResponse(job.status_dict())
+
+
 @user_passes_test(check_teacher)
 def confirm_delete_sitting(request, sitting_pk):
     sitting = Sitting.objects.get(pk=sitting_pk)
@@ -922,21 +938,19 @@ def timetable_overview(request, start_slot_pk, teacher_pk):
     :return:
     """
     teacher = Teacher.objects.get(pk=teacher_pk)
-    starting_slot = CalendaredPeriod.objects.get(pk=start_slot_pk)
+    starting_slot = CalendaredPeriod.objects.select_related('tt_slot').get(pk=start_slot_pk)
 
-    slots = CalendaredPeriod.objects.filter(date__gte=starting_slot.date,
-                                            date__lt=starting_slot.date + datetime.timedelta(weeks=1))
     calendar_items = build_week_grid(starting_slot, teacher)
 
     try:
         next_week_pk = CalendaredPeriod.objects.get(date=starting_slot.date + datetime.timedelta(weeks=1),
-                                                    tt_slot__period=starting_slot.tt_slot.period).pk
+                                                    tt_slot__period=starting_slot.tt_slot.period_id).pk
     except ObjectDoesNotExist:
         next_week_pk = False
 
     try:
         last_week_pk = CalendaredPeriod.objects.get(date=starting_slot.date - datetime.timedelta(weeks=1),
-                                                    tt_slot__period=starting_slot.tt_slot.period).pk
+                                                    tt_slot__period=starting_slot.tt_slot.period_id).pk
     except ObjectDoesNotExist:
         last_week_pk = False
 
@@ -947,6 +961,109 @@ def timetable_overview(request, start_slot_pk, teacher_pk):
                                                                 'return_pk': start_slot_pk})
 
 
+def timetable_date_range(request):
+    """ The optional start and end dates (YYYY-MM-DD) given in a request's query string. """
+    dates = []
+    for param in ['start', 'end']:
+        try:
+            dates.append(datetime.date.fromisoformat(request.GET[param]))
+        except (KeyError, ValueError):
+            dates.append(None)
+    return dates
+
+
+@user_passes_test(check_teacher)
+def timetable_year(request, teacher_pk):
+    """
+    A teacher's timetable for the whole year, one row per day, for planning
+    and printing. Use ?start=YYYY-MM-DD&end=YYYY-MM-DD to show a single term.
+    """
+    teacher = get_object_or_404(Teacher, pk=teacher_pk)
+    start_date, end_date = timetable_date_range(request)
+    periods = list(Period.objects.filter(year__current=True).values_list('name', flat=True))
+
+    days = {}
+    for date, period, lessons, suspensions in teacher_timetable(teacher, start_date, end_date):
+        days.setdefault(date, {})[period] = {'lessons': lessons, 'suspensions': suspensions}
+    rows = [(date, [cells.get(period) for period in periods]) for date, cells in days.items()]
+
+    return render(request, 'GreenPen/timetable_year.html', {'teacher': teacher,
+                                                            'periods': periods,
+                                                            'rows': rows,
+                                                            'start': start_date,
+                                                            'end': end_date})
+
+
+def ical_text(text):
+    """ Escape text for an iCalendar property value. """
+    return str(text or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def ical_fold(line):
+    """ Fold an iCalendar content line so that no line is longer than 75 octets (RFC 5545 3.1). """
+    lines = []
+    current, size = '', 0
+    for char in line:
+        char_size = len(char.encode('utf-8'))
+        if size + char_size > 75:
+            lines.append(current)
+            # Continuation lines start with a space:
+            current, size = ' ', 1
+        current += char
+        size += char_size
+    lines.append(current)
+    return '\r\n'.join(lines)
+
+
+@user_passes_test(check_teacher)
+def timetable_export(request, teacher_pk, file_format):
+    """
+    Download a teacher's lessons for the year (or ?start= / ?end= dates) as
+    a CSV file or an iCalendar file. Periods don't have times, so calendar
+    events are all-day events named after the period.
+    """
+    teacher = get_object_or_404(Teacher, pk=teacher_pk)
+    start_date, end_date = timetable_date_range(request)
+    timetable = teacher_timetable(teacher, start_date, end_date)
+    filename = 'timetable-' + str(teacher.staff_code or teacher.pk)
+
+    if file_format == 'csv':
+        response = HttpResponse(content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="{}.csv"'.format(filename)
+        writer = csv.writer(response)
+        writer.writerow(['Date', 'Period', 'Group', 'Title', 'Description', 'Requirements', 'Suspended'])
+        for date, period, lessons, suspensions in timetable:
+            for lesson in lessons:
+                writer.writerow([date, period, lesson['teachinggroup__name'], lesson['title'],
+                                 lesson['description'], lesson['requirements'], '; '.join(map(str, suspensions))])
+            if suspensions and not lessons:
+                writer.writerow([date, period, '', '', '', '', '; '.join(map(str, suspensions))])
+        return response
+
+    if file_format == 'ics':
+        lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//GreenPen//Timetable//EN']
+        stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+        for date, period, lessons, suspensions in timetable:
+            for lesson in lessons:
+                lines += ['BEGIN:VEVENT',
+                          # Lessons move between dates when others are added or suspended, so
+                          # the UID only depends on the lesson, letting calendars move the event:
+                          'UID:greenpen-lesson-{}@{}'.format(lesson['pk'], request.get_host()),
+                          'DTSTAMP:' + stamp,
+                          'DTSTART;VALUE=DATE:' + date.strftime('%Y%m%d'),
+                          'SUMMARY:' + ical_text('P{} {}: {}'.format(period, lesson['teachinggroup__name'],
+                                                                      lesson['title'] or 'Lesson')),
+                          'DESCRIPTION:' + ical_text(lesson['description']),
+                          'END:VEVENT']
+        lines.append('END:VCALENDAR')
+        response = HttpResponse('\r\n'.join(ical_fold(line) for line in lines) + '\r\n',
+                                content_type='text/calendar')
+        response['Content-Disposition'] = 'attachment; filename="{}.ics"'.format(filename)
+        return response
+
+    raise Http404('Unknown format')
+
+
 @user_passes_test(check_teacher)
 def add_tt_lesson(request, slot_pk):
     """
@@ -977,31 +1094,44 @@ def add_tt_lesson(request, slot_pk):
 
 def build_week_grid(start_period=CalendaredPeriod.objects.none(),
                     teacher=Teacher.objects.none()):
-    days = Day.objects.filter(year=AcademicYear.objects.get(current=True))
-    periods = Period.objects.filter(year=AcademicYear.objects.get(current=True))
-
-    slots = CalendaredPeriod.objects.filter(date__gte=start_period.date,
-                                            date__lt=start_period.date + datetime.timedelta(weeks=1))
-    row = [period for period in periods]
-    #    row = [''] + row
-    rows = [row]
+    """
+    Lay out a teacher's lessons and suspensions for the week beginning at
+    start_period. The week's periods, lessons and suspensions are each
+    fetched in one query and arranged into the grid in memory.
+
+    :return: a list of rows. The first is the periods; each following row is
+             a day followed by one dict per period with its 'lessons',
+             'suspensions' (False if there are none) and 'slot'.
+    """
+    year = AcademicYear.objects.get(current=True)
+    days = list(Day.objects.filter(year=year))
+    periods = list(Period.objects.filter(year=year))
+
+    slots = {}
+    for slot in CalendaredPeriod.objects.filter(date__gte=start_period.date,
+                                                date__lt=start_period.date + datetime.timedelta(weeks=1)
+                                                ).select_related('tt_slot'):
+        slots[(slot.tt_slot.day_id, slot.tt_slot.period_id)] = slot
+
+    # Either add all lessons (might double book teachers!) or make false
+    lessons = {}
+    for lesson in Lesson.objects.filter(slot__in=slots.values(), teachinggroup__teachers=teacher) \
+            .select_related('teachinggroup', 'slot').prefetch_related('resources').order_by('teachinggroup__name'):
+        lessons.setdefault(lesson.slot_id, []).append(lesson)
+
+    suspensions = {}
+    for suspension in Suspension.objects.filter(slot__in=slots.values()).filter(Q(teachinggroups__teachers=teacher)
+                                                                                | Q(whole_school=True)).distinct():
+        suspensions.setdefault(suspension.slot_id, []).append(suspension)
+
+    rows = [periods]
     for day in days:
         row = [day]
         for period in periods:
-            slot = slots.get(tt_slot__day=day, tt_slot__period=period)
-
-            # Either add all lessons (might double book teachers!) or make false
-            lessons = Lesson.objects.filter(slot=slot, teachinggroup__teachers=teacher)
-            if not lessons.count():
-                lessons = False
-
-            # Add suspensions or make false.
-            suspensions = Suspension.objects.filter(slot=slot).filter(Q(teachinggroups__teachers=teacher)
-                                                                      | Q(whole_school=True))
-            if not suspensions.count():
-                suspensions = False
-            row.append({'lessons': lessons,
-                        'suspensions': suspensions,
+            slot = slots.get((day.pk, period.pk))
+            pk = slot.pk if slot else None
+            row.append({'lessons': lessons.get(pk, False),
+                        'suspensions': suspensions.get(pk, False),
                         'slot': slot})
         rows.append(row)
 
@@ -1084,68 +1214,160 @@ def suspend_days(request):
     if request.method == 'POST':
         form = SuspendDaysForm(request.POST)
         if form.is_valid():
-            start_date = form.cleaned_data['start_date']
-            end_date = form.cleaned_data['end_date']
-            whole_school = form.cleaned_data['whole_school']
-            teachinggroups = form.cleaned_data['teaching_groups']
-
-            delta = end_date - start_date  # as timedelta
-
-            for i in range(delta.days + 1):
-                day = start_date + datetime.timedelta(days=i)
-                periods = Period.objects.filter(year=AcademicYear.objects.get(current=True))
-                for period in periods:
-                    suspension = Suspension.objects.create(date=day,
-                                                           whole_school=whole_school,
-                                                           reason=form.cleaned_data['reason'],
-                                                           period=period)
-                    if not whole_school:
-                        suspension.teachinggroups.set(teachinggroups)
+            suspend_periods(form.cleaned_data['start_date'],
+                            form.cleaned_data['end_date'],
+                            reason=form.cleaned_data['reason'],
+                            whole_school=form.cleaned_data['whole_school'],
+                            teachinggroups=form.cleaned_data['teaching_groups'])
             return redirect(reverse('tt_splash'))
 
     return render(request, 'GreenPen/suspend_days.html', {'form': form})
 
 
-@login_required()
-def load_mistake_children(request, mark_pk=False):
+def jstree_nodes(request, queryset, roots):
+    """
+    The nodes to send for a lazy-loading jsTree request: the children of the
+    node in ?id=, or `roots` on the first load (when jsTree sends '#').
+    Add ?subtree=1 to get everything below the node in one response instead,
+    saving a round trip for each level when expanding deep nodes.
+    """
+    try:
+        parent_id = int(request.GET.get('id'))
+    except (TypeError, ValueError):
+        return roots
+    if request.GET.get('subtree'):
+        return get_object_or_404(queryset, pk=parent_id).get_descendants()
+    return queryset.filter(parent_id=parent_id)
+
+
+def selected_tree_pks(selected):
+    """
+    The pks of a queryset of selected MPTT nodes and of their ancestors, as
+    sets, so that each node of a jsTree response can be checked against them
+    without any more queries.
+    """
+    nodes = list(selected.values_list('pk', 'tree_id', 'lft', 'rght'))
+    if not nodes:
+        return set(), set()
+    ancestors = Q()
+    for pk, tree_id, lft, rght in nodes:
+        ancestors |= Q(tree_id=tree_id, lft__lt=lft, rght__gt=rght)
+    return {node[0] for node in nodes}, set(selected.model.objects.filter(ancestors).values_list('pk', flat=True))
+
+
+def jstree_node(node, text, root_level=0):
+    """ A jsTree JSON node for an MPTT node, without any per-user state. """
+    if node.level == root_level or node.parent_id is None:
+        parent_pk = '#'
+    else:
+        parent_pk = node.parent_id
+    return {'id': node.pk,
+            'parent': parent_pk,
+            'text': text(node),
+            'children': node.rght - node.lft > 1}
+
+
+def jstree_state(nodes, checked, ancestors, opened, li_attr):
+    """ Copies of jstree_node() nodes with the per-request state laid over them (see jstree_json()). """
+    data = []
+    for node in nodes:
+        pk = node['id']
+        node = dict(node, state={'selected': pk in checked,
+                                 'undetermined': pk in ancestors,
+                                 'opened': pk in ancestors or pk in opened})
+        if li_attr is not None:
+            node['li_attr'] = li_attr.get(pk, False)
+        data.append(node)
+    return data
+
+
+# Seconds to keep the structure of a jsTree response for. Changing a tree
+# changes its tree version (see GreenPen.models.tree_version), so this only
+# limits how long unused entries hang around.
+TREE_JSON_TIMEOUT = 60 * 60 * 24
+
+
+def jstree_json(request, queryset, roots, text, root_level=0, checked=frozenset(), ancestors=frozenset(),
+                opened=frozenset(), li_attr=None, public=False):
+    """
+    A jsTree JSON response for the nodes asked for in `request` (see
+    jstree_nodes()), with a strong ETag so that repeated expansions can be
+    answered with a 304.
+
+    The structure of the nodes (ids, parents, text, whether they have
+    children) is the same for everyone, so it is cached against the tree
+    version. Which nodes are checked, part-checked or open depends on the
+    request, and is laid over the cached structure afterwards.
+
+    :param text: function giving the text to show for a node
+    :param checked: pks of checked nodes
+    :param ancestors: pks of ancestors of checked nodes; shown open and part-checked
+    :param opened: pks of other nodes to show open
+    :param li_attr: optional dict of pk: attributes for a node's <li>. Nodes
+                    not in it get False.
+    :param public: whether shared caches may keep the response, i.e. it doesn't
+                   depend on who is asking
+
+    The tree version is kept in the cache, so without settings.SHARED_CACHE
+    another process may have changed the tree without this one knowing. The
+    structure is then built every time and no ETag is sent.
+    """
+    if not settings.SHARED_CACHE:
+        response = JsonResponse(jstree_state([jstree_node(node, text, root_level=root_level)
+                                              for node in jstree_nodes(request, queryset, roots)],
+                                             checked, ancestors, opened, li_attr), safe=False)
+        patch_cache_control(response, no_store=True)
+        return response
+
+    version = tree_version(queryset.model)
     parent_id = request.GET.get('id')
+    subtree = bool(request.GET.get('subtree'))
     try:
-        parent_id = int(parent_id)
-        parent = Mistake.objects.get(pk=parent_id)
-        children = Mistake.objects.filter(parent=parent)
-    except ValueError:
-        children = Mistake.objects.filter(level=0)
+        int(parent_id)
+        root_pks = []
+    except (TypeError, ValueError):
+        parent_id = '#'
+        root_pks = list(roots.values_list('pk', flat=True))
+    structure = [queryset.model._meta.label, version, parent_id, subtree, root_pks, root_level]
+    overlay = [sorted(checked), sorted(ancestors), sorted(opened),
+               None if li_attr is None else sorted(li_attr.items(), key=lambda item: item[0])]
+    etag = quote_etag(hashlib.sha256(json.dumps([structure, overlay], default=str).encode()).hexdigest())
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        key = 'greenpen_tree_json_' + hashlib.sha256(json.dumps(structure).encode()).hexdigest()
+        nodes = cache.get(key)
+        if nodes is None:
+            nodes = [jstree_node(node, text, root_level=root_level)
+                     for node in jstree_nodes(request, queryset, roots)]
+            cache.set(key, nodes, TREE_JSON_TIMEOUT)
+
+        response = JsonResponse(jstree_state(nodes, checked, ancestors, opened, li_attr), safe=False)
+        response['ETag'] = etag
+
+    # Browsers must check back each time (as selections change), but can be
+    # told nothing has changed:
+    if public:
+        patch_cache_control(response, public=True, no_cache=True)
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def syllabus_text(point):
+    return str(point.identifier) + ": " + str(point.text)
+
 
+@login_required()
+def load_mistake_children(request, mark_pk=False):
+    mark_mistakes, mistake_ancestors = set(), set()
     if mark_pk:
         mark = Mark.objects.get(pk=mark_pk)
-        mark_mistakes = mark.mistakes.all()
-        mistake_ancestors = mark.mistakes.all().get_ancestors(include_self=False)
+        mark_mistakes, mistake_ancestors = selected_tree_pks(mark.mistakes.all())
 
-    data = []
-    for child in children:
-        if child.parent:
-            parent_pk = child.parent.pk
-        else:
-            parent_pk = '#'
-        undetermined = False
-        selected = False
-        opened = False
-        if mark_pk:
-            if child in mistake_ancestors:
-                undetermined = True
-                opened = True
-            if child in mark_mistakes:
-                selected = True
-        data.append({
-            'id': child.pk,
-            'parent': parent_pk,
-            'text': child.mistake_type,
-            'children': not child.is_leaf_node(),
-            'state': {'selected': selected,
-                      'undetermined': undetermined,
-                      'opened': opened}
-        })
-    return JsonResponse(data, safe=False)
+    return jstree_json(request, Mistake.objects.all(), Mistake.objects.filter(level=0),
+                       lambda mistake: mistake.mistake_type,
+                       checked=mark_mistakes, ancestors=mistake_ancestors)
 
 
 @login_required()
@@ -1193,6 +1415,9 @@ class SyllabusJSONView(View):
     # the tree, e.g. for a lesson.
     syllabus = Syllabus.objects.filter(level=0)
     root_level = 0
+    # Whether responses are the same for every user, so shared caches may keep
+    # them. Set this to False if set_children() depends on the request.
+    cache_public = True
 
     def set_syllabus(self, syllabus):
         if syllabus:
@@ -1220,45 +1445,15 @@ class SyllabusJSONView(View):
 
     def get(self, request, *args, **kwargs):
         self.set_syllabus(False)
-        parent_id = self.request.GET.get('id')
         self.set_root_level()
         checked, indeterminate = self.set_children()
+        # Evaluate each once, rather than for every child:
+        checked = set(checked.values_list('pk', flat=True))
+        indeterminate = set(indeterminate.values_list('pk', flat=True))
 
-        try:
-            parent_id = int(parent_id)
-            parent = Syllabus.objects.get(pk=parent_id)
-            children = Syllabus.objects.filter(parent=parent)
-        except ValueError:
-            children = self.syllabus
-
-        data = []
-        for child in children:
-            if child.get_level() == self.root_level:
-                parent_pk = '#'
-            elif child.parent:
-                parent_pk = child.parent.pk
-            else:
-                parent_pk = '#' # We shouldn't get here, as root level is 0 by default.
-            undetermined = False
-            selected = False
-            opened = False
-            if child in indeterminate:
-                undetermined = True
-                opened = True
-
-            if child in checked:
-                selected = True
-
-            data.append({
-                'id': child.pk,
-                'parent': parent_pk,
-                'text': str(child.identifier) + ": " + str(child.text),
-                'children': not child.is_leaf_node(),
-                'state': {'selected': selected,
-                          'undetermined': undetermined,
-                          'opened': opened}
-            })
-        return JsonResponse(data, safe=False)
+        return jstree_json(request, Syllabus.objects.all(), self.syllabus, syllabus_text,
+                           root_level=self.root_level, checked=checked, ancestors=indeterminate,
+                           public=self.cache_public)
 
 
 @login_required()
@@ -1268,67 +1463,19 @@ def load_syllabus_points_exam(request, exam_pk):
     syllabus section that an exam tests.
     """
 
-    # See if we have a parent loaded. If we are expanding a node, this will be present.
-    # if not, we are on the initial load, and it will raise a value error.
-    parent_id = request.GET.get('id')
-    try:
-        parent_id = int(parent_id)
-        parent = Syllabus.objects.get(pk=parent_id)
-        children = Syllabus.objects.filter(parent=parent)
-    except ValueError:
-        children = Syllabus.objects.filter(level=0)
-
     # get the exam, and find what syallbus it's currently set to.
     exam = Exam.objects.get(pk=exam_pk)
-
-    if exam.syllabus:
-        exam_syllabus = exam.syllabus
-        exam_ancestors = exam_syllabus.get_ancestors(include_self=False)
+    exam_syllabus, exam_ancestors = selected_tree_pks(Syllabus.objects.filter(pk=exam.syllabus_id))
 
     # We also want to open the nodes for any points already
     # in the exam
+    included_points, included_ancestors = selected_tree_pks(Syllabus.objects.filter(question__exam=exam))
+    li_attr = {pk: {"class": "jstree-ancestor-checked"} for pk in included_ancestors}
+    li_attr.update({pk: {"class": "jstree-syllabus-checked"} for pk in included_points})
 
-    included_points = Syllabus.objects.filter(question__exam=exam)
-
-    included_ancestors = included_points.get_ancestors(include_self=False)
-
-    #  Build a list of the parent points.
-    data = []
-    for child in children:
-        if child.parent:
-            parent_pk = child.parent.pk
-        else:
-            parent_pk = '#'
-        undetermined = False
-        selected = False
-        opened = False
-        li_attr = False
-        if exam.syllabus:
-            if child in exam_ancestors:
-                undetermined = True
-                opened = True
-
-            if child == exam_syllabus:
-                selected = True
-
-        if child in included_ancestors:
-            opened = True
-            li_attr = {"class": "jstree-ancestor-checked"}
-
-        if child in included_points:
-            li_attr = {"class": "jstree-syllabus-checked"}
-
-        data.append({
-            'id': child.pk,
-            'parent': parent_pk,
-            'text': str(child.identifier) + ": " + str(child.text),
-            'children': not child.is_leaf_node(),
-            'state': {'selected': selected,
-                      'undetermined': undetermined,
-                      'opened': opened},
-            'li_attr': li_attr
-        })
-    return JsonResponse(data, safe=False)
+    return jstree_json(request, Syllabus.objects.all(), Syllabus.objects.filter(level=0), syllabus_text,
+                       checked=exam_syllabus, ancestors=exam_ancestors, opened=included_ancestors,
+                       li_attr=li_attr)
 
 
 def is_teacher(user=User.objects.none()):
@@ -1486,6 +1633,8 @@ class EditResource(AddResource, UpdateView):
 
 
 class ResourceSyllabusJSON(SyllabusJSONView):
+    cache_public = False
+
     def set_children(self):
         resource_pk = self.kwargs['resource_pk']
         resource = Resource.objects.get(pk=resource_pk)
@@ -1496,6 +1645,7 @@ class ResourceSyllabusJSON(SyllabusJSONView):
 
 
 class LessonSyllabusJSON(SyllabusJSONView):
+    cache_public = False
 
     def set_children(self):
         lesson_pk = self.kwargs['lesson_pk']
@@ -1611,46 +1761,32 @@ def import_student_self_assessment_scores_pt2(request, sitting_pk, student_pk):
 
 @csrf_exempt
 def gquiz_alert(request):
-    if request.method == 'POST':
+    """
+    Called by the Google Apps Script on a quiz's response form whenever a
+    student submits it. The response is recorded and imported by a
+    background job (see notify_gquiz_response), so Google gets a reply
+    straight away.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
         recieved_json = json.loads(request.body)
         sheet_url = recieved_json['form_url']
         student_email = recieved_json['student_email']
-        response_timestamp = recieved_json['timestamp']
-
-        remote_add = request.META['REMOTE_ADDR']
-
-
-        print('Sheet url: ' + sheet_url)
-        print('Email: ' + student_email)
-        print('Timestamp' + response_timestamp)
-        print('remote address:' + remote_add)
-
-        time_string = str(response_timestamp)
+        time_string = str(recieved_json['timestamp'])
+        # Timestamps look like 2021-01-01T10:00:00.000Z:
         time_string = time_string.replace('T', ' ')
         time_string = re.match(r'(.*)\.', time_string).group()
         time_string = time_string[:-1]
         response_timestamp = datetime.datetime.strptime(time_string, "%Y-%m-%d %H:%M:%S")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return HttpResponseBadRequest('Expected JSON with form_url, student_email and timestamp')
 
-        sittings = GQuizSitting.objects.filter(scores_sheet_url=sheet_url)
+    if not GQuizSitting.objects.filter(scores_sheet_url=sheet_url).exists():
+        raise Http404('No sitting uses this response sheet')
 
-        if sittings.count() > 1:
-            # More than one sitting using the same response sheet.
-            # This should only occur for self-assessment quizzes.
-            if sittings.count() != sittings.filter(self_assessment=True).count():
-                raise IntegrityError("Multiple sittings using the same URL")
-
-            sitting = sittings.filter(students__user__email=student_email).get_closest_to(response_timestamp)
-        else:
-            sitting = GQuizSitting.objects.get(scores_sheet_url=sheet_url)
-
-        sitting.import_scores(email=student_email, timestamp=response_timestamp)
-        print("E:" + student_email +":E")
-        print("T:" + str(response_timestamp) +"T")
-        sitting.imported = True
-        sitting.save()
-        return HttpResponse('Success')
-    else:
-        return HttpResponseBadRequest
+    notify_gquiz_response(sheet_url, student_email, response_timestamp)
+    return HttpResponse('Accepted', status=202)
 
 
 @teacher_or_own_only